@@ -1,33 +1,65 @@
+import asyncio
+import base64
+from contextlib import asynccontextmanager
+from email.utils import formatdate
 import json
+import math
 import traceback
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from urllib.parse import urlencode
 from utils.config import config
-from utils.floatie import fetch_video_data
+from utils.floatie import fetch_video_data_async
 from utils.proxy import get_proxy_url
-from utils.redis_handler import wait_for_message, queue_high, queue_low, redis_conn
-from utils.logger import log
-from typing import Any
+from utils.priority_queue import priority_score
+from utils.redis_handler import fetch_job, get_job_queue, take_over_job, wait_for_message, queue_resolve, queue_render, redis_conn
+from utils.access_trace import record_access
+from utils.batch_lookup import BatchEntry, BatchResult, lookup_thumbnails, max_batch_size
+from utils.cleanup import update_last_used
+from utils.admission import estimate_ready_in, wait_timeout
+from utils.job_events import max_jobs_per_client, parse_job_id, stream_job_events
+from utils.hot_cache import get_hot_cache
+from utils.format_selection import get_chosen_formats, get_measured_render_times
+from utils.logger import log, log_error
+from utils.negative_cache import failure_messages, get_cached_failure
+from utils.metrics import RequestMetrics, render_app_metrics, thumbnail_response_duration
+from utils.profiling import ProfilingMiddleware, request_profiling
+from utils.sharding import ShardRoutingMiddleware, run_heartbeat
+from typing import Any, AsyncIterator
 import time
+from time import perf_counter
 from hmac import compare_digest
 from rq.worker import Worker
 from utils.test_utils import in_test
 import logging
 
-from utils.thumbnail import generate_thumbnail, get_latest_thumbnail_from_files, get_job_id, get_thumbnail_from_files, set_best_time
+from utils.thumbnail import Thumbnail, decode_job_status, find_thumbnail_file, get_finished_thumbnail, get_latest_thumbnail_from_files, \
+    get_job_id, get_render_job_id, get_thumbnail_from_files, get_variant_width, quantize_time, resolve_thumbnail, set_best_time
 from utils.video import valid_video_id
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # Every app process announces the node, so that it stays on the ring while any of them is running
+    heartbeat = asyncio.create_task(run_heartbeat()) if config["sharding"]["enabled"] else None
+    yield
+    if heartbeat is not None:
+        heartbeat.cancel()
+
+app = FastAPI(lifespan=lifespan)
+# Added first so that forwarded responses still get the CORS headers
+app.add_middleware(ShardRoutingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Timestamp", "X-Title", "X-Failure-Reason"],
+    expose_headers=["X-Timestamp", "X-Title", "X-Failure-Reason", "X-Estimated-Ready", "X-Job-ID", "ETag", "Last-Modified"],
     max_age=86400,
 )
+app.add_middleware(ProfilingMiddleware)
 
 logger = logging.getLogger('uvicorn.error')
 
@@ -42,105 +74,300 @@ async def get_thumbnail(response: Response, request: Request,
                         title: str | None = None,
                         officialTime: bool = False,
                         isLivestream: bool = False,
-                        redirectUrl: str | None = None) -> Response:
+                        redirectUrl: str | None = None,
+                        width: int | None = None) -> Response:
+    request_metrics = RequestMetrics(bool(generateNow), bool(isLivestream))
     if type(videoID) is not str or (type(time) is not float and time is not None) \
-            or type(generateNow) is not bool or not valid_video_id(videoID):
+            or type(generateNow) is not bool or not valid_video_id(videoID) \
+            or (width is not None and width <= 0):
+        request_metrics.record("invalid")
         raise HTTPException(status_code=400, detail="Invalid parameters")
 
+    variant_width = get_variant_width(width) if width is not None else None
+
+    if time is not None:
+        time = await quantize_time(videoID, time)
+
     if officialTime and time is not None:
         await set_best_time(videoID, time)
 
     try:
-        return await handle_thumbnail_response(videoID, time, isLivestream, title, response)
+        thumbnail_response = await handle_thumbnail_response(videoID, time, isLivestream, title, response, variant_width,
+                                                                request.headers.get("If-None-Match"))
+        request_metrics.record("cache_hit")
+        record_access(videoID, time, True, len(thumbnail_response.body))
+        return thumbnail_response
     except FileNotFoundError:
-        pass
+        record_access(videoID, time, False, 0)
 
     if time is None:
         # If we got here with a None time, then there is no thumbnail to pull from
-        return thumbnail_response_error(redirectUrl, "Thumbnail not cached")
+        return thumbnail_response_error(redirectUrl, "Thumbnail not cached", request_metrics, "not_cached")
 
+    failure_reason = await get_cached_failure(videoID)
+    if failure_reason is not None:
+        # This video failed recently for a reason that does not depend on the time
+        return thumbnail_response_error(redirectUrl, failure_messages.get(failure_reason, "Failed to generate thumbnail"),
+                                        request_metrics, "cached_failure")
 
     job_id = get_job_id(videoID, time)
-    queue = queue_high if generateNow else queue_low
-
-    job = queue.fetch_job(job_id)
-    other_queue_job = queue_low.fetch_job(job_id) if queue == queue_high else queue_high.fetch_job(job_id)
-    if other_queue_job is not None:
-        if other_queue_job.is_started:
-            # It is already started, use it
-            job = other_queue_job
-        elif queue == queue_high:
-            # Old queue is low, prefer new one
-            queue_low.remove(other_queue_job)
-        elif job is not None:
-            # New queue is low, old queue is high, prefer old one
-            queue.remove(job)
-            job = other_queue_job
-        else:
-            # New queue is low, old queue is high, prefer old one
-            job = other_queue_job
+    priority = get_request_priority(request, generateNow)
+
+    # Found on any node's queue, as a job of a video that moved to this node is still on the queue of the old one
+    job = fetch_job(job_id)
+    if job is not None and job.is_finished:
+        # The playback url has been resolved, follow the job through the render stage
+        render_job = fetch_job(get_render_job_id(videoID, time))
+        if render_job is not None and not render_job.is_finished:
+            job = render_job
+    if job is not None:
+        job = take_over_job(job)
 
     if job is None or job.is_finished:
-        if len(queue) > config["thumbnail_storage"]["max_queue_size"]:
-            return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail due to queue being too big")
+        if len(queue_resolve) >= config["priority"]["max_queued"][priority]:
+            return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail due to queue being too big",
+                                            request_metrics, "queue_full")
 
         # Start the job if it is not already started
-        # TODO: Remove the ttl when proper priority is implemented
-        job = queue.enqueue(generate_thumbnail,
+        job = queue_resolve.enqueue(resolve_thumbnail,
                         args=(videoID, time, title, isLivestream, not in_test()),
                         job_id=job_id,
                         job_timeout=30,
                         failure_ttl=500,
-                        ttl=60,
-                        at_front="front_auth" in config\
-                            and config["front_auth"] is not None\
-                            and request.headers.get("authorization") == config["front_auth"])
+                        meta={"priority": priority, "priority_score": priority_score(priority)})
+    elif job.is_queued:
+        # Popular thumbnails move up the queue, and a request with a higher priority moves it to at least that priority
+        get_job_queue(job).boost(job, config["priority"]["request_boost"], priority_score(priority))
+        scores = config["priority"]["scores"]
+        if scores[priority] > scores[job.meta.get("priority", "low")]:
+            job.meta["priority"] = priority
+            job.save_meta()
 
     if job.is_failed:
-        return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail")
+        return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail", request_metrics, "failed")
 
     result: bool = False
-    if ((job.get_position() or 0) < config["thumbnail_storage"]["max_before_async_generation"]
-            and (generateNow or len(queue_high) < config["thumbnail_storage"]["max_before_async_generation"])):
+    finished_thumbnail: Thumbnail | None = None
+    # Throughput is only measured for this node's queues
+    ready_in = await estimate_ready_in(job, queue_resolve, queue_render) if get_job_queue(job) in (queue_resolve, queue_render) else None
+    if ready_in is None:
+        # Nothing has finished recently to measure from
+        position = get_job_queue(job).get_job_position(job) or 0
+        should_wait = position < config["thumbnail_storage"]["max_before_async_generation"]
+    else:
+        should_wait = ready_in <= wait_timeout
+
+    if should_wait:
         try:
-            result = (await wait_for_message(job_id)) == "true"
+            status, finished_thumbnail = decode_job_status(await wait_for_message(job_id, wait_timeout))
+            result = status == "true"
         except TimeoutError:
             log("Failed to generate thumbnail due to timeout")
-            return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail due to timeout")
+            return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail due to timeout", request_metrics, "timeout",
+                                            {"X-Job-ID": job_id})
     else:
-        log("Thumbnail not generated yet", job.get_position())
-        return thumbnail_response_error(redirectUrl, "Thumbnail not generated yet")
+        log("Thumbnail not generated yet", ready_in)
+        return thumbnail_response_error(redirectUrl, "Thumbnail not generated yet", request_metrics, "not_generated_yet",
+                                        {"X-Job-ID": job_id, **(get_estimated_ready_headers(ready_in) or {})})
 
     if result:
         try:
-            return await handle_thumbnail_response(videoID, time, isLivestream, title, response)
+            # The worker sends small thumbnails with the completion message, only variants are read back from storage
+            thumbnail_response = await handle_thumbnail_response(videoID, time, isLivestream, title, response, variant_width,
+                                                                request.headers.get("If-None-Match"),
+                                                                finished_thumbnail if variant_width is None else None)
+            request_metrics.record("generated")
+            return thumbnail_response
         except Exception as e:
             log("Server error when getting thumbnails", e)
-            return thumbnail_response_error(redirectUrl, "Server error")
+            return thumbnail_response_error(redirectUrl, "Server error", request_metrics, "server_error")
     else:
         log("Failed to generate thumbnail")
-        return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail")
+        return thumbnail_response_error(redirectUrl, "Failed to generate thumbnail", request_metrics, "generation_failed")
+
 
+@app.head("/api/v1/getThumbnail")
+async def get_thumbnail_head(videoID: str, time: float | None = None,
+                             isLivestream: bool = False,
+                             width: int | None = None) -> Response:
+    """
+    Checks if a thumbnail is cached without reading it or generating it
+    """
+    if type(videoID) is not str or (type(time) is not float and time is not None) \
+            or not valid_video_id(videoID) or (width is not None and width <= 0):
+        raise HTTPException(status_code=400, detail="Invalid parameters")
+
+    if time is not None:
+        time = await quantize_time(videoID, time)
+
+    try:
+        thumbnail_file = await find_thumbnail_file(videoID, time, isLivestream, get_variant_width(width) if width is not None else None)
+    except FileNotFoundError:
+        return Response(status_code=204, headers={"X-Failure-Reason": "Thumbnail not cached"})
+
+    headers = get_thumbnail_headers(thumbnail_file.time, thumbnail_file.etag, thumbnail_file.last_modified)
+    if thumbnail_file.size is not None:
+        headers["Content-Length"] = str(thumbnail_file.size)
+
+    return Response(media_type="image/webp", headers=headers)
+
+class BatchThumbnailEntry(BaseModel):
+    videoID: str
+    time: float | None = None
+    isLivestream: bool = False
+
+class BatchThumbnailRequest(BaseModel):
+    videos: list[BatchThumbnailEntry]
+    includeImages: bool = False
+    generateMissing: bool = False
+
+@app.post("/api/v1/getThumbnails")
+async def get_thumbnails(batch: BatchThumbnailRequest) -> dict[str, Any]:
+    """
+    Looks up many thumbnails in one request, and starts low priority jobs for the missing ones
+    when generateMissing is set. Thumbnails are returned inline when includeImages is set,
+    otherwise they can be loaded from their url.
+    """
+    if len(batch.videos) > max_batch_size or not all(valid_video_id(video.videoID) for video in batch.videos):
+        raise HTTPException(status_code=400, detail="Invalid parameters")
 
-async def handle_thumbnail_response(video_id: str, time: float | None, is_livestream: bool, title: str | None, response: Response) -> Response:
-    thumbnail = await get_thumbnail_from_files(video_id, time, is_livestream, title) if time is not None else \
-        await get_latest_thumbnail_from_files(video_id, is_livestream)
-    response.headers["X-Timestamp"] = str(thumbnail.time)
-    response.headers["Cache-Control"] = "public, max-age=3600"
+    results = await lookup_thumbnails([BatchEntry(video.videoID, video.time, video.isLivestream) for video in batch.videos],
+                                      batch.includeImages, batch.generateMissing)
+    for result in results:
+        record_access(result.video_id, result.time, result.available, len(result.image) if result.image is not None else 0)
+
+    return {"thumbnails": [get_batch_result_json(result) for result in results]}
+
+def get_batch_result_json(result: BatchResult) -> dict[str, Any]:
+    url: str | None = None
+    if result.available:
+        parameters: dict[str, str] = {"videoID": result.video_id, "time": str(result.timestamp)}
+        if result.is_livestream:
+            parameters["isLivestream"] = "true"
+        url = f"/api/v1/getThumbnail?{urlencode(parameters)}"
+
+    return {
+        "videoID": result.video_id,
+        "time": result.time,
+        "available": result.available,
+        "timestamp": result.timestamp,
+        "title": result.title.strip() if result.title is not None else None,
+        "url": url,
+        "image": base64.b64encode(result.image).decode() if result.image is not None else None,
+        "failureReason": result.failure_reason,
+        "queued": result.queued,
+        "jobID": get_job_id(result.video_id, result.time) if result.queued and result.time is not None else None,
+    }
+
+@app.get("/api/v1/jobEvents")
+async def get_job_events(jobID: list[str] = Query()) -> StreamingResponse:
+    """
+    Server-Sent Events telling when each job finishes, instead of polling getThumbnail.
+    Job IDs are sent in X-Job-ID when a thumbnail is not generated yet.
+    """
+    job_ids = list(dict.fromkeys(jobID))
+    if len(job_ids) == 0 or len(job_ids) > max_jobs_per_client or any(parse_job_id(job_id) is None for job_id in job_ids):
+        raise HTTPException(status_code=400, detail="Invalid parameters")
+
+    return StreamingResponse(stream_job_events(job_ids), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Sent as they happen instead of buffered by nginx
+        "X-Accel-Buffering": "no",
+    })
+
+def get_request_priority(request: Request, generate_now: bool) -> str:
+    if "front_auth" in config \
+            and config["front_auth"] is not None \
+            and request.headers.get("authorization") == config["front_auth"]:
+        return "front"
+    elif generate_now:
+        return "high"
+    else:
+        return "low"
+
+def get_estimated_ready_headers(ready_in: float | None) -> dict[str, str] | None:
+    if ready_in is None or not math.isfinite(ready_in):
+        return None
+
+    # Unix time at which the thumbnail is expected to be ready, so clients know when to try again
+    return {"X-Estimated-Ready": str(round(time.time() + ready_in))}
+
+async def handle_thumbnail_response(video_id: str, time: float | None, is_livestream: bool, title: str | None, response: Response,
+                                    width: int | None = None, if_none_match: str | None = None,
+                                    finished_thumbnail: Thumbnail | None = None) -> Response:
+    start_time = perf_counter()
+    result = "hit"
+    try:
+        if if_none_match is not None and title is None:
+            # Revalidations are answered from the file's stat without reading the image
+            thumbnail_file = await find_thumbnail_file(video_id, time, is_livestream, width)
+            if thumbnail_file.etag is not None and etag_matches(if_none_match, thumbnail_file.etag):
+                try:
+                    await update_last_used(video_id)
+                except Exception as e:
+                    log_error(f"Failed to update last used {e}")
+
+                thumbnail_response_duration.observe(perf_counter() - start_time, result="not_modified")
+                return Response(status_code=304, headers=get_thumbnail_headers(thumbnail_file.time, thumbnail_file.etag,
+                                                                               thumbnail_file.last_modified))
+
+        if finished_thumbnail is not None:
+            thumbnail = await get_finished_thumbnail(video_id, is_livestream, title, finished_thumbnail)
+            result = "message"
+        elif time is not None:
+            thumbnail = await get_thumbnail_from_files(video_id, time, is_livestream, title, width)
+        else:
+            thumbnail = await get_latest_thumbnail_from_files(video_id, is_livestream, width)
+    except FileNotFoundError:
+        thumbnail_response_duration.observe(perf_counter() - start_time, result="miss")
+        raise
+    except Exception:
+        thumbnail_response_duration.observe(perf_counter() - start_time, result="error")
+        raise
+
+    response.headers.update(get_thumbnail_headers(thumbnail.time, thumbnail.etag, thumbnail.last_modified))
     if thumbnail.title is not None:
         try:
             response.headers["X-Title"] = thumbnail.title.strip()
         except UnicodeEncodeError:
             pass
 
+    thumbnail_response_duration.observe(perf_counter() - start_time, result=result)
     return Response(content=thumbnail.image, media_type="image/webp", headers=response.headers)
 
-def thumbnail_response_error(redirect_url: str | None, text: str) -> Response:
-    if redirect_url is not None and redirect_url.startswith("https://i.ytimg.com"):
-        return RedirectResponse(redirect_url)
+def get_thumbnail_headers(thumbnail_time: float, etag: str | None, last_modified: float | None) -> dict[str, str]:
+    headers = {
+        "X-Timestamp": str(thumbnail_time),
+        # A title can be added to any thumbnail later, so after this it is revalidated with the ETag
+        "Cache-Control": "public, max-age=3600",
+    }
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+
+    return headers
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+
+    # Weak comparison, as If-None-Match uses
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def thumbnail_response_error(redirect_url: str | None, text: str,
+                             request_metrics: RequestMetrics | None = None, outcome: str = "error",
+                             headers: dict[str, str] | None = None) -> Response:
+    redirect = redirect_url is not None and redirect_url.startswith("https://i.ytimg.com")
+    if request_metrics is not None:
+        request_metrics.record(outcome, redirect)
+
+    if redirect_url is not None and redirect:
+        return RedirectResponse(redirect_url, headers=headers)
     else:
         raise HTTPException(status_code=204, headers={
-            "X-Failure-Reason": text
+            "X-Failure-Reason": text,
+            **(headers or {})
         })
 
 @app.get("/api/v1/status")
@@ -151,24 +378,28 @@ def get_status(includeDefault: bool = True, auth: str | None = None) -> dict[str
 
         return {
             "queues": {
-                "high": {
-                    "length": len(queue_high),
-                    "scheduled_jobs": queue_high.scheduled_job_registry.count,
-                    "finished_jobs": queue_high.finished_job_registry.count,
-                    "failed_jobs": queue_high.failed_job_registry.count,
-                    "started_jobs": queue_high.started_job_registry.count,
-                    "deferred_jobs": queue_high.deferred_job_registry.count,
-                    "cancelled_jobs": queue_high.canceled_job_registry.count,
-                },
                 "default": {
-                    "length": len(queue_low),
-                    "scheduled_jobs": queue_low.scheduled_job_registry.count,
-                    "finished_jobs": queue_low.finished_job_registry.count,
-                    "failed_jobs": queue_low.failed_job_registry.count,
-                    "started_jobs": queue_low.started_job_registry.count,
-                    "deferred_jobs": queue_low.deferred_job_registry.count,
-                    "cancelled_jobs": queue_low.canceled_job_registry.count,
+                    "length": len(queue_resolve),
+                    "scheduled_jobs": queue_resolve.scheduled_job_registry.count,
+                    "finished_jobs": queue_resolve.finished_job_registry.count,
+                    "failed_jobs": queue_resolve.failed_job_registry.count,
+                    "started_jobs": queue_resolve.started_job_registry.count,
+                    "deferred_jobs": queue_resolve.deferred_job_registry.count,
+                    "cancelled_jobs": queue_resolve.canceled_job_registry.count,
                 } if includeDefault else None,
+                # Deprecated, from before high and low priority jobs shared the default queue
+                "high": {
+                    "length": queue_resolve.count_ahead_of("high"),
+                },
+                "render": {
+                    "length": len(queue_render),
+                    "scheduled_jobs": queue_render.scheduled_job_registry.count,
+                    "finished_jobs": queue_render.finished_job_registry.count,
+                    "failed_jobs": queue_render.failed_job_registry.count,
+                    "started_jobs": queue_render.started_job_registry.count,
+                    "deferred_jobs": queue_render.deferred_job_registry.count,
+                    "cancelled_jobs": queue_render.canceled_job_registry.count,
+                },
             },
             "workers": [get_worker_info(worker, is_authorized) for worker in workers],
             "workers_count": len(workers),
@@ -185,10 +416,14 @@ def clear_queue(auth: str, low: bool = True, high: bool = False) -> None:
     is_authorized = compare_digest(auth, config["status_auth_password"])
 
     if is_authorized:
-        if low:
-            queue_low.empty()
-        if high:
-            queue_high.empty()
+        if low and high:
+            queue_resolve.empty()
+        elif low or high:
+            priorities = ["low"] if low else ["high", "front"]
+            for job in queue_resolve.get_jobs():
+                if job.meta.get("priority") in priorities:
+                    queue_resolve.remove(job)
+                    job.delete()
     else:
         raise HTTPException(status_code=204)
 
@@ -218,8 +453,20 @@ def get_worker_info(worker: Worker, is_authorized: bool) -> dict[str, Any]:
     except Exception:
         return {}
 
+@app.get("/api/v1/profiling")
+def get_profiling(auth: str, enabled: bool | None = None, threshold: float | None = None) -> dict[str, Any]:
+    if not compare_digest(auth, config["status_auth_password"]):
+        raise HTTPException(status_code=204)
+
+    if enabled is not None:
+        request_profiling.enabled = enabled
+    if threshold is not None:
+        request_profiling.threshold = threshold
+
+    return request_profiling.state()
+
 @app.get("/api/v1/floatie")
-def get_floatie(videoID: str, auth: str) -> Response:
+async def get_floatie(videoID: str, auth: str) -> Response:
     if auth != config["floatie_auth"]:
         return Response(content="Unauthorized", media_type="text/plain", status_code=401)
 
@@ -227,7 +474,7 @@ def get_floatie(videoID: str, auth: str) -> Response:
     proxy_url = proxy.url if proxy is not None else None
 
     try:
-        data = fetch_video_data(videoID, proxy_url)
+        data = await fetch_video_data_async(videoID, proxy_url)
 
         return Response(content=json.dumps(data), media_type="application/json")
     except Exception as e:
@@ -236,8 +483,13 @@ def get_floatie(videoID: str, auth: str) -> Response:
 @app.get("/metrics")
 def get_metrics() -> Response:
     workers = Worker.all(connection=redis_conn)
+    chosen_formats = get_chosen_formats()
+    render_times = get_measured_render_times(set(chosen_formats.keys()))
+    hot_cache = get_hot_cache()
+    hot_cache_stats = hot_cache.stats() if hot_cache is not None else None
     current_time = time.time()
-    queues = {"high": queue_high, "low": queue_low}
+    queues = {"default": queue_resolve, "render": queue_render}
+    high_length = queue_resolve.count_ahead_of("high")
     queue_gauges = {
         "queue_length": lambda q: len(q),
         "queue_scheduled": lambda q: q.scheduled_job_registry.count,
@@ -286,6 +538,9 @@ def get_metrics() -> Response:
             for q_name, queue in queues.items()
             for g_name, func in queue_gauges.items()
         ],
+        # Deprecated, from before high and low priority jobs shared the default queue
+        f'dearrow_queue_length{{queue="high"}} {high_length}',
+        f'dearrow_queue_length{{queue="low"}} {len(queue_resolve) - high_length}',
 
         "# HELP dearrow_current_time Current unix time",
         "# TYPE dearrow_current_time gauge",
@@ -310,12 +565,46 @@ def get_metrics() -> Response:
             for g_name, func in worker_gauges.items()
             if (result := func(w)) is not None
         ],
+
+        "# HELP dearrow_chosen_formats_total Number of times each codec and height was chosen to render from",
+        "# TYPE dearrow_chosen_formats_total counter",
+        *[
+            f'dearrow_chosen_formats_total{{codec="{codec}",height="{height}"}} {count}'
+            for (codec, height), count in chosen_formats.items()
+        ],
+
+        "# HELP dearrow_render_time_seconds Median of the recently measured render times for each codec and height",
+        "# TYPE dearrow_render_time_seconds gauge",
+        *[
+            f'dearrow_render_time_seconds{{codec="{codec}",height="{height}"}} {render_time}'
+            for (codec, height), render_time in render_times.items()
+            if render_time is not None
+        ],
+
+        *([
+            "# HELP dearrow_hot_cache_hits_total Thumbnails found in the hot cache shared by the app processes",
+            "# TYPE dearrow_hot_cache_hits_total counter",
+            f"dearrow_hot_cache_hits_total {hot_cache_stats[0]}",
+            "# HELP dearrow_hot_cache_misses_total Thumbnails looked for in the hot cache and not found",
+            "# TYPE dearrow_hot_cache_misses_total counter",
+            f"dearrow_hot_cache_misses_total {hot_cache_stats[1]}",
+            "# HELP dearrow_hot_cache_bytes Bytes of the hot cache in use",
+            "# TYPE dearrow_hot_cache_bytes gauge",
+            f"dearrow_hot_cache_bytes {hot_cache_stats[2]}",
+        ] if hot_cache_stats is not None else []),
+
+        *render_app_metrics(),
     ]
 
     return Response(content="\n".join(result), headers={"Content-Type" : "text/plain; version=0.0.4"})
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("app:app", host=config["server"]["host"], # type: ignore
-                port=config["server"]["port"], reload=config["server"]["reload"],
-                log_level="info" if config["debug"] else "warning")
+    if config["app_processes"] > 1:
+        from utils.app_processes import run_app_processes
+        run_app_processes("app:app", config["server"]["host"], config["server"]["port"], config["app_processes"],
+                          "info" if config["debug"] else "warning")
+    else:
+        import uvicorn
+        uvicorn.run("app:app", host=config["server"]["host"], # type: ignore
+                    port=config["server"]["port"], reload=config["server"]["reload"],
+                    log_level="info" if config["debug"] else "warning")
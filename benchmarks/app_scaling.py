@@ -0,0 +1,220 @@
+"""
+Benchmark of cached getThumbnail requests as the number of app processes grows.
+
+Builds a synthetic cache folder, starts a redis server and then, for each process count,
+app.py with app_processes set to it. Requests for cached thumbnails are sent over HTTP by
+several client processes for a fixed time, and the requests per second, latencies, hot
+cache hit ratio and the memory of the app processes are recorded.
+
+    python -m benchmarks.app_scaling --processes 1 2 4 --output app_scaling.json
+
+The clients run on the same machine, so they take cores from the app. Leave some cores
+free for them with --clients, or the app stops scaling before it runs out of cores.
+"""
+
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Any
+
+import httpx
+from redis import Redis
+
+from benchmarks.common import summarize_latencies, write_results, zipf_sample
+from benchmarks.load_harness import free_port, local_host, start_process, wait_for, write_config
+from benchmarks.read_path import populate_cache
+
+def build_config(args: argparse.Namespace, folder: str, redis_port: int, app_port: int, processes: int) -> dict[str, Any]:
+    return {
+        "server": {
+            "host": local_host,
+            "port": app_port,
+            "reload": False,
+            "worker_health_check_port": 0,
+        },
+        "thumbnail_storage": {
+            "path": os.path.join(folder, "cache"),
+            "max_size": 50_000_000_000,
+            "cleanup_multiplier": 0.9,
+            "redis_offset_allowed": 20,
+            "max_before_async_generation": 15,
+            "max_queue_size": 10000,
+        },
+        "redis": {"host": local_host, "port": redis_port},
+        "yt_auth": {"visitorData": ""},
+        "default_max_height": 720,
+        "status_auth_password": "benchmark",
+        "skip_local_ffmpeg": False,
+        "try_floatie": True,
+        "try_floatie_for_live": True,
+        "try_ytdlp": False,
+        "max_concurrent_renders": 100,
+        "max_concurrent_ytdlp": 100,
+        "app_processes": processes,
+        "hot_cache_size": args.hot_cache_size,
+        "debug": False,
+    }
+
+def run_client(base_url: str, requests: list[tuple[str, float]], duration: float | None, concurrency: int) -> tuple[list[float], int]:
+    """
+    Sends requests for the given duration from one client process, or each request once without one.
+    Returns the latencies and the number of errors.
+    """
+    async def run() -> tuple[list[float], int]:
+        latencies: list[float] = []
+        errors = 0
+        deadline = time.perf_counter() + duration if duration is not None else math.inf
+
+        async with httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=concurrency)) as client:
+            async def send(offset: int) -> None:
+                nonlocal errors
+                index = offset
+                while time.perf_counter() < deadline and (duration is not None or index < len(requests)):
+                    video_id, thumbnail_time = requests[index % len(requests)]
+                    index += concurrency
+                    start_time = time.perf_counter()
+                    try:
+                        response = await client.get("/api/v1/getThumbnail", params={"videoID": video_id, "time": thumbnail_time})
+                        if response.status_code != 200:
+                            errors += 1
+                            continue
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - start_time)
+
+            await asyncio.gather(*[send(offset) for offset in range(concurrency)])
+
+        return latencies, errors
+
+    return asyncio.run(run())
+
+def get_process_memory(pid: int) -> dict[str, int]:
+    """
+    Resident and proportional set sizes in bytes of a process and its children. Shared
+    memory is split between the processes using it in the proportional size.
+    """
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids += [int(child) for child in file.read().split()]
+    except FileNotFoundError:
+        pass
+
+    memory = {"rss": 0, "pss": 0}
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/smaps_rollup") as file:
+                for line in file:
+                    name, value = line.split(":", 1)
+                    if name in ("Rss", "Pss"):
+                        memory[name.lower()] += int(value.split()[0]) * 1024
+        except FileNotFoundError:
+            pass
+
+    return memory
+
+def get_hot_cache_stats(base_url: str) -> dict[str, float]:
+    stats: dict[str, float] = {}
+    for line in httpx.get(f"{base_url}/metrics").text.splitlines():
+        if line.startswith("dearrow_hot_cache_"):
+            name, value = line.split(" ")
+            stats[name.removeprefix("dearrow_hot_cache_")] = float(value)
+
+    return stats
+
+def run_processes(args: argparse.Namespace, folder: str, redis_port: int, processes: int,
+                  requests: list[tuple[str, float]]) -> dict[str, Any]:
+    app_port = free_port()
+    app = start_process("app.py", write_config(folder, f"app-{processes}", build_config(args, folder, redis_port, app_port, processes)),
+                        os.path.join(folder, f"app-{processes}.log"), None)
+    base_url = f"http://{local_host}:{app_port}"
+
+    try:
+        wait_for(lambda: httpx.get(f"{base_url}/api/v1/status").status_code == 200, "app")
+        # Loads every thumbnail into the hot cache
+        run_client(base_url, list(dict.fromkeys(requests)), None, args.concurrency)
+        before = get_hot_cache_stats(base_url)
+
+        with multiprocessing.get_context("fork").Pool(args.clients) as pool:
+            client_results = pool.starmap(run_client, [(base_url, requests[index::args.clients], args.duration, args.concurrency)
+                                                       for index in range(args.clients)])
+
+        after = get_hot_cache_stats(base_url)
+        hits = after.get("hits_total", 0) - before.get("hits_total", 0)
+        misses = after.get("misses_total", 0) - before.get("misses_total", 0)
+
+        return {
+            "requests": vars(summarize_latencies([latency for latencies, _ in client_results for latency in latencies], args.duration)),
+            "errors": sum(errors for _, errors in client_results),
+            "hot_cache_hit_ratio": hits / (hits + misses) if hits + misses > 0 else None,
+            "hot_cache_bytes": after.get("bytes"),
+            "memory": get_process_memory(app.pid),
+        }
+    finally:
+        app.terminate()
+        try:
+            app.wait(15)
+        except subprocess.TimeoutExpired:
+            app.kill()
+
+def run_benchmark(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    folder = tempfile.mkdtemp(prefix="dearrow-scaling-")
+    redis_process: subprocess.Popen[bytes] | None = None
+
+    try:
+        thumbnails = populate_cache(os.path.join(folder, "cache"), args.videos, args.timestamps, args.title_ratio, rng)
+        requests = [(thumbnail.video_id, thumbnail.time) for thumbnail in zipf_sample(thumbnails, args.zipf, args.requests, rng)]
+
+        redis_port = args.redis_port
+        if redis_port is None:
+            redis_server = shutil.which("redis-server")
+            if redis_server is None:
+                raise RuntimeError("redis-server not found, pass --redis-port to use an existing server")
+            redis_port = free_port()
+            redis_process = subprocess.Popen([redis_server, "--port", str(redis_port), "--bind", local_host,
+                                              "--save", "", "--appendonly", "no"], stdout=subprocess.DEVNULL)
+        wait_for(Redis(host=local_host, port=redis_port).ping, "redis")
+
+        results = {str(processes): run_processes(args, folder, redis_port, processes, requests) for processes in args.processes}
+        write_results("app_scaling", vars(args), {
+            "processes": results,
+            "cpu_count": os.cpu_count(),
+            "logs": folder if args.keep else None,
+        }, args.output)
+    finally:
+        if redis_process is not None:
+            redis_process.terminate()
+            redis_process.wait()
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark cached getThumbnail requests with a growing number of app processes")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], help="App process counts to measure")
+    parser.add_argument("--clients", type=int, default=4, help="Client processes sending requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once per client process")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to send requests for at each process count")
+    parser.add_argument("--videos", type=int, default=1000, help="Number of synthetic videos in the cache")
+    parser.add_argument("--timestamps", type=int, default=3, help="Maximum number of thumbnails per video")
+    parser.add_argument("--title-ratio", type=float, default=0.5, help="Fraction of thumbnails with a title")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of distinct requests the clients cycle through")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the request distribution")
+    parser.add_argument("--hot-cache-size", type=int, default=64 * 1024 * 1024, help="hot_cache_size of the app, 0 to disable")
+    parser.add_argument("--redis-port", type=int, help="Use an existing redis server on localhost instead of starting one")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder with logs and the cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+
+    run_benchmark(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
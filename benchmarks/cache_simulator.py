@@ -0,0 +1,276 @@
+"""
+Replays an access trace recorded with access_trace_path against cache policies.
+
+The current behaviour is lru-video: storage is checked after every render and,
+once it is above max_size, whole videos are deleted in order of last use
+until it is below max_size * cleanup_multiplier.
+
+    python -m benchmarks.cache_simulator trace.csv --capacities 10G 20G 50G --multipliers 0.8 0.9
+"""
+
+import argparse
+from dataclasses import dataclass, field
+import math
+import re
+from typing import Iterable, Iterator
+
+from benchmarks.common import write_results
+
+@dataclass
+class Access:
+    timestamp: float
+    video_id: str
+    time: float | None
+    hit: bool
+    size: int
+
+@dataclass
+class Unit:
+    """
+    What gets evicted as a whole: a video folder or a single thumbnail
+    """
+    size: int = 0
+    thumbnails: set[float] = field(default_factory=set)
+    inserted: float = 0
+    last_used: float = 0
+    uses: int = 0
+    priority: float = 0
+
+@dataclass
+class SimulationResult:
+    policy: str
+    max_size: int
+    cleanup_multiplier: float
+    requests: int = 0
+    hits: int = 0
+    requested_bytes: float = 0
+    hit_bytes: float = 0
+    explicit_requests: int = 0
+    explicit_hits: int = 0
+    renders: int = 0
+    cleanups: int = 0
+    evicted_units: int = 0
+
+    def summary(self) -> dict[str, float | int | str]:
+        return {
+            "policy": self.policy,
+            "max_size": self.max_size,
+            "cleanup_multiplier": self.cleanup_multiplier,
+            "requests": self.requests,
+            "hits": self.hits,
+            "hit_ratio": self.hits / self.requests if self.requests > 0 else 0,
+            "byte_hit_ratio": self.hit_bytes / self.requested_bytes if self.requested_bytes > 0 else 0,
+            "renders": self.renders,
+            # Every request with a time would need a render without the cache
+            "renders_saved": self.explicit_hits,
+            "renders_saved_ratio": self.explicit_hits / self.explicit_requests if self.explicit_requests > 0 else 0,
+            "cleanups": self.cleanups,
+            "evicted_units": self.evicted_units,
+        }
+
+def normalize_time(time: float) -> float:
+    # get_thumbnail_from_files matches files by the millisecond truncated time
+    return math.floor(time * 1000) / 1000
+
+class SimulatedCache:
+    per_video = True
+
+    def __init__(self, name: str, max_size: int, cleanup_multiplier: float):
+        self.max_size = max_size
+        self.target_size = int(max_size * cleanup_multiplier)
+        self.used = 0
+        self.units: dict[str, Unit] = {}
+        self.video_units: dict[str, set[str]] = {}
+        self.result = SimulationResult(name, max_size, cleanup_multiplier)
+
+    def unit_key(self, video_id: str, time: float) -> str:
+        return video_id if self.per_video else f"{video_id} {time}"
+
+    def eviction_priority(self, unit: Unit) -> tuple[float, ...]:
+        return (unit.last_used,)
+
+    def touch(self, unit: Unit, now: float) -> None:
+        unit.last_used = now
+        unit.uses += 1
+
+    def find(self, video_id: str, time: float | None) -> Unit | None:
+        keys = self.video_units.get(video_id)
+        if not keys:
+            return None
+
+        if time is None:
+            # Any thumbnail of the video can be served for requests without a time
+            return self.units[next(iter(keys))]
+
+        unit = self.units.get(self.unit_key(video_id, time))
+        return unit if unit is not None and time in unit.thumbnails else None
+
+    def access(self, access: Access, size: float) -> None:
+        result = self.result
+        time = normalize_time(access.time) if access.time is not None else None
+        unit = self.find(access.video_id, time)
+
+        result.requests += 1
+        result.requested_bytes += size
+        if time is not None:
+            result.explicit_requests += 1
+
+        if unit is not None:
+            result.hits += 1
+            result.hit_bytes += size
+            if time is not None:
+                result.explicit_hits += 1
+            self.touch(unit, access.timestamp)
+        elif time is not None:
+            self.insert(access.video_id, time, int(size), access.timestamp)
+
+    def insert(self, video_id: str, time: float, size: int, now: float) -> None:
+        key = self.unit_key(video_id, time)
+        unit = self.units.get(key)
+        if unit is None:
+            unit = Unit(inserted=now)
+            self.units[key] = unit
+            self.video_units.setdefault(video_id, set()).add(key)
+
+        unit.thumbnails.add(time)
+        unit.size += size
+        self.used += size
+        self.touch(unit, now)
+        self.result.renders += 1
+
+        if self.used > self.max_size:
+            self.cleanup()
+
+    def cleanup(self) -> None:
+        self.result.cleanups += 1
+        for key in sorted(self.units, key=lambda key: self.eviction_priority(self.units[key])):
+            if self.used <= self.target_size:
+                break
+            self.evict(key)
+
+    def evict(self, key: str) -> None:
+        unit = self.units.pop(key)
+        self.used -= unit.size
+        self.result.evicted_units += 1
+
+        video_id = key.split(" ")[0]
+        video_keys = self.video_units[video_id]
+        video_keys.discard(key)
+        if len(video_keys) == 0:
+            del self.video_units[video_id]
+
+class LruThumbnailCache(SimulatedCache):
+    per_video = False
+
+class LfuVideoCache(SimulatedCache):
+    def eviction_priority(self, unit: Unit) -> tuple[float, ...]:
+        return (unit.uses, unit.last_used)
+
+class FifoVideoCache(SimulatedCache):
+    def eviction_priority(self, unit: Unit) -> tuple[float, ...]:
+        return (unit.inserted,)
+
+class GdsfThumbnailCache(SimulatedCache):
+    """
+    GreedyDual-Size-Frequency: small, frequently used thumbnails are kept longest
+    """
+    per_video = False
+
+    def __init__(self, name: str, max_size: int, cleanup_multiplier: float):
+        super().__init__(name, max_size, cleanup_multiplier)
+        self.inflation = 0.0
+
+    def eviction_priority(self, unit: Unit) -> tuple[float, ...]:
+        return (unit.priority,)
+
+    def touch(self, unit: Unit, now: float) -> None:
+        super().touch(unit, now)
+        unit.priority = self.inflation + unit.uses / max(1, unit.size)
+
+    def evict(self, key: str) -> None:
+        self.inflation = max(self.inflation, self.units[key].priority)
+        super().evict(key)
+
+policies: dict[str, type[SimulatedCache]] = {
+    "lru-video": SimulatedCache,
+    "lru-thumbnail": LruThumbnailCache,
+    "lfu-video": LfuVideoCache,
+    "fifo-video": FifoVideoCache,
+    "gdsf-thumbnail": GdsfThumbnailCache,
+}
+
+def parse_trace(lines: Iterable[str]) -> Iterator[Access]:
+    for line in lines:
+        parts = line.strip().split(",")
+        if len(parts) != 5:
+            continue
+
+        timestamp, video_id, time, hit, size = parts
+        yield Access(float(timestamp), video_id, float(time) if time != "" else None, hit == "1", int(size))
+
+def estimate_sizes(accesses: list[Access]) -> tuple[dict[tuple[str, float | None], int], float]:
+    """
+    Misses are recorded with zero bytes, so use the size seen on a hit for the
+    same thumbnail, or the mean size of all hits when it was never hit
+    """
+    sizes: dict[tuple[str, float | None], int] = {}
+    for access in accesses:
+        if access.hit and access.size > 0:
+            sizes[(access.video_id, normalize_time(access.time) if access.time is not None else None)] = access.size
+
+    mean_size = sum(sizes.values()) / len(sizes) if len(sizes) > 0 else 0
+    return sizes, mean_size
+
+def simulate(accesses: list[Access], policy: str, max_size: int, cleanup_multiplier: float) -> SimulationResult:
+    sizes, mean_size = estimate_sizes(accesses)
+    cache = policies[policy](policy, max_size, cleanup_multiplier)
+    for access in accesses:
+        key = (access.video_id, normalize_time(access.time) if access.time is not None else None)
+        cache.access(access, access.size if access.size > 0 else sizes.get(key, mean_size))
+
+    return cache.result
+
+def parse_size(text: str) -> int:
+    match = re.match(r"^(\d+(?:\.\d+)?)([KMGT]?)B?$", text.upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+
+    multiplier = 1000 ** "_KMGT".index(match.group(2) or "_")
+    return int(float(match.group(1)) * multiplier)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay an access trace against different cache policies and sizes")
+    parser.add_argument("traces", nargs="+", help="Trace files recorded by the app, merged by timestamp")
+    parser.add_argument("--capacities", nargs="+", type=parse_size, required=True, help="max_size values to try, e.g. 50G")
+    parser.add_argument("--multipliers", nargs="+", type=float, default=[0.9], help="cleanup_multiplier values to try")
+    parser.add_argument("--policies", nargs="+", choices=list(policies), default=list(policies))
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    accesses: list[Access] = []
+    for trace in args.traces:
+        with open(trace) as file:
+            accesses.extend(parse_trace(file))
+    accesses.sort(key=lambda access: access.timestamp)
+
+    observed_hits = sum(1 for access in accesses if access.hit)
+    results = [simulate(accesses, policy, capacity, multiplier).summary()
+                for policy in args.policies for capacity in args.capacities for multiplier in args.multipliers]
+
+    write_results("cache_simulator", {
+        "traces": args.traces,
+        "capacities": args.capacities,
+        "multipliers": args.multipliers,
+        "policies": args.policies,
+    }, {
+        "trace": {
+            "requests": len(accesses),
+            "observed_hit_ratio": observed_hits / len(accesses) if len(accesses) > 0 else 0,
+            "unique_thumbnails": len(set((access.video_id, access.time) for access in accesses if access.time is not None)),
+            "unique_videos": len(set(access.video_id for access in accesses)),
+        },
+        "simulations": results,
+    }, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Sequence
+
+# Must be set before anything imports utils.config
+os.environ.setdefault("CONFIG_PATH", os.path.join(os.path.dirname(__file__), "benchmark_config.yaml"))
+
+@dataclass
+class LatencySummary:
+    count: int
+    total_time: float
+    throughput: float
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+    max: float
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0
+
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize_latencies(latencies: Sequence[float], total_time: float) -> LatencySummary:
+    sorted_values = sorted(latencies)
+    count = len(sorted_values)
+
+    return LatencySummary(
+        count=count,
+        total_time=total_time,
+        throughput=count / total_time if total_time > 0 else 0,
+        mean=sum(sorted_values) / count if count > 0 else 0,
+        p50=percentile(sorted_values, 0.5),
+        p90=percentile(sorted_values, 0.9),
+        p99=percentile(sorted_values, 0.99),
+        max=sorted_values[-1] if count > 0 else 0,
+    )
+
+def zipf_weights(count: int, exponent: float) -> list[float]:
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+def zipf_sample(population: Sequence[Any], exponent: float, count: int, rng: random.Random) -> list[Any]:
+    return rng.choices(population, weights=zipf_weights(len(population), exponent), k=count)
+
+def random_video_id(rng: random.Random) -> str:
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+    return "".join(rng.choice(alphabet) for _ in range(11))
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def write_results(name: str, parameters: dict[str, Any], results: dict[str, Any], output: str | None) -> None:
+    """
+    Results are written as JSON so that runs against different versions can be diffed
+    """
+    data = {
+        "benchmark": name,
+        "timestamp": time.time(),
+        "git_commit": git_commit(),
+        "python": sys.version.split(" ")[0],
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": {key: asdict(value) if isinstance(value, LatencySummary) else value
+                        for key, value in results.items()},
+    }
+
+    text = json.dumps(data, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w") as file:
+            file.write(text)
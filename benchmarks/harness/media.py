@@ -0,0 +1,86 @@
+"""
+Synthetic streams and the ffmpeg stand-in used by the load harness
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+
+from benchmarks.harness.servers import StreamFile
+
+# (file name, mime type, width, height, fps, encoder arguments)
+# Laid out like YouTube's adaptive streams, with the index in front of the media
+stream_specs: list[tuple[str, str, int, int, int, list[str]]] = [
+    ("dash-720.mp4", 'video/mp4; codecs="avc1.64001f"', 1280, 720, 30,
+        ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof+global_sidx+dash"]),
+    ("dash-360.webm", 'video/webm; codecs="vp9"', 640, 360, 30,
+        ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-dash", "1", "-cues_to_front", "1"]),
+]
+
+fake_ffmpeg_script = """#!{python}
+import os
+import sys
+import time
+
+time.sleep(float(os.environ.get("FAKE_FFMPEG_DELAY", "0.5")))
+
+with open({image_path!r}, "rb") as file:
+    image = file.read()
+
+args = sys.argv[1:]
+outputs = [arg for arg in args if arg.endswith(".webp")]
+if len(outputs) > 0:
+    with open(outputs[0], "wb") as file:
+        file.write(image)
+elif "pipe:1" in args or "-" in args:
+    sys.stdout.buffer.write(image)
+else:
+    sys.exit(1)
+"""
+
+def create_streams(folder: str, duration: int) -> dict[str, StreamFile]:
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        raise RuntimeError("ffmpeg is needed to create the synthetic streams")
+
+    os.makedirs(folder, exist_ok=True)
+    streams: dict[str, StreamFile] = {}
+    for name, mime_type, width, height, fps, encoder_args in stream_specs:
+        path = os.path.join(folder, f"{duration}s-{name}")
+        if not os.path.exists(path):
+            print(f"Creating synthetic stream {path}")
+            subprocess.run([
+                ffmpeg_path, "-y", "-v", "error",
+                "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+                "-t", str(duration), "-g", str(fps * 2),
+                *encoder_args, path,
+            ], check=True)
+
+        streams[name] = StreamFile(path, mime_type, width, height, fps)
+
+    return streams
+
+def create_fake_ffmpeg(folder: str, sample_stream: StreamFile) -> str:
+    """
+    Writes an ffmpeg stand-in that sleeps and then outputs a pre-rendered frame.
+
+    Returns the folder to put at the front of PATH.
+    """
+    bin_folder = os.path.join(folder, "fake-ffmpeg")
+    os.makedirs(bin_folder, exist_ok=True)
+
+    image_path = os.path.join(bin_folder, "frame.webp")
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        raise RuntimeError("ffmpeg is needed to render the sample frame")
+    subprocess.run([ffmpeg_path, "-y", "-v", "error", "-i", sample_stream.path, "-vframes", "1", image_path], check=True)
+
+    script_path = os.path.join(bin_folder, "ffmpeg")
+    with open(script_path, "w") as file:
+        file.write(fake_ffmpeg_script.format(python=sys.executable, image_path=image_path))
+    os.chmod(script_path, os.stat(script_path).st_mode | stat.S_IEXEC)
+
+    return bin_folder
@@ -0,0 +1,292 @@
+"""
+Local stand-ins for YouTube, googlevideo and proxies used by the load harness
+"""
+
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import select
+import socket
+import sys
+import threading
+import time
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+import zlib
+
+@dataclass
+class StreamFile:
+    path: str
+    mime_type: str
+    width: int
+    height: int
+    fps: int
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which stalls on delayed ACKs when connections are kept alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str, headers: dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients hanging up early is normal here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start_server(server: ThreadingHTTPServer) -> threading.Thread:
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+class MediaServer(QuietServer):
+    """
+    Serves synthetic streams with byte range support, like googlevideo does
+    """
+
+    def __init__(self, address: tuple[str, int], streams: dict[str, StreamFile]):
+        super().__init__(address, MediaHandler)
+        self.streams = streams
+        self.bytes_sent = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+class MediaHandler(QuietHandler):
+    server: MediaServer
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        name = os.path.basename(urlsplit(self.path).path)
+        stream = self.server.streams.get(name)
+        if stream is None:
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        size = os.path.getsize(stream.path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        range_match = re.match(r"bytes=(\d*)-(\d*)", range_header or "")
+        if range_match is not None:
+            if range_match.group(1):
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(size - 1, int(range_match.group(2)))
+            elif range_match.group(2):
+                start = max(0, size - int(range_match.group(2)))
+
+            if start >= size:
+                self.send_body(416, b"", stream.mime_type, {"Content-Range": f"bytes */{size}"})
+                return
+
+        headers = {"Accept-Ranges": "bytes", "Content-Length": str(end - start + 1)}
+        if range_match is not None:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        self.send_response(206 if range_match is not None else 200)
+        self.send_header("Content-Type", stream.mime_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        with self.server.lock:
+            self.server.requests += 1
+        if self.command == "HEAD":
+            return
+
+        # ffmpeg drops the connection once it has what it needs, so only count what was sent
+        remaining = end - start + 1
+        with open(stream.path, "rb") as file:
+            file.seek(start)
+            while remaining > 0:
+                chunk = file.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except ConnectionError:
+                    self.close_connection = True
+                    break
+                remaining -= len(chunk)
+                with self.server.lock:
+                    self.server.bytes_sent += len(chunk)
+
+class YoutubeStub(QuietServer):
+    """
+    Answers the watch page and innertube player requests made by utils/floatie.py.
+
+    A deterministic fraction of video IDs is reported as unplayable or login
+    required so that failure paths get exercised too.
+    """
+
+    def __init__(self, address: tuple[str, int], media_base_url: str, streams: dict[str, StreamFile],
+                 latency: float, unplayable_ratio: float, login_required_ratio: float):
+        super().__init__(address, YoutubeHandler)
+        self.media_base_url = media_base_url
+        self.streams = streams
+        self.latency = latency
+        self.unplayable_ratio = unplayable_ratio
+        self.login_required_ratio = login_required_ratio
+        self.watch_requests = 0
+        self.player_requests = 0
+        self.lock = threading.Lock()
+
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def playability_status(self, video_id: str) -> str:
+        bucket = (zlib.crc32(video_id.encode()) % 10000) / 10000
+        if bucket < self.unplayable_ratio:
+            return "UNPLAYABLE"
+        elif bucket < self.unplayable_ratio + self.login_required_ratio:
+            return "LOGIN_REQUIRED"
+        else:
+            return "OK"
+
+    def player_response(self, video_id: str) -> dict[str, Any]:
+        status = self.playability_status(video_id)
+        response: dict[str, Any] = {
+            "playabilityStatus": {"status": status, "reason": "Synthetic failure" if status != "OK" else None},
+            "videoDetails": {"videoId": video_id, "lengthSeconds": "60"},
+        }
+
+        if status == "OK":
+            response["streamingData"] = {
+                "adaptiveFormats": [{
+                    "url": f"{self.media_base_url}/{name}?v={video_id}",
+                    "mimeType": stream.mime_type,
+                    "width": stream.width,
+                    "height": stream.height,
+                    "fps": stream.fps,
+                    "contentLength": str(os.path.getsize(stream.path)),
+                } for name, stream in sorted(self.streams.items(), key=lambda item: -item[1].height)]
+            }
+
+        return response
+
+class YoutubeHandler(QuietHandler):
+    server: YoutubeStub
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/watch":
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.watch_requests += 1
+
+        video_id = parse_qs(url.query).get("v", [""])[0]
+        # The real page is several hundred kilobytes, only the visitor data matters
+        page = f'<html><script>ytcfg.set({{"VISITOR_DATA":"stub-{video_id}"}});</script>{" " * 400_000}</html>'
+        self.send_body(200, page.encode(), "text/html")
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if url.path != "/youtubei/v1/player":
+            self.send_body(404, b"Not found", "text/plain")
+            return
+
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.player_requests += 1
+
+        video_id = json.loads(body)["videoId"]
+        self.send_body(200, json.dumps(self.server.player_response(video_id)).encode(), "application/json")
+
+class ForwardProxy(QuietServer):
+    """
+    Minimal forwarding proxy supporting absolute-form requests and CONNECT tunnels
+    """
+
+    def __init__(self, address: tuple[str, int]):
+        super().__init__(address, ForwardProxyHandler)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/"
+
+class ForwardProxyHandler(QuietHandler):
+    server: ForwardProxy
+    # Upstream responses are relayed as they are, so close after each one
+    protocol_version = "HTTP/1.0"
+
+    def do_CONNECT(self) -> None:
+        host, _, port = self.path.partition(":")
+        with self.server.lock:
+            self.server.requests += 1
+
+        upstream = socket.create_connection((host, int(port or 443)), timeout=30)
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.tunnel(self.connection, upstream)
+
+    def tunnel(self, client: socket.socket, upstream: socket.socket) -> None:
+        sockets = [client, upstream]
+        try:
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 30)
+                if errored or not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is client else client).sendall(data)
+        finally:
+            upstream.close()
+
+    def forward(self) -> None:
+        url = urlsplit(self.path)
+        if url.hostname is None:
+            self.send_body(400, b"Absolute URL required", "text/plain")
+            return
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        upstream = socket.create_connection((url.hostname, url.port or 80), timeout=30)
+        try:
+            path = url.path + (f"?{url.query}" if url.query else "")
+            headers = "".join(f"{name}: {value}\r\n" for name, value in self.headers.items()
+                                if name.lower() not in ("proxy-connection", "connection", "keep-alive"))
+            upstream.sendall(f"{self.command} {path or '/'} HTTP/1.0\r\n{headers}Connection: close\r\n\r\n".encode() + body)
+
+            while True:
+                data = upstream.recv(65536)
+                if not data:
+                    break
+                self.wfile.write(data)
+        finally:
+            upstream.close()
+
+    def do_GET(self) -> None:
+        self.forward()
+
+    def do_POST(self) -> None:
+        self.forward()
+
+    def do_HEAD(self) -> None:
+        self.forward()
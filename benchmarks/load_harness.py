@@ -0,0 +1,302 @@
+"""
+End-to-end load harness for the thumbnail miss path, running entirely locally.
+
+Starts a stub YouTube server for floatie, a range-capable media server with
+synthetic streams, optionally a forwarding proxy, a redis server, the app and
+a number of workers. A Zipf-distributed mix of getThumbnail requests is then
+replayed against the app while queue depth is sampled.
+
+    python -m benchmarks.load_harness --workers 4 --requests 2000 --output harness.json
+
+Pass --fake-ffmpeg to swap ffmpeg for a stand-in that sleeps and outputs a
+pre-rendered frame, to measure the pipeline without decode cost.
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import httpx
+from redis import Redis
+from rq.worker import Worker
+import yaml
+
+from benchmarks.common import random_video_id, summarize_latencies, write_results, zipf_sample
+from benchmarks.harness.media import create_fake_ffmpeg, create_streams
+from benchmarks.harness.servers import ForwardProxy, MediaServer, YoutubeStub, start_server
+from utils.priority_queue import PriorityQueue
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+local_host = "127.0.0.1"
+
+@dataclass
+class RequestResult:
+    latency: float
+    status: int
+    outcome: str
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((local_host, 0))
+        return sock.getsockname()[1]
+
+def wait_for(check: Any, description: str, timeout: float = 30) -> None:
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+
+    raise TimeoutError(f"Timed out waiting for {description}")
+
+def build_config(args: argparse.Namespace, folder: str, redis_port: int, youtube_url: str, proxy_url: str | None) -> dict[str, Any]:
+    return {
+        "server": {
+            "host": local_host,
+            "port": args.app_port,
+            "reload": False,
+            "worker_health_check_port": 0,
+        },
+        "thumbnail_storage": {
+            "path": os.path.join(folder, "cache"),
+            "max_size": args.max_size,
+            "cleanup_multiplier": 0.9,
+            "redis_offset_allowed": 20,
+            "max_before_async_generation": args.max_before_async_generation,
+            "max_queue_size": 100000,
+        },
+        "redis": {"host": local_host, "port": redis_port},
+        "yt_auth": {"visitorData": ""},
+        "default_max_height": 720,
+        "status_auth_password": "harness",
+        "skip_local_ffmpeg": False,
+        "try_floatie": True,
+        "try_floatie_for_live": True,
+        "try_ytdlp": False,
+        "max_concurrent_renders": 1000,
+        "range_rendering": not args.full_seek,
+        "max_concurrent_ytdlp": 1000,
+        "worker_concurrency": args.worker_concurrency,
+        "proxy_urls": [{"url": proxy_url, "status_url": None, "country_code": "LOCAL"}] if proxy_url is not None else None,
+        "youtube_url": youtube_url,
+        "debug": False,
+    }
+
+def write_config(folder: str, name: str, config: dict[str, Any]) -> str:
+    path = os.path.join(folder, f"{name}.yaml")
+    with open(path, "w") as file:
+        yaml.safe_dump(config, file)
+    return path
+
+def start_process(script: str, config_path: str, log_path: str, extra_path: str | None,
+                  arguments: list[str] = []) -> subprocess.Popen[bytes]:
+    env = dict(os.environ, CONFIG_PATH=config_path, PYTHONUNBUFFERED="1")
+    if extra_path is not None:
+        env["PATH"] = extra_path + os.pathsep + env["PATH"]
+
+    return subprocess.Popen([sys.executable, script, *arguments], cwd=repo_folder, env=env,
+                            stdout=open(log_path, "wb"), stderr=subprocess.STDOUT)
+
+async def sample_queues(redis_conn: Redis, start_time: float, samples: list[dict[str, Any]], stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        queues = PriorityQueue.all(connection=redis_conn)
+        samples.append({
+            "time": round(time.time() - start_time, 3),
+            "queues": {queue.name: queue.count for queue in queues},
+            "started": {queue.name: queue.started_job_registry.count for queue in queues},
+        })
+
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_load(args: argparse.Namespace, base_url: str, catalogue: list[tuple[str, float]],
+                   rng: random.Random) -> tuple[list[RequestResult], float]:
+    requests = zipf_sample(catalogue, args.zipf, args.requests, rng)
+    generate_now = [rng.random() < args.generate_now_ratio for _ in requests]
+    results: list[RequestResult] = []
+    next_request = 0
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async def run_client() -> None:
+            nonlocal next_request
+            while next_request < len(requests):
+                index = next_request
+                next_request += 1
+
+                video_id, thumbnail_time = requests[index]
+                start_time = time.perf_counter()
+                try:
+                    response = await client.get("/api/v1/getThumbnail", params={
+                        "videoID": video_id,
+                        "time": thumbnail_time,
+                        "generateNow": generate_now[index],
+                    })
+                    outcome = "ok" if response.status_code == 200 else response.headers.get("X-Failure-Reason", str(response.status_code))
+                    results.append(RequestResult(time.perf_counter() - start_time, response.status_code, outcome))
+                except httpx.HTTPError as e:
+                    results.append(RequestResult(time.perf_counter() - start_time, 0, type(e).__name__))
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*[run_client() for _ in range(args.concurrency)])
+
+    return results, time.perf_counter() - start_time
+
+async def run_harness(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    folder = tempfile.mkdtemp(prefix="dearrow-harness-")
+    processes: list[subprocess.Popen[bytes]] = []
+    servers: list[Any] = []
+
+    try:
+        streams = create_streams(args.media_folder, args.stream_duration)
+        fake_ffmpeg_path = create_fake_ffmpeg(folder, next(iter(streams.values()))) if args.fake_ffmpeg is not None else None
+        if args.fake_ffmpeg is not None:
+            os.environ["FAKE_FFMPEG_DELAY"] = str(args.fake_ffmpeg)
+
+        media_server = MediaServer((local_host, 0), streams)
+        youtube_stub = YoutubeStub((local_host, 0), media_server.base_url(), streams,
+                                   args.youtube_latency, args.unplayable_ratio, args.login_required_ratio)
+        proxy = ForwardProxy((local_host, 0)) if args.proxy else None
+        servers = [server for server in (media_server, youtube_stub, proxy) if server is not None]
+        for server in servers:
+            start_server(server)
+
+        redis_port = args.redis_port
+        if redis_port is None:
+            redis_server = shutil.which("redis-server")
+            if redis_server is None:
+                raise RuntimeError("redis-server not found, pass --redis-port to use an existing server")
+            redis_port = free_port()
+            processes.append(subprocess.Popen([redis_server, "--port", str(redis_port), "--bind", local_host,
+                                               "--save", "", "--appendonly", "no"], stdout=subprocess.DEVNULL))
+        redis_conn = Redis(host=local_host, port=redis_port)
+        wait_for(redis_conn.ping, "redis")
+        if args.redis_port is None or args.flush:
+            redis_conn.flushdb()
+
+        if args.app_port is None:
+            args.app_port = free_port()
+        config = build_config(args, folder, redis_port, youtube_stub.base_url(), proxy.url() if proxy is not None else None)
+        processes.append(start_process("app.py", write_config(folder, "app", config),
+                                       os.path.join(folder, "app.log"), None))
+        # With separate render workers, the other workers only resolve
+        worker_stages = ["resolve" if args.render_workers > 0 else "all"] * args.workers + ["render"] * args.render_workers
+        for index, stage in enumerate(worker_stages):
+            config["server"]["worker_health_check_port"] = free_port()
+            processes.append(start_process("worker.py", write_config(folder, f"worker-{index}", config),
+                                           os.path.join(folder, f"worker-{index}.log"), fake_ffmpeg_path, ["--stage", stage]))
+
+        base_url = f"http://{local_host}:{args.app_port}"
+        wait_for(lambda: httpx.get(f"{base_url}/api/v1/status").status_code == 200, "app")
+        wait_for(lambda: len(Worker.all(connection=redis_conn)) >= len(worker_stages) * args.worker_concurrency, "workers")
+
+        catalogue = [(random_video_id(rng), round(rng.uniform(0, args.stream_duration - 1), 3))
+                     for _ in range(args.videos) for _ in range(args.times_per_video)]
+
+        start_time = time.time()
+        queue_samples: list[dict[str, Any]] = []
+        stop_sampling = asyncio.Event()
+        sampler = asyncio.create_task(sample_queues(redis_conn, start_time, queue_samples, stop_sampling))
+
+        results, load_time = await run_load(args, base_url, catalogue, rng)
+        if args.drain:
+            while any(queue.count > 0 or queue.started_job_registry.count > 0 for queue in PriorityQueue.all(connection=redis_conn)):
+                await asyncio.sleep(0.5)
+
+        stop_sampling.set()
+        await sampler
+        wall_time = time.time() - start_time
+
+        workers = Worker.all(connection=redis_conn)
+        outcomes: dict[str, Any] = {}
+        for outcome in sorted(set(result.outcome for result in results)):
+            latencies = [result.latency for result in results if result.outcome == outcome]
+            outcomes[outcome] = summarize_latencies(latencies, load_time)
+
+        write_results("load_harness", {key: value for key, value in vars(args).items()}, {
+            "requests": summarize_latencies([result.latency for result in results], load_time),
+            "outcomes": {outcome: vars(summary) for outcome, summary in outcomes.items()},
+            "wall_time": wall_time,
+            "workers": [{
+                "name": worker.name,
+                "successful_jobs": worker.successful_job_count,
+                "failed_jobs": worker.failed_job_count,
+                "working_time": worker.total_working_time,
+                "renders_per_second": worker.successful_job_count / wall_time,
+            } for worker in workers],
+            "renders_per_second": sum(worker.successful_job_count for worker in workers) / wall_time,
+            "queue_depth": queue_samples,
+            "stubs": {
+                "watch_requests": youtube_stub.watch_requests,
+                "player_requests": youtube_stub.player_requests,
+                "media_requests": media_server.requests,
+                "media_bytes": media_server.bytes_sent,
+                "proxy_requests": proxy.requests if proxy is not None else None,
+            },
+            "logs": folder if args.keep else None,
+        }, args.output)
+    finally:
+        # Workers and the app first, so that redis outlives them
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for server in servers:
+            server.shutdown()
+
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the full thumbnail miss path against local stand-ins")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--render-workers", type=int, default=0,
+                        help="Worker processes that only render, the others then only resolve")
+    parser.add_argument("--worker-concurrency", type=int, default=1, help="Jobs each worker process runs at the same time")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20, help="Clients sending requests at the same time")
+    parser.add_argument("--videos", type=int, default=200)
+    parser.add_argument("--times-per-video", type=int, default=3)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the request mix")
+    parser.add_argument("--generate-now-ratio", type=float, default=0.3)
+    parser.add_argument("--max-before-async-generation", type=int, default=15)
+    parser.add_argument("--max-size", type=int, default=10_000_000_000, help="thumbnail_storage.max_size for the run")
+    parser.add_argument("--youtube-latency", type=float, default=0.05, help="Seconds added to each stub YouTube response")
+    parser.add_argument("--unplayable-ratio", type=float, default=0.03)
+    parser.add_argument("--login-required-ratio", type=float, default=0.02)
+    parser.add_argument("--proxy", action="store_true", help="Route floatie and ffmpeg fallbacks through a local proxy")
+    parser.add_argument("--fake-ffmpeg", type=float, metavar="SECONDS",
+                        help="Replace ffmpeg with a stand-in that takes this long per render")
+    parser.add_argument("--full-seek", action="store_true",
+                        help="Let ffmpeg seek the whole stream instead of downloading only the keyframe group")
+    parser.add_argument("--stream-duration", type=int, default=60)
+    parser.add_argument("--media-folder", default=os.path.join(tempfile.gettempdir(), "dearrow-harness-media"),
+                        help="Where synthetic streams are created and reused between runs")
+    parser.add_argument("--redis-port", type=int, help="Use an existing redis server on localhost instead of starting one")
+    parser.add_argument("--flush", action="store_true", help="Flush the existing redis database before running")
+    parser.add_argument("--app-port", type=int)
+    parser.add_argument("--drain", action="store_true", help="Wait for the queues to empty before finishing")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder with logs and the cache")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+
+    asyncio.run(run_harness(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Offline benchmark of the cache read path.
+
+Builds a synthetic cache folder and measures get_thumbnail_from_files,
+get_latest_thumbnail_from_files and a cached /api/v1/getThumbnail request
+through an ASGI client. Redis is replaced by fakeredis unless --redis config
+is passed, in which case the redis server from the config file is used.
+
+    python -m benchmarks.read_path --videos 2000 --output read_path.json
+"""
+
+import argparse
+import asyncio
+from dataclasses import dataclass
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from benchmarks.common import LatencySummary, random_video_id, summarize_latencies, write_results, zipf_sample
+from constants.thumbnail import image_format, metadata_format
+from utils.config import config
+import utils.redis_handler as redis_handler
+
+@dataclass
+class CachedThumbnail:
+    video_id: str
+    time: float
+    has_title: bool
+
+def synthetic_image(rng: random.Random, size: int) -> bytes:
+    # Only the header is real, nothing on the read path decodes the image
+    payload = rng.randbytes(max(0, size - 12))
+    return b"RIFF" + (size - 8).to_bytes(4, "little") + b"WEBP" + payload
+
+def populate_cache(folder: str, videos: int, timestamps: int, title_ratio: float, rng: random.Random) -> list[CachedThumbnail]:
+    thumbnails: list[CachedThumbnail] = []
+    now = time.time()
+
+    for _ in range(videos):
+        video_id = random_video_id(rng)
+        video_folder = os.path.join(folder, video_id)
+        os.makedirs(video_folder, exist_ok=True)
+
+        for _ in range(rng.randint(1, timestamps)):
+            # Clients send times with arbitrary precision
+            thumbnail_time = round(rng.uniform(0, 3600), rng.choice([0, 1, 3, 6]))
+            thumbnail_time = float(thumbnail_time)
+            image_filename = os.path.join(video_folder, f"{thumbnail_time}{image_format}")
+            with open(image_filename, "wb") as file:
+                file.write(synthetic_image(rng, rng.randint(15_000, 80_000)))
+
+            has_title = rng.random() < title_ratio
+            if has_title:
+                with open(os.path.join(video_folder, f"{thumbnail_time}{metadata_format}"), "w") as file:
+                    file.write(f"Synthetic title {rng.randint(0, 1_000_000)}")
+
+            modified_time = now - rng.uniform(0, 30 * 24 * 60 * 60)
+            os.utime(image_filename, (modified_time, modified_time))
+            thumbnails.append(CachedThumbnail(video_id, thumbnail_time, has_title))
+
+    return thumbnails
+
+async def measure(operation: Callable[[CachedThumbnail], Awaitable[None]],
+                    requests: list[CachedThumbnail], concurrency: int) -> LatencySummary:
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(thumbnail: CachedThumbnail) -> None:
+        async with semaphore:
+            start_time = time.perf_counter()
+            await operation(thumbnail)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run(thumbnail) for thumbnail in requests])
+    return summarize_latencies(latencies, time.perf_counter() - start_time)
+
+async def use_fake_redis() -> None:
+    import fakeredis
+
+    redis_handler.set_async_redis_conn(fakeredis.aioredis.FakeRedis())
+
+async def run_benchmarks(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    folder = tempfile.mkdtemp(prefix="dearrow-benchmark-")
+    config["thumbnail_storage"]["path"] = folder
+
+    try:
+        populate_start = time.perf_counter()
+        thumbnails = populate_cache(folder, args.videos, args.timestamps, args.title_ratio, rng)
+        populate_time = time.perf_counter() - populate_start
+
+        if args.redis == "fake":
+            await use_fake_redis()
+
+        # Imported late so that the config above is used
+        import httpx
+        from app import app
+        from utils.thumbnail import get_latest_thumbnail_from_files, get_thumbnail_from_files
+
+        requests = zipf_sample(thumbnails, args.zipf, args.requests, rng)
+
+        async def from_files(thumbnail: CachedThumbnail) -> None:
+            await get_thumbnail_from_files(thumbnail.video_id, thumbnail.time, False)
+
+        async def latest_from_files(thumbnail: CachedThumbnail) -> None:
+            await get_latest_thumbnail_from_files(thumbnail.video_id, False)
+
+        transport = httpx.ASGITransport(app=app) # pyright: ignore[reportGeneralTypeIssues]
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            async def get_thumbnail_request(thumbnail: CachedThumbnail) -> None:
+                response = await client.get("/api/v1/getThumbnail", params={
+                    "videoID": thumbnail.video_id,
+                    "time": thumbnail.time,
+                })
+                if response.status_code != 200:
+                    raise RuntimeError(f"Unexpected status {response.status_code} for {thumbnail}")
+
+            # Warm up the page cache and connections before measuring
+            for thumbnail in requests[:min(len(requests), 100)]:
+                await get_thumbnail_request(thumbnail)
+
+            results = {
+                "get_thumbnail_from_files": await measure(from_files, requests, args.concurrency),
+                "get_latest_thumbnail_from_files": await measure(latest_from_files, requests, args.concurrency),
+                "get_thumbnail_hit": await measure(get_thumbnail_request, requests, args.concurrency),
+            }
+
+        results["populate"] = {
+            "thumbnails": len(thumbnails),
+            "with_title": sum(1 for thumbnail in thumbnails if thumbnail.has_title),
+            "seconds": populate_time,
+        }
+
+        write_results("read_path", vars(args), results, args.output)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the cached thumbnail read path")
+    parser.add_argument("--videos", type=int, default=1000, help="Number of synthetic videos in the cache")
+    parser.add_argument("--timestamps", type=int, default=10, help="Maximum number of thumbnails per video")
+    parser.add_argument("--title-ratio", type=float, default=0.5, help="Fraction of thumbnails with a title")
+    parser.add_argument("--requests", type=int, default=5000, help="Number of requests per measurement")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the request distribution")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once")
+    parser.add_argument("--redis", choices=["fake", "config"], default="fake",
+                        help="Use fakeredis or the redis server from the config file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+
+    asyncio.run(run_benchmarks(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark of the cold start of the app and worker entry points, as when replicas are added.
+
+For each entry point, fresh Python processes import it and report the import time, peak
+memory and whether yt-dlp was loaded. app.py and worker.py are then started against a
+local redis server, and the time until they answer HTTP requests and their memory at
+that point are recorded.
+
+    python -m benchmarks.startup --runs 5 --output startup.json
+
+Pass --try-ytdlp to have the worker warm its yt-dlp pool at start, as resolve workers
+using yt-dlp do.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+import httpx
+from redis import Redis
+
+from benchmarks.app_scaling import get_process_memory
+from benchmarks.common import write_results
+from benchmarks.load_harness import free_port, local_host, repo_folder, start_process, wait_for, write_config
+
+entry_points = ["app", "worker"]
+# Printed by a fresh interpreter after importing the entry point
+import_script = """
+import json, resource, sys, time
+start_time = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start_time, "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  "modules": len(sys.modules), "yt_dlp": "yt_dlp" in sys.modules}}))
+"""
+
+def build_config(args: argparse.Namespace, folder: str, redis_port: int, app_port: int, health_check_port: int) -> dict[str, Any]:
+    return {
+        "server": {
+            "host": local_host,
+            "port": app_port,
+            "reload": False,
+            "worker_health_check_port": health_check_port,
+        },
+        "thumbnail_storage": {
+            "path": os.path.join(folder, "cache"),
+            "max_size": 50_000_000_000,
+            "cleanup_multiplier": 0.9,
+            "redis_offset_allowed": 20,
+            "max_before_async_generation": 15,
+            "max_queue_size": 10000,
+        },
+        "redis": {"host": local_host, "port": redis_port},
+        "yt_auth": {"visitorData": ""},
+        "default_max_height": 720,
+        "status_auth_password": "benchmark",
+        "skip_local_ffmpeg": False,
+        "try_floatie": True,
+        "try_floatie_for_live": True,
+        "try_ytdlp": args.try_ytdlp,
+        "max_concurrent_renders": 100,
+        "max_concurrent_ytdlp": 100,
+        "debug": False,
+    }
+
+def measure_import(module: str, config_path: str) -> dict[str, Any]:
+    output = subprocess.run([sys.executable, "-c", import_script.format(module=module)], cwd=repo_folder, check=True,
+                            env=dict(os.environ, CONFIG_PATH=config_path), stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+def time_until(check: Callable[[], bool], process: subprocess.Popen[bytes], description: str, timeout: float = 60) -> float:
+    """
+    Seconds from now until the check passes, polled often enough to time a start of well under a second
+    """
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{description} exited with code {process.returncode}")
+        try:
+            if check():
+                return time.perf_counter() - start_time
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.01)
+
+    raise TimeoutError(f"Timed out waiting for {description}")
+
+def measure_ready(entry_point: str, config_path: str, url: str, log_path: str) -> dict[str, Any]:
+    start_time = time.perf_counter()
+    process = start_process(f"{entry_point}.py", config_path, log_path, None, ["--concurrency", "1"] if entry_point == "worker" else [])
+    try:
+        # The app redirects / to the repository, the worker's health check answers any path
+        expected_status = 307 if entry_point == "app" else 200
+        time_until(lambda: httpx.get(url).status_code == expected_status, process, entry_point)
+        return {
+            "seconds": time.perf_counter() - start_time,
+            "memory": get_process_memory(process.pid),
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+def run_benchmark(args: argparse.Namespace) -> None:
+    folder = tempfile.mkdtemp(prefix="dearrow-startup-")
+    redis_process: subprocess.Popen[bytes] | None = None
+
+    try:
+        redis_port = args.redis_port
+        if redis_port is None:
+            redis_server = shutil.which("redis-server")
+            if redis_server is None:
+                raise RuntimeError("redis-server not found, pass --redis-port to use an existing server")
+            redis_port = free_port()
+            redis_process = subprocess.Popen([redis_server, "--port", str(redis_port), "--bind", local_host,
+                                              "--save", "", "--appendonly", "no"], stdout=subprocess.DEVNULL)
+        wait_for(Redis(host=local_host, port=redis_port).ping, "redis")
+
+        app_port = free_port()
+        health_check_port = free_port()
+        config_path = write_config(folder, "startup", build_config(args, folder, redis_port, app_port, health_check_port))
+        urls = {"app": f"http://{local_host}:{app_port}/", "worker": f"http://{local_host}:{health_check_port}/"}
+
+        results: dict[str, Any] = {}
+        for entry_point in entry_points:
+            imports = [measure_import(entry_point, config_path) for _ in range(args.runs)]
+            starts = [measure_ready(entry_point, config_path, urls[entry_point], os.path.join(folder, f"{entry_point}-{run}.log"))
+                      for run in range(args.runs)]
+
+            results[entry_point] = {
+                "import_seconds": summarize([result["seconds"] for result in imports]),
+                "import_max_rss": statistics.median(result["max_rss"] for result in imports),
+                "modules": imports[0]["modules"],
+                "yt_dlp_loaded": imports[0]["yt_dlp"],
+                "ready_seconds": summarize([result["seconds"] for result in starts]),
+                "ready_rss": statistics.median(result["memory"]["rss"] for result in starts),
+                "ready_pss": statistics.median(result["memory"]["pss"] for result in starts),
+            }
+
+        write_results("startup", vars(args), {
+            "entry_points": results,
+            "logs": folder if args.keep else None,
+        }, args.output)
+    finally:
+        if redis_process is not None:
+            redis_process.terminate()
+            redis_process.wait()
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the start time and memory of the app and worker processes")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes to start for each entry point and measurement")
+    parser.add_argument("--try-ytdlp", action="store_true", help="Set try_ytdlp, so that the worker warms its yt-dlp pool at start")
+    parser.add_argument("--redis-port", type=int, help="Use an existing redis server on localhost instead of starting one")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder with logs")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+
+    run_benchmark(parser.parse_args())
+
+if __name__ == "__main__":
+    main()
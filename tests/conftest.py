@@ -0,0 +1,49 @@
+import os
+import shutil
+
+import fakeredis
+import pytest
+from utils.config import config
+from utils.redis_handler import reset_async_redis_conn, set_async_redis_conn
+from utils.thumbnail import get_file_paths
+
+# The video stored_thumbnail is stored for
+stored_video_id = "jNQXAC9IVRw"
+
+@pytest.fixture
+def async_redis():
+    async_redis = fakeredis.aioredis.FakeRedis()
+    set_async_redis_conn(async_redis)
+    yield async_redis
+    reset_async_redis_conn()
+
+@pytest.fixture
+def stored_image() -> bytes:
+    # Overridden by modules that need other contents
+    return b"image"
+
+@pytest.fixture
+def stored_thumbnail(tmp_path, monkeypatch, async_redis, stored_image: bytes) -> tuple[str, str]:
+    """
+    Thumbnail of stored_video_id at 5.3 without a title, in storage of its own. Gives the
+    image's filename and the filename its title is written to.
+    """
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+
+    output_folder, output_filename, metadata_filename, _ = get_file_paths(stored_video_id, 5.3, False)
+    os.makedirs(output_folder)
+    with open(output_filename, "wb") as file:
+        file.write(stored_image)
+
+    return output_filename, metadata_filename
+
+@pytest.fixture(scope="session")
+def ffmpeg_path() -> str:
+    """
+    For tests that run ffmpeg themselves to make their samples, which are skipped without it
+    """
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        pytest.skip("ffmpeg is needed to make the samples")
+
+    return ffmpeg_path
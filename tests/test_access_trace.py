@@ -0,0 +1,13 @@
+import os
+
+import utils.process_state as process_state
+from utils.access_trace import get_trace_path
+
+def test_trace_path(monkeypatch):
+    assert get_trace_path("trace-{pid}.csv") == f"trace-{os.getpid()}.csv"
+    assert get_trace_path("trace.csv") == "trace.csv"
+
+    # Several app processes never write to the same file
+    monkeypatch.setattr(process_state, "state_folder", "/tmp/dearrow-app")
+    assert get_trace_path("trace.csv") == f"trace.csv.{os.getpid()}"
+    assert get_trace_path("trace-{pid}.csv") == f"trace-{os.getpid()}.csv"
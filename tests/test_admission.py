@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+import math
+import threading
+
+import fakeredis
+import pytest
+from rq.job import Job
+from utils.admission import StageEstimate, estimate_ready_in, get_throughput_estimate, measure_throughput
+import utils.admission as admission
+from utils.priority_queue import PriorityQueue, priority_score
+from utils.worker_slots import ThumbnailWorker
+
+def job_function() -> None:
+    pass
+
+def add_finished_job(queue: PriorityQueue, job_id: str, duration: float) -> None:
+    job = Job.create(job_function, id=job_id, connection=queue.connection, origin=queue.name)
+    job.started_at = datetime(2024, 1, 1)
+    job.ended_at = job.started_at + timedelta(seconds=duration)
+    job.save()
+    queue.finished_job_registry.add(job, 500)
+
+def test_stage_wait():
+    assert StageEstimate(2, None).wait(10) is None
+    assert StageEstimate(0, 1.5).wait(0) == math.inf
+    assert StageEstimate(1, 1.5).wait(0) == 1.5
+    assert StageEstimate(2, 1.5).wait(3) == 3
+    assert StageEstimate(4, 1.5).wait(3) == 1.5
+
+@pytest.mark.asyncio
+async def test_estimate_ready_in():
+    connection = fakeredis.FakeStrictRedis()
+    queue_resolve = PriorityQueue("default", connection=connection)
+    queue_render = PriorityQueue("render", connection=connection)
+    ThumbnailWorker(["render", "default"], connection=connection, name="all").register_birth()
+    ThumbnailWorker(["render"], connection=connection, name="render").register_birth()
+
+    for index, duration in enumerate([0.5, 1, 1.5, 100]):
+        add_finished_job(queue_resolve, f"resolve-{index}", duration)
+    add_finished_job(queue_render, "render", 2)
+
+    estimate = measure_throughput(connection, [queue_resolve, queue_render])
+    assert estimate.stages["default"] == StageEstimate(1, 1.25)
+    assert estimate.stages["render"] == StageEstimate(2, 2)
+
+    admission.current_estimate = estimate
+    jobs = [queue_resolve.enqueue(job_function, job_id=f"queued-{index}", meta={"priority_score": priority_score("low", index)})
+            for index in range(3)]
+    render_job = queue_render.enqueue(job_function, job_id="rendering", meta={"priority_score": priority_score("low", 0)})
+
+    # Two jobs ahead to resolve, then those two and the waiting render job spread over two render workers
+    assert await estimate_ready_in(jobs[2], queue_resolve, queue_render) == 3 * 1.25 + 2 * 2
+    assert await estimate_ready_in(render_job, queue_resolve, queue_render) == 2
+
+    admission.current_estimate = None
+
+@pytest.mark.asyncio
+async def test_estimate_measured_off_event_loop(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    queues = [PriorityQueue("default", connection=connection), PriorityQueue("render", connection=connection)]
+    measured_on: list[threading.Thread] = []
+
+    def measure(*args):
+        measured_on.append(threading.current_thread())
+        return measure_throughput(*args)
+
+    monkeypatch.setattr(admission, "current_estimate", None)
+    monkeypatch.setattr(admission, "measure_throughput", measure)
+    estimate = await get_throughput_estimate(connection, queues)
+    assert measured_on != [] and threading.main_thread() not in measured_on
+
+    # Used until it is refreshed
+    assert await get_throughput_estimate(connection, queues) is estimate
+    assert len(measured_on) == 1
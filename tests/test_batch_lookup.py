@@ -0,0 +1,136 @@
+import os
+import time
+
+import fakeredis
+import pytest
+import utils.batch_lookup as batch_lookup
+from utils.batch_lookup import BatchEntry, lookup_thumbnails
+from utils.cleanup import last_used_key
+from utils.config import config
+from utils.negative_cache import failure_key
+from utils.priority_queue import PriorityQueue
+from utils.redis_handler import reset_async_redis_conn, set_async_redis_conn
+from utils.storage import LocalStorage
+from utils.thumbnail import get_best_time_key, get_file_paths, get_fps_key, get_job_id
+
+@pytest.fixture
+def redis_server(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    connection = fakeredis.FakeStrictRedis(server=server)
+    monkeypatch.setattr(batch_lookup, "queue_resolve", PriorityQueue("default", connection=connection))
+    monkeypatch.setattr(batch_lookup, "queue_render", PriorityQueue("render", connection=connection))
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+
+    async_redis = fakeredis.aioredis.FakeRedis(server=server)
+    set_async_redis_conn(async_redis)
+    yield async_redis
+    reset_async_redis_conn()
+
+def store_thumbnail(video_id: str, time: float, image: bytes = b"image", title: str | None = None) -> None:
+    output_folder, output_filename, metadata_filename, _ = get_file_paths(video_id, time, False)
+    os.makedirs(output_folder, exist_ok=True)
+    with open(output_filename, "wb") as file:
+        file.write(image)
+    if title is not None:
+        with open(metadata_filename, "w") as file:
+            file.write(title)
+
+@pytest.mark.asyncio
+async def test_lookup(redis_server):
+    store_thumbnail("jNQXAC9IVRw", 5.3, title="Me at the zoo")
+    store_thumbnail("bdq-IYxhByw", 1.0)
+    store_thumbnail("bdq-IYxhByw", 2.0)
+    await redis_server.set(get_fps_key("jNQXAC9IVRw"), 30)
+    await redis_server.set(get_best_time_key("bdq-IYxhByw"), 1.0)
+    await redis_server.set(failure_key("dQw4w9WgXcQ"), "premiere")
+
+    results = await lookup_thumbnails([
+        BatchEntry("jNQXAC9IVRw", 5.32),
+        BatchEntry("bdq-IYxhByw", None),
+        BatchEntry("bdq-IYxhByw", 3.0),
+        BatchEntry("dQw4w9WgXcQ", 1.0),
+    ], True, False)
+
+    assert [result.available for result in results] == [True, True, False, False]
+    # Found from a time in the same frame
+    assert (results[0].time, results[0].timestamp, results[0].title, results[0].image) == (5.3, 5.3, "Me at the zoo", b"image")
+    assert results[1].timestamp == 1.0
+    assert results[2].failure_reason == "Thumbnail not cached"
+    assert results[3].failure_reason == "Video has not premiered yet"
+
+    last_used = await redis_server.zrange(last_used_key(), 0, -1)
+    assert sorted(last_used) == [b"bdq-IYxhByw", b"jNQXAC9IVRw"]
+
+@pytest.mark.asyncio
+async def test_images_only_when_asked(redis_server):
+    store_thumbnail("jNQXAC9IVRw", 5.3)
+    results = await lookup_thumbnails([BatchEntry("jNQXAC9IVRw", 5.3)], False, False)
+    assert results[0].available
+    assert results[0].image is None
+
+@pytest.mark.asyncio
+async def test_enqueue_missing(redis_server, monkeypatch):
+    queue = batch_lookup.queue_resolve
+    store_thumbnail("jNQXAC9IVRw", 5.3)
+    await redis_server.set(failure_key("dQw4w9WgXcQ"), "unplayable")
+    monkeypatch.setitem(config["priority"]["max_queued"], "low", 2)
+
+    entries = [
+        BatchEntry("jNQXAC9IVRw", 5.3),
+        BatchEntry("jNQXAC9IVRw", 6.0),
+        BatchEntry("jNQXAC9IVRw", 6.0),
+        BatchEntry("bdq-IYxhByw", None),
+        BatchEntry("dQw4w9WgXcQ", 1.0),
+        BatchEntry("bdq-IYxhByw", 2.0),
+        BatchEntry("bdq-IYxhByw", 3.0),
+    ]
+    results = await lookup_thumbnails(entries, False, True)
+
+    # Cached, latest, and known failures are not queued, and the same thumbnail is only queued once
+    assert queue.get_job_ids() == [get_job_id("jNQXAC9IVRw", 6.0), get_job_id("bdq-IYxhByw", 2.0)]
+    assert [result.queued for result in results] == [False, True, True, False, False, True, False]
+    assert results[6].failure_reason == "Failed to generate thumbnail due to queue being too big"
+    assert queue.fetch_job(get_job_id("bdq-IYxhByw", 2.0)).meta["priority"] == "low" # pyright: ignore
+
+    # Jobs already waiting are reported without being added again
+    results = await lookup_thumbnails(entries[1:2], False, True)
+    assert results[0].queued
+    assert len(queue) == 2
+
+@pytest.mark.asyncio
+async def test_failed_entries(redis_server, monkeypatch):
+    store_thumbnail("jNQXAC9IVRw", 5.3)
+    store_thumbnail("bdq-IYxhByw", 1.0)
+    read = LocalStorage.read
+
+    def read_failing(self: LocalStorage, name: str):
+        if name.startswith("bdq-IYxhByw/"):
+            raise OSError("Storage unavailable")
+        return read(self, name)
+
+    monkeypatch.setattr(LocalStorage, "read", read_failing)
+    results = await lookup_thumbnails([
+        BatchEntry("jNQXAC9IVRw", 5.3),
+        BatchEntry("bdq-IYxhByw", 1.0),
+        BatchEntry("dQw4w9WgXcQ", 1.0),
+    ], True, True)
+
+    # Each entry gets its own result, and entries that could not be checked are not queued
+    assert [result.available for result in results] == [True, False, False]
+    assert results[0].image == b"image"
+    assert results[1].failure_reason == "Server error"
+    assert [result.queued for result in results] == [False, False, True]
+    assert batch_lookup.queue_resolve.get_job_ids() == [get_job_id("dQw4w9WgXcQ", 1.0)]
+
+@pytest.mark.asyncio
+async def test_entries_checked_at_once(redis_server, monkeypatch):
+    find_thumbnail = batch_lookup.find_thumbnail
+
+    def slow_find_thumbnail(*args):
+        time.sleep(0.2)
+        return find_thumbnail(*args)
+
+    monkeypatch.setattr(batch_lookup, "find_thumbnail", slow_find_thumbnail)
+    start_time = time.monotonic()
+    await lookup_thumbnails([BatchEntry("jNQXAC9IVRw", float(i)) for i in range(8)], False, False)
+    assert time.monotonic() - start_time < 8 * 0.2 / 2
@@ -0,0 +1,39 @@
+from benchmarks.cache_simulator import Access, parse_trace, simulate
+
+
+def make_trace() -> list[Access]:
+    # Video a is requested often, b and c once each
+    return [
+        Access(1, "aaaaaaaaaaa", 1.0, False, 0),
+        Access(2, "aaaaaaaaaaa", 1.0, True, 100),
+        Access(3, "bbbbbbbbbbb", 2.0, False, 0),
+        Access(4, "aaaaaaaaaaa", 1.0, True, 100),
+        Access(5, "ccccccccccc", 3.0, False, 0),
+        Access(6, "aaaaaaaaaaa", None, True, 100),
+        Access(7, "bbbbbbbbbbb", 2.0, False, 0),
+    ]
+
+def test_parse_trace():
+    accesses = list(parse_trace(["1.5,aaaaaaaaaaa,2.25,1,300\n", "2.5,aaaaaaaaaaa,,0,0\n", "bad line\n"]))
+    assert accesses == [
+        Access(1.5, "aaaaaaaaaaa", 2.25, True, 300),
+        Access(2.5, "aaaaaaaaaaa", None, False, 0),
+    ]
+
+def test_unbounded_cache_hits_everything_seen_before():
+    result = simulate(make_trace(), "lru-video", 10_000, 0.9).summary()
+    assert result["requests"] == 7
+    assert result["hits"] == 4
+    assert result["renders"] == 3
+    assert result["renders_saved"] == 3
+
+def test_small_cache_evicts_least_recently_used_video():
+    # Only two thumbnails fit, so c pushes out b rather than the recently used a
+    result = simulate(make_trace(), "lru-video", 250, 0.8).summary()
+    assert result["cleanups"] == 2
+    assert result["hits"] == 3
+    assert result["renders"] == 4
+
+def test_byte_hit_ratio_uses_estimated_miss_sizes():
+    result = simulate(make_trace(), "lru-video", 10_000, 0.9).summary()
+    assert result["byte_hit_ratio"] == 4 / 7
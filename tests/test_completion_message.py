@@ -0,0 +1,58 @@
+import os
+
+from fastapi import Response
+import pytest
+from app import handle_thumbnail_response
+from tests.conftest import stored_video_id as video_id
+from utils.config import config
+from utils.storage import StoredFile
+from utils.thumbnail import Thumbnail, decode_job_status, encode_job_status, get_file_names, get_finished_message_thumbnail, get_job_status
+
+metadata_name = get_file_names(video_id, 5.3, False)[2]
+
+@pytest.fixture
+def stored_image() -> bytes:
+    # Newlines separate the parts of the completion message
+    return b"image\nwith newlines"
+
+def read_image(filename: str) -> tuple[bytes, StoredFile]:
+    with open(filename, "rb") as file:
+        return file.read(), StoredFile.from_stat(os.fstat(file.fileno()))
+
+def test_encode_and_decode():
+    assert decode_job_status(encode_job_status("false", None)) == ("false", None)
+
+    thumbnail = Thumbnail(b"image\nwith newlines", 5.3, "Title\n", '"5-1"', 1.5)
+    message = encode_job_status("true", thumbnail)
+    assert decode_job_status(message) == ("true", thumbnail)
+    assert get_job_status(message) == "true"
+
+def test_large_images_not_sent(stored_thumbnail: tuple[str, str], monkeypatch):
+    output_filename, metadata_filename = stored_thumbnail
+    with open(metadata_filename, "w") as file:
+        file.write("Title")
+
+    thumbnail = get_finished_message_thumbnail(5.3, metadata_name, None, *read_image(output_filename))
+    assert thumbnail is not None
+    assert thumbnail.image == b"image\nwith newlines"
+    assert thumbnail.title == "Title"
+    assert thumbnail.etag is not None
+
+    monkeypatch.setitem(config, "completion_image_max_size", 4)
+    assert get_finished_message_thumbnail(5.3, metadata_name, None, *read_image(output_filename)) is None
+
+@pytest.mark.asyncio
+async def test_response_from_message(stored_thumbnail: tuple[str, str]):
+    output_filename, metadata_filename = stored_thumbnail
+    thumbnail = get_finished_message_thumbnail(5.3, metadata_name, None, *read_image(output_filename))
+    os.remove(output_filename)
+
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response(), finished_thumbnail=thumbnail)
+    assert response.body == b"image\nwith newlines"
+    assert response.headers["ETag"] == thumbnail.etag # pyright: ignore
+
+    # A title given in the request is stored and not sent back
+    response = await handle_thumbnail_response(video_id, 5.3, False, "Title", Response(), finished_thumbnail=thumbnail)
+    assert "X-Title" not in response.headers
+    with open(metadata_filename) as file:
+        assert file.read() == "Title"
@@ -0,0 +1,67 @@
+from fastapi import Response
+import pytest
+from app import etag_matches, get_thumbnail_head, handle_thumbnail_response
+from tests.conftest import stored_video_id as video_id
+
+def test_etag_matches():
+    assert etag_matches('"5-1"', '"5-1"')
+    assert etag_matches('"4-1", W/"5-1"', '"5-1"')
+    assert etag_matches("*", '"5-1"')
+    assert not etag_matches('"5-2"', '"5-1"')
+
+@pytest.mark.asyncio
+async def test_not_modified(stored_thumbnail: tuple[str, str]):
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response())
+    assert response.body == b"image"
+    # A title can be added later, so even thumbnails at a time are revalidated
+    assert response.headers["Cache-Control"] == "public, max-age=3600"
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response(), if_none_match=etag)
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["ETag"] == etag
+
+    # Rewritten thumbnails are sent again
+    with open(stored_thumbnail[0], "wb") as file:
+        file.write(b"new image")
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response(), if_none_match=etag)
+    assert response.status_code == 200
+    assert response.body == b"new image"
+    assert response.headers["ETag"] != etag
+
+@pytest.mark.asyncio
+async def test_title_changes_etag(stored_thumbnail: tuple[str, str]):
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response())
+    etag = response.headers["ETag"]
+
+    with open(stored_thumbnail[1], "w") as file:
+        file.write("Title")
+    response = await handle_thumbnail_response(video_id, 5.3, False, None, Response(), if_none_match=etag)
+    assert response.status_code == 200
+    assert response.headers["X-Title"] == "Title"
+    assert response.headers["ETag"] != etag
+    assert response.headers["Cache-Control"] == "public, max-age=3600"
+
+    head_response = await get_thumbnail_head(video_id, 5.3)
+    assert head_response.headers["ETag"] == response.headers["ETag"]
+    assert head_response.headers["Cache-Control"] == "public, max-age=3600"
+
+@pytest.mark.asyncio
+async def test_latest_thumbnail(stored_thumbnail: tuple[str, str]):
+    response = await handle_thumbnail_response(video_id, None, False, None, Response())
+    assert response.body == b"image"
+    assert response.headers["Cache-Control"] == "public, max-age=3600"
+
+@pytest.mark.asyncio
+async def test_head(stored_thumbnail: tuple[str, str]):
+    response = await get_thumbnail_head(video_id, 5.3)
+    assert response.status_code == 200
+    assert response.body == b""
+    assert response.headers["Content-Length"] == "5"
+    assert response.headers["X-Timestamp"] == "5.3"
+    assert "ETag" in response.headers
+
+    response = await get_thumbnail_head(video_id, 6.0)
+    assert response.status_code == 204
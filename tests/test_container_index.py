@@ -0,0 +1,102 @@
+import subprocess
+
+import pytest
+from utils.container_index import ContainerIndexError, RangeReader, initial_fetch_size, read_index, write_segment_file
+
+fps = 30
+width = 160
+height = 90
+
+# Six seconds with a keyframe every two seconds
+sample_args = {
+    "fragmented.mp4": ["-c:v", "libx264", "-pix_fmt", "yuv420p",
+                       "-movflags", "frag_keyframe+empty_moov+default_base_moof+global_sidx+dash"],
+    "cues-front.webm": ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-dash", "1", "-cues_to_front", "1"],
+    "cues-end.webm": ["-c:v", "libvpx-vp9", "-deadline", "realtime"],
+    "progressive.mp4": ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart"],
+}
+
+@pytest.fixture(scope="module")
+def samples(tmp_path_factory, ffmpeg_path: str) -> dict[str, str]:
+    folder = tmp_path_factory.mktemp("samples")
+    paths: dict[str, str] = {}
+    for name, encoder_args in sample_args.items():
+        paths[name] = str(folder / name)
+        subprocess.run([
+            ffmpeg_path, "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+            "-t", "6", "-g", str(fps * 2), *encoder_args, paths[name],
+        ], check=True)
+
+    return paths
+
+def decode_frames(ffmpeg_path: str, path: str, seek_time: float = 0, count: int | None = None) -> list[bytes]:
+    frames = subprocess.run([
+        ffmpeg_path, "-v", "error", "-ss", str(seek_time), "-i", path,
+        *(["-vframes", str(count)] if count is not None else []),
+        "-f", "rawvideo", "-pix_fmt", "gray", "-",
+    ], check=True, capture_output=True).stdout
+
+    return [frames[i:i + width * height] for i in range(0, len(frames), width * height)]
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+class Fetcher:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.fetches: list[tuple[int, int]] = []
+
+    def __call__(self, start: int, end: int) -> bytes:
+        self.fetches.append((start, end))
+        return self.data[start:end]
+
+    def fetched(self, start: int, end: int) -> bool:
+        return any(fetch_start < end and start < fetch_end for fetch_start, fetch_end in self.fetches)
+
+@pytest.mark.parametrize("name", ["fragmented.mp4", "cues-front.webm", "cues-end.webm"])
+def test_index(samples, name: str):
+    index = read_index(RangeReader(Fetcher(read_file(samples[name]))))
+    assert [segment.time for segment in index.segments] == [0, 2, 4]
+    for segment, next_segment in zip(index.segments, index.segments[1:]):
+        assert segment.end == next_segment.start
+
+    # The index is left out of the init segment
+    assert b"sidx" not in index.init
+    assert bytes.fromhex("1C53BB6B") not in index.init
+
+    assert index.find_segment(59 / fps, 1 / fps) == index.segments[0]
+    assert index.find_segment(60 / fps, 1 / fps) == index.segments[1]
+    assert index.find_segment(10, 1 / fps) == index.segments[2]
+
+def test_no_index(samples):
+    with pytest.raises(ContainerIndexError):
+        read_index(RangeReader(Fetcher(read_file(samples["progressive.mp4"]))))
+
+@pytest.mark.parametrize("name", ["fragmented.mp4", "cues-front.webm", "cues-end.webm"])
+def test_segment_decodes_to_same_frame(samples, tmp_path, ffmpeg_path: str, name: str):
+    frames = decode_frames(ffmpeg_path, samples[name])
+    for frame_index in [0, 59, 60, 61, 179]:
+        fetcher = Fetcher(read_file(samples[name]))
+        reader = RangeReader(fetcher)
+        index = read_index(reader)
+        filename = str(tmp_path / f"{frame_index}-{name}")
+        seek_time = write_segment_file(reader, index, frame_index / fps, fps, filename)
+
+        assert decode_frames(ffmpeg_path, filename, seek_time, 1) == [frames[frame_index]]
+
+        # Other keyframe groups are only downloaded as part of the first fetch
+        segment = index.find_segment(frame_index / fps, 1 / fps)
+        for other in index.segments:
+            if other != segment:
+                assert not fetcher.fetched(max(other.start, initial_fetch_size), other.end)
+
+def test_reader_merges_fetches():
+    fetcher = Fetcher(bytes(range(256)) * 4)
+    reader = RangeReader(fetcher)
+
+    assert reader.read(0, 100) == fetcher.data[0:100]
+    assert reader.read(50, 150) == fetcher.data[50:150]
+    assert reader.read(10, 20) == fetcher.data[10:20]
+    assert fetcher.fetches == [(0, 100), (100, 150)]
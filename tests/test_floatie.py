@@ -0,0 +1,36 @@
+import json
+
+import utils.floatie as floatie
+from utils.config import config
+
+def test_parse_visitor_data():
+    page = '<script>ytcfg.set({"INNERTUBE_API_KEY":"key","VISITOR_DATA":"Cgt0ZXN0"});</script>'
+    assert floatie.parse_visitor_data(page) == "Cgt0ZXN0"
+    assert floatie.parse_visitor_data("<html></html>") is None
+
+def test_visitor_data_cached_per_proxy(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(floatie.time, "time", lambda: now)
+    monkeypatch.setitem(config, "floatie_visitor_data_ttl", 60)
+
+    floatie.cache_visitor_data("http://proxy:8080", "proxied")
+    floatie.cache_visitor_data(None, None)
+    assert floatie.get_cached_visitor_data("http://proxy:8080") == "proxied"
+    assert floatie.get_cached_visitor_data(None) is None
+
+    now += 61
+    assert floatie.get_cached_visitor_data("http://proxy:8080") is None
+
+    floatie.cache_visitor_data("http://proxy:8080", "proxied")
+    floatie.forget_visitor_data("http://proxy:8080")
+    assert floatie.get_cached_visitor_data("http://proxy:8080") is None
+
+def test_player_request():
+    _, payload = floatie.get_player_request("jNQXAC9IVRw")
+    assert json.loads(payload) == {"context": floatie.context, "videoId": "jNQXAC9IVRw"}
+
+def test_sessions_reused_per_proxy():
+    session = floatie.get_session("http://proxy:8080")
+    assert floatie.get_session("http://proxy:8080") is session
+    assert session.proxies["https"] == "http://proxy:8080"
+    assert floatie.get_session(None) is not session
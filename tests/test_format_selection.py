@@ -0,0 +1,67 @@
+import fakeredis
+import pytest
+import utils.format_selection as format_selection
+from utils.format_selection import get_bitrate, get_codec, record_chosen_format, record_render_time, select_format
+from utils.video import PlaybackUrl
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    monkeypatch.setattr(format_selection, "redis_conn", fakeredis.FakeStrictRedis())
+    monkeypatch.setattr(format_selection, "measured_render_times", {})
+
+def playback_url(codec: str, height: int, bitrate: int | None = None) -> PlaybackUrl:
+    return PlaybackUrl(f"https://example.com/{codec}-{height}", height * 16 // 9, height, 30, codec, bitrate)
+
+def test_codec():
+    assert get_codec({"mimeType": 'video/mp4; codecs="av01.0.05M.08"'}) == "av1"
+    assert get_codec({"mimeType": 'video/webm; codecs="vp9"'}) == "vp9"
+    assert get_codec({"vcodec": "avc1.64001F"}) == "h264"
+    assert get_codec({"mimeType": "video/mp4"}) == "unknown"
+
+def test_bitrate():
+    assert get_bitrate({"bitrate": 2_000_000, "averageBitrate": 1_000_000}) == 1_000_000
+    assert get_bitrate({"tbr": 1500.5}) == 1_500_500
+    assert get_bitrate({"contentLength": "1000000", "approxDurationMs": "8000"}) == 1_000_000
+    assert get_bitrate({"filesize": 1_000_000, "duration": 4}) == 2_000_000
+    assert get_bitrate({"filesize": 1_000_000}) is None
+
+def test_cheapest_codec_at_target():
+    urls = [playback_url("av1", 1080), playback_url("av1", 720), playback_url("vp9", 720),
+            playback_url("h264", 720), playback_url("h264", 360)]
+
+    chosen, _ = select_format(urls, 720)
+    assert (chosen.codec, chosen.height) == ("h264", 720)
+
+def test_bitrate_counts():
+    urls = [playback_url("h264", 720, 20_000_000), playback_url("vp9", 720, 1_000_000)]
+
+    chosen, _ = select_format(urls, 720)
+    assert chosen.codec == "vp9"
+
+def test_target_height_kept():
+    # Cheaper shorter formats do not lower the quality
+    chosen, _ = select_format([playback_url("av1", 720), playback_url("h264", 480)], 720)
+    assert (chosen.codec, chosen.height) == ("av1", 720)
+
+    # Tallest available when nothing reaches the target
+    chosen, _ = select_format([playback_url("av1", 480), playback_url("h264", 360)], 720)
+    assert (chosen.codec, chosen.height) == ("av1", 480)
+
+    with pytest.raises(ValueError):
+        select_format([playback_url("h264", 1080)], 720)
+
+def test_measured_render_times():
+    urls = [playback_url("vp9", 720), playback_url("h264", 720)]
+    for _ in range(format_selection.min_render_time_samples):
+        record_render_time(urls[1], 2)
+
+    chosen, render_time = select_format(urls, 720)
+    assert chosen.codec == "vp9"
+    assert render_time == pytest.approx(format_selection.estimate_render_time(urls[0]))
+
+def test_chosen_formats():
+    record_chosen_format(playback_url("h264", 720))
+    record_chosen_format(playback_url("h264", 720))
+    record_chosen_format(playback_url("vp9", 360))
+
+    assert format_selection.get_chosen_formats() == {("h264", 720): 2, ("vp9", 360): 1}
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+from utils.config import config
+from utils.thumbnail import get_file_paths, get_fps_key, get_frame_index, get_frame_time, get_thumbnail_from_files, quantize_time
+
+def test_frame_index():
+    assert get_frame_index(5.3, 30) == 159
+    assert get_frame_index(5.33, 30) == 159
+    assert get_frame_index(5.34, 30) == 160
+    assert get_frame_index(0, 60) == 0
+
+@pytest.mark.parametrize("fps", [24, 25, 30, 50, 60, 120])
+def test_frame_time_stays_in_frame(fps: int):
+    for frame_index in range(0, 10_000, 7):
+        assert get_frame_index(get_frame_time(frame_index, fps), fps) == frame_index
+
+@pytest.mark.asyncio
+async def test_quantize_time(async_redis):
+    video_id = "jNQXAC9IVRw"
+    assert await quantize_time(video_id, 5.31) == 5.31
+
+    await async_redis.set(get_fps_key(video_id), 30)
+    assert await quantize_time(video_id, 5.3) == 5.3
+    assert await quantize_time(video_id, 5.30001) == 5.3
+    assert await quantize_time(video_id, 5.32) == 5.3
+    assert await quantize_time(video_id, 5.34) == 5.334
+
+@pytest.mark.asyncio
+async def test_same_frame_served_from_files(async_redis, tmp_path, monkeypatch):
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+    video_id = "bdq-IYxhByw"
+
+    # Rendered before the fps was known
+    output_folder, output_filename, _, _ = get_file_paths(video_id, 5.299, False)
+    os.makedirs(output_folder)
+    with open(output_filename, "wb") as file:
+        file.write(b"image")
+
+    with pytest.raises(FileNotFoundError):
+        await get_thumbnail_from_files(video_id, 5.28, False)
+
+    await async_redis.set(get_fps_key(video_id), 30)
+    thumbnail = await get_thumbnail_from_files(video_id, 5.28, False)
+    assert thumbnail.time == 5.299
+    assert thumbnail.image == b"image"
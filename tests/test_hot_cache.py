@@ -0,0 +1,104 @@
+import os
+import signal
+
+import pytest
+from tests.conftest import stored_video_id as video_id
+import utils.hot_cache as hot_cache
+from utils.hot_cache import SharedCache, key_length_format
+from utils.thumbnail import get_thumbnail_from_files
+
+def record_size(key: bytes, value: bytes) -> int:
+    return key_length_format.size + len(key) + len(value)
+
+def test_get_and_put():
+    cache = SharedCache(64 * 1024)
+    assert cache.get(b"a") is None
+
+    cache.put(b"a", b"first")
+    cache.put(b"b", b"second")
+    assert cache.get(b"a") == b"first"
+    assert cache.get(b"b") == b"second"
+
+    cache.put(b"a", b"replaced")
+    assert cache.get(b"a") == b"replaced"
+    assert cache.stats()[:2] == (3, 1)
+
+def test_oldest_overwritten_first():
+    cache = SharedCache(64 * 1024)
+    value = bytes(4000)
+    keys = [str(i).encode() for i in range(cache.ring_size // record_size(b"00", value) + 1)]
+    for key in keys:
+        cache.put(key, value)
+
+    assert cache.get(keys[0]) is None
+    assert all(cache.get(key) == value for key in keys[2:])
+
+def test_read_entries_kept():
+    cache = SharedCache(64 * 1024)
+    value = bytes(4000)
+    cache.put(b"popular", value)
+    for i in range(100):
+        cache.put(str(i).encode(), value)
+        assert cache.get(b"popular") == value
+
+def test_large_values_skipped():
+    cache = SharedCache(64 * 1024)
+    cache.put(b"large", bytes(cache.ring_size // 4))
+    assert cache.get(b"large") is None
+
+def test_shared_with_forked_processes():
+    cache = SharedCache(64 * 1024)
+    pid = os.fork()
+    if pid == 0:
+        cache.put(b"from child", b"value")
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert cache.get(b"from child") == b"value"
+
+def test_lock_of_killed_process(monkeypatch):
+    monkeypatch.setattr(hot_cache, "recover_timeout", 0.1)
+    cache = SharedCache(64 * 1024)
+    cache.put(b"a", b"value")
+    pid = os.fork()
+    if pid == 0:
+        cache.lock.acquire()
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    os.waitpid(pid, 0)
+    # Missed rather than waited on forever
+    assert cache.get(b"a") is None
+    cache.put(b"b", b"value")
+
+    cache.recover()
+    assert cache.get(b"a") is None
+    cache.put(b"a", b"value")
+    assert cache.get(b"a") == b"value"
+
+    # Left alone when nothing holds the lock
+    cache.recover()
+    assert cache.get(b"a") == b"value"
+
+@pytest.mark.asyncio
+async def test_thumbnail_from_hot_cache(stored_thumbnail: tuple[str, str], monkeypatch):
+    monkeypatch.setattr(hot_cache, "hot_cache", SharedCache(1024 * 1024))
+    output_filename, metadata_filename = stored_thumbnail
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False)
+
+    assert await get_thumbnail_from_files(video_id, 5.3, False) == thumbnail
+    assert hot_cache.hot_cache.stats()[0] == 1 # pyright: ignore
+
+    # Changed files are read again
+    with open(metadata_filename, "w") as file:
+        file.write("Title")
+    assert (await get_thumbnail_from_files(video_id, 5.3, False)).title == "Title"
+    assert (await get_thumbnail_from_files(video_id, 5.3, False)).title == "Title"
+    assert hot_cache.hot_cache.stats()[0] == 3 # pyright: ignore
+
+    with open(output_filename, "wb") as file:
+        file.write(b"new image")
+    assert (await get_thumbnail_from_files(video_id, 5.3, False)).image == b"new image"
+
+    os.remove(output_filename)
+    with pytest.raises(FileNotFoundError):
+        await get_thumbnail_from_files(video_id, 5.3, False)
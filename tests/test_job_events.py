@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import fakeredis
+import pytest
+import utils.job_events as job_events
+from rq.job import JobStatus
+from utils.job_events import parse_job_id, stream_job_events
+from utils.priority_queue import PriorityQueue
+from utils.redis_handler import reset_async_redis_conn, set_async_redis_conn
+from utils.thumbnail import get_job_id, get_render_job_id
+
+def job_function() -> None:
+    pass
+
+@pytest.fixture
+def async_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    connection = fakeredis.FakeStrictRedis(server=server)
+    monkeypatch.setattr(job_events, "queue_resolve", PriorityQueue("default", connection=connection))
+    monkeypatch.setattr(job_events, "queue_render", PriorityQueue("render", connection=connection))
+    monkeypatch.setattr(job_events, "subscribers", {})
+    monkeypatch.setattr(job_events, "pubsub", None)
+    monkeypatch.setattr(job_events, "listener", None)
+    monkeypatch.setattr(job_events, "subscription_lock", asyncio.Lock())
+
+    async_redis = fakeredis.aioredis.FakeRedis(server=server)
+    set_async_redis_conn(async_redis)
+    yield async_redis
+    reset_async_redis_conn()
+
+def test_parse_job_id():
+    assert parse_job_id(get_job_id("bdq-IYxhByw", 5.3)) == ("bdq-IYxhByw", 5.3)
+    assert parse_job_id(get_job_id("jNQXAC9IVRw", 0.0)) == ("jNQXAC9IVRw", 0.0)
+    assert parse_job_id("jNQXAC9IVRw-5.30") is None
+    assert parse_job_id("jNQXAC9IVRw") is None
+    assert parse_job_id("invalid-5.3") is None
+
+async def next_event(events) -> dict:
+    return json.loads((await asyncio.wait_for(anext(events), 5)).removeprefix("data: "))
+
+@pytest.mark.asyncio
+async def test_shared_subscription(async_redis):
+    first_job, second_job = get_job_id("jNQXAC9IVRw", 5.3), get_job_id("bdq-IYxhByw", 1.0)
+    first_client = stream_job_events([first_job, second_job])
+    second_client = stream_job_events([first_job])
+
+    first_event = asyncio.create_task(next_event(first_client))
+    second_event = asyncio.create_task(next_event(second_client))
+    while len(job_events.subscribers.get(first_job, ())) < 2:
+        await asyncio.sleep(0.01)
+
+    # One subscription for the process, with each job's channel subscribed once
+    assert job_events.pubsub is not None
+    assert set(job_events.pubsub.channels) == {first_job.encode(), second_job.encode()}
+
+    await async_redis.publish(first_job, "true")
+    assert await first_event == {"jobID": first_job, "ready": True}
+    assert await second_event == {"jobID": first_job, "ready": True}
+
+    # The second client is done, so only the first one is still waiting
+    with pytest.raises(StopAsyncIteration):
+        await anext(second_client)
+    assert set(job_events.subscribers.keys()) == {second_job}
+
+    # A publish for a job already reported is ignored
+    first_event = asyncio.create_task(next_event(first_client))
+    await async_redis.publish(first_job, "true")
+    await async_redis.publish(second_job, "false")
+    assert await first_event == {"jobID": second_job, "ready": False}
+
+    with pytest.raises(StopAsyncIteration):
+        await anext(first_client)
+    assert job_events.subscribers == {}
+    # The shared subscription stops being read once nobody is waiting
+    await asyncio.wait_for(job_events.listener, 5) # pyright: ignore
+
+@pytest.mark.asyncio
+async def test_jobs_ended_before_subscribing(async_redis):
+    queue_resolve, queue_render = job_events.queue_resolve, job_events.queue_render
+    failed_job, rendered_job, waiting_job = get_job_id("jNQXAC9IVRw", 1.0), get_job_id("jNQXAC9IVRw", 2.0), get_job_id("jNQXAC9IVRw", 3.0)
+
+    queue_resolve.enqueue(job_function, job_id=failed_job).set_status(JobStatus.FAILED)
+    queue_resolve.enqueue(job_function, job_id=rendered_job).set_status(JobStatus.FINISHED)
+    queue_render.enqueue(job_function, job_id=get_render_job_id("jNQXAC9IVRw", 2.0)).set_status(JobStatus.FINISHED)
+    queue_resolve.enqueue(job_function, job_id=waiting_job)
+
+    events = stream_job_events([failed_job, rendered_job, waiting_job])
+    assert {(event := await next_event(events))["jobID"]: event["ready"] for _ in range(2)} == {failed_job: False, rendered_job: True}
+
+    waiting_event = asyncio.create_task(next_event(events))
+    await asyncio.sleep(0.1)
+    await async_redis.publish(waiting_job, "true")
+    assert await waiting_event == {"jobID": waiting_job, "ready": True}
+    with pytest.raises(StopAsyncIteration):
+        await anext(events)
+    await asyncio.wait_for(job_events.listener, 5) # pyright: ignore
+
+@pytest.mark.asyncio
+async def test_keepalive(async_redis, monkeypatch):
+    monkeypatch.setattr(job_events, "keepalive_interval", 0.05)
+    job_id = get_job_id("jNQXAC9IVRw", 5.3)
+    events = stream_job_events([job_id])
+
+    # The wait times out without ending the stream
+    assert await asyncio.wait_for(anext(events), 5) == ": keepalive\n\n"
+    assert await asyncio.wait_for(anext(events), 5) == ": keepalive\n\n"
+
+    monkeypatch.setattr(job_events, "keepalive_interval", 15)
+    event = asyncio.create_task(next_event(events))
+    await asyncio.sleep(0.1)
+    await async_redis.publish(job_id, "true")
+    assert await event == {"jobID": job_id, "ready": True}
+    with pytest.raises(StopAsyncIteration):
+        await anext(events)
+    await asyncio.wait_for(job_events.listener, 5) # pyright: ignore
@@ -0,0 +1,65 @@
+import utils.metrics as metrics
+from utils.metrics import Counter, Histogram, RequestMetrics, render_app_metrics, write_app_metrics
+import utils.process_state as process_state
+
+
+def test_counter_render():
+    counter = Counter("test_total", "Test counter")
+    counter.inc(outcome="cache_hit")
+    counter.inc(outcome="cache_hit")
+    counter.inc(2.5, outcome="timeout")
+
+    assert counter.render() == [
+        "# HELP test_total Test counter",
+        "# TYPE test_total counter",
+        'test_total{outcome="cache_hit"} 2',
+        'test_total{outcome="timeout"} 2.5',
+    ]
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "Test histogram", (0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_seconds_count 3" in lines
+
+def test_request_metrics_records_once():
+    request_metrics = RequestMetrics(True, False)
+    request_metrics.record("timeout", True)
+    request_metrics.record("server_error")
+
+    lines = render_app_metrics()
+    labels = 'outcome="timeout",generate_now="true",is_livestream="false"'
+    assert f"dearrow_requests_total{{{labels}}} 1" in lines
+    assert f"dearrow_request_redirects_total{{{labels}}} 1" in lines
+    assert not any('outcome="server_error"' in line for line in lines)
+
+def test_metrics_of_all_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_state, "state_folder", str(tmp_path))
+    counter = Counter("test_total", "Test counter")
+    histogram = Histogram("test_seconds", "Test histogram", (0.1, 1))
+    monkeypatch.setattr(metrics, "app_metrics", [counter, histogram])
+
+    # Another process, which has since exited
+    counter.inc(outcome="cache_hit")
+    histogram.observe(0.05)
+    monkeypatch.setattr(process_state, "process_key", "1-1")
+    write_app_metrics()
+    counter.values.clear()
+    histogram.values.clear()
+
+    counter.inc(outcome="cache_hit")
+    counter.inc(outcome="timeout")
+    histogram.observe(0.5)
+    monkeypatch.setattr(process_state, "process_key", None)
+    lines = render_app_metrics()
+    assert 'test_total{outcome="cache_hit"} 2' in lines
+    assert 'test_total{outcome="timeout"} 1' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert "test_seconds_count 2" in lines
@@ -0,0 +1,72 @@
+import fakeredis
+import pytest
+import utils.floatie as floatie
+import utils.negative_cache as negative_cache
+import utils.video as video
+from utils.config import config
+from utils.floatie import InnertubeBotCheckError, InnertubeLoginRequiredError, InnertubePlayabilityError, is_bot_check
+from utils.redis_handler import reset_async_redis_conn, set_async_redis_conn
+from utils.thumbnail import PremiereError, ThumbnailGenerationError, get_failure_reason
+
+def test_failure_reason():
+    assert get_failure_reason(InnertubePlayabilityError("Not Playable: UNPLAYABLE")) == "unplayable"
+    assert get_failure_reason(PremiereError("Image file is too small")) == "premiere"
+    assert get_failure_reason(ThumbnailGenerationError("ffmpeg failed")) is None
+    assert get_failure_reason(ValueError("Failed to find playback URL")) is None
+
+    # Login required is only known from the cause once the yt-dlp fallback was not tried
+    try:
+        try:
+            raise InnertubeLoginRequiredError("Login required: This video is private")
+        except InnertubeLoginRequiredError as e:
+            raise ValueError("Failed to fetch playback URLs") from e
+    except ValueError as e:
+        assert get_failure_reason(e) == "login_required"
+
+    # Bot checks depend on the proxy and visitor data
+    assert get_failure_reason(InnertubeBotCheckError("Login required: Sign in to confirm you're not a bot")) is None
+
+def playback_urls_failure(monkeypatch, floatie_error: Exception, ytdlp_error: Exception | None) -> BaseException:
+    def fail(error: Exception):
+        def fetch(*_):
+            raise error
+
+        return fetch
+
+    monkeypatch.setitem(config, "try_floatie", True)
+    monkeypatch.setitem(config, "try_ytdlp", ytdlp_error is not None)
+    monkeypatch.setattr(floatie, "fetch_playback_urls", fail(floatie_error))
+    monkeypatch.setattr(video, "fetch_playback_urls_from_ytdlp", fail(ytdlp_error or ValueError()))
+
+    with pytest.raises(ValueError) as e:
+        video.get_playback_urls("jNQXAC9IVRw", None, False)
+    return e.value
+
+def test_failure_reason_of_fallback(monkeypatch):
+    # The reason comes from the error that decided the failure, not the one fallen back from
+    private = InnertubeLoginRequiredError("Login required: This video is private")
+    assert get_failure_reason(playback_urls_failure(monkeypatch, private, ValueError("yt-dlp failed"))) is None
+    assert get_failure_reason(playback_urls_failure(monkeypatch, private, None)) == "login_required"
+
+    bot_check = InnertubeBotCheckError("Login required: Sign in to confirm you're not a bot")
+    assert get_failure_reason(playback_urls_failure(monkeypatch, bot_check, None)) is None
+
+def test_bot_check():
+    assert is_bot_check("Sign in to confirm you’re not a bot")
+    assert not is_bot_check("Sign in to confirm your age")
+
+@pytest.mark.asyncio
+async def test_cached_failure(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(negative_cache, "redis_conn", fakeredis.FakeStrictRedis(server=server))
+    set_async_redis_conn(fakeredis.aioredis.FakeRedis(server=server))
+
+    try:
+        negative_cache.cache_failure("jNQXAC9IVRw", "premiere")
+        negative_cache.cache_failure("bdq-IYxhByw", "unknown")
+
+        assert await negative_cache.get_cached_failure("jNQXAC9IVRw") == "premiere"
+        assert await negative_cache.get_cached_failure("bdq-IYxhByw") is None
+        assert 0 < negative_cache.redis_conn.ttl(negative_cache.failure_key("jNQXAC9IVRw")) <= 10 * 60
+    finally:
+        reset_async_redis_conn()
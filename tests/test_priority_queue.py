@@ -0,0 +1,118 @@
+import fakeredis
+import pytest
+from rq.exceptions import DequeueTimeout
+from rq.job import Job
+from utils.config import config
+from utils.priority_queue import PriorityQueue, priority_score
+
+def job_function() -> None:
+    pass
+
+@pytest.fixture
+def queues():
+    connection = fakeredis.FakeStrictRedis()
+    return PriorityQueue("default", connection=connection), PriorityQueue("render", connection=connection)
+
+def enqueue(queue: PriorityQueue, job_id: str, score: float, at_front: bool = False):
+    return queue.enqueue(job_function, job_id=job_id, meta={"priority_score": score}, at_front=at_front)
+
+def dequeue_ids(queues: list[PriorityQueue]) -> list[str]:
+    job_ids = []
+    while (result := PriorityQueue.dequeue_any(queues, None, connection=queues[0].connection)) is not None:
+        job_ids.append(result[0].id)
+    return job_ids
+
+def test_highest_score_first(queues):
+    queue, _ = queues
+    enqueue(queue, "low", priority_score("low", 1000))
+    enqueue(queue, "high", priority_score("high", 1000))
+    enqueue(queue, "front", priority_score("low", 1000), at_front=True)
+
+    assert len(queue) == 3
+    assert queue.get_job_ids() == ["front", "high", "low"]
+    assert queue.get_job_position("low") == 2
+    assert dequeue_ids([queue]) == ["front", "high", "low"]
+    assert len(queue) == 0
+
+def test_aging():
+    # A low priority request that waited long enough goes ahead of a new high priority request
+    waited = (config["priority"]["scores"]["high"] - config["priority"]["scores"]["low"]) / config["priority"]["aging"]
+    assert priority_score("low", 1000) > priority_score("high", 1000 + waited + 1)
+    assert priority_score("low", 1000) < priority_score("high", 1000 + waited - 1)
+
+def test_boost(queues):
+    queue, _ = queues
+    enqueue(queue, "first", priority_score("low", 1000))
+    enqueue(queue, "popular", priority_score("low", 1001))
+
+    boost = config["priority"]["request_boost"]
+    assert queue.boost("popular", boost) == priority_score("low", 1001) + boost
+    assert queue.get_job_ids() == ["popular", "first"]
+
+    # Requesting with a higher priority raises the score to at least that priority
+    assert queue.boost("first", boost, priority_score("high", 1002)) == priority_score("high", 1002) + boost
+    assert queue.get_job_ids() == ["first", "popular"]
+
+    # Jobs that are not waiting anymore are not added back
+    assert dequeue_ids([queue]) == ["first", "popular"]
+    assert queue.boost("first", boost) is None
+    assert len(queue) == 0
+
+def test_dequeue_queue_order(queues):
+    queue, render_queue = queues
+    enqueue(queue, "resolve", priority_score("high", 1000))
+    enqueue(render_queue, "render", priority_score("low", 1000))
+
+    job, dequeued_queue = PriorityQueue.dequeue_any([render_queue, queue], None, connection=queue.connection)
+    assert job.id == "render"
+    assert dequeued_queue == render_queue
+    assert job.meta["priority_score"] == priority_score("low", 1000)
+    assert dequeue_ids([render_queue, queue]) == ["resolve"]
+
+def test_dequeue_timeout(queues):
+    queue, _ = queues
+    with pytest.raises(DequeueTimeout):
+        PriorityQueue.dequeue_any([queue], 1, connection=queue.connection)
+
+def test_remove_and_empty(queues):
+    queue, _ = queues
+    job = enqueue(queue, "removed", priority_score("low", 1000))
+    enqueue(queue, "emptied", priority_score("low", 1000))
+
+    queue.remove(job)
+    assert queue.get_job_ids() == ["emptied"]
+    assert queue.fetch_job("removed") is not None
+
+    assert queue.empty() == 1
+    assert len(queue) == 0
+    assert queue.fetch_job("emptied") is None
+
+def test_cancel_and_delete(queues):
+    queue, _ = queues
+    enqueue(queue, "cancelled", priority_score("low", 1000))
+    enqueue(queue, "deleted", priority_score("low", 1000))
+    enqueue(queue, "kept", priority_score("low", 1000))
+
+    queue.fetch_job("cancelled").cancel()
+    queue.fetch_job("deleted").delete()
+    assert queue.get_job_ids() == ["kept"]
+    assert queue.canceled_job_registry.get_job_ids() == ["cancelled"]
+
+def test_cancelled_jobs_are_not_run(queues):
+    queue, _ = queues
+    enqueue(queue, "cancelled", priority_score("high", 1000))
+    enqueue(queue, "kept", priority_score("low", 1000))
+
+    # Cancelled as a plain rq job, which leaves it in the sorted set
+    Job.fetch("cancelled", connection=queue.connection).cancel()
+    assert len(queue) == 2
+    assert dequeue_ids([queue]) == ["kept"]
+
+def test_count_ahead_of(queues):
+    queue, _ = queues
+    enqueue(queue, "high", priority_score("high"))
+    enqueue(queue, "low", priority_score("low"))
+    enqueue(queue, "front", priority_score("low"), at_front=True)
+
+    assert queue.count_ahead_of("high") == 2
+    assert queue.count_ahead_of("low") == 3
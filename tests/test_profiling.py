@@ -0,0 +1,34 @@
+import multiprocessing
+import threading
+import time
+
+from utils.profiling import RequestProfiling, SamplingProfiler
+
+
+def busy_wait(duration: float) -> None:
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        pass
+
+def test_sampling_profiler_finds_busy_function():
+    profiler = SamplingProfiler(threading.get_ident(), 0.001)
+    profiler.start()
+    busy_wait(0.2)
+    profiler.stop()
+
+    summary = profiler.summary(100)
+    assert summary["samples"] > 0
+    assert summary["top_self"][0][0].startswith("busy_wait ")
+    assert any("test_sampling_profiler_finds_busy_function" in name for name, _ in summary["top_cumulative"])
+
+def test_settings_shared_with_forked_processes():
+    settings = RequestProfiling(False, 1.0)
+
+    def toggle() -> None:
+        settings.enabled = True
+        settings.threshold = 0.5
+
+    process = multiprocessing.get_context("fork").Process(target=toggle)
+    process.start()
+    process.join()
+    assert (settings.enabled, settings.threshold) == (True, 0.5)
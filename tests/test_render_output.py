@@ -0,0 +1,62 @@
+import os
+import subprocess
+import time
+
+import fakeredis
+import pytest
+import utils.cleanup as cleanup
+import utils.thumbnail as thumbnail
+from utils.config import config
+from utils.thumbnail import PremiereError, ThumbnailGenerationError, decode_job_status, finish_thumbnail, get_file_paths, get_job_id, \
+    get_webp_width, run_ffmpeg_render
+
+video_id = "jNQXAC9IVRw"
+
+@pytest.fixture
+def redis(tmp_path, monkeypatch) -> fakeredis.FakeStrictRedis:
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+    os.makedirs(get_file_paths(video_id, 5.3, False)[0])
+
+    redis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(thumbnail, "redis_conn", redis)
+    monkeypatch.setattr(cleanup, "redis_conn", redis)
+    # Keeps the cleanup job from being queued
+    redis.set(cleanup.last_storage_check_key(), int(time.time()))
+    return redis
+
+def test_render_to_memory(tmp_path, ffmpeg_path: str):
+    video_filename = str(tmp_path / "video.mp4")
+    subprocess.run([ffmpeg_path, "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=640x360:duration=2",
+                    video_filename], check=True)
+
+    image_data = run_ffmpeg_render(video_filename, 1, [])
+    assert get_webp_width(image_data) == 640
+    assert os.listdir(tmp_path) == ["video.mp4"]
+
+def test_finish_thumbnail(redis: fakeredis.FakeStrictRedis, ffmpeg_path: str):
+    pubsub = redis.pubsub()
+    pubsub.subscribe(get_job_id(video_id, 5.3))
+    pubsub.get_message()
+
+    image_data = subprocess.run([ffmpeg_path, "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=640x360", "-vframes", "1",
+                                 "-f", "webp", "pipe:1"], check=True, stdout=subprocess.PIPE).stdout
+    finish_thumbnail(video_id, 5.3, None, False, False, image_data)
+
+    output_folder, output_filename, _, _ = get_file_paths(video_id, 5.3, False)
+    with open(output_filename, "rb") as file:
+        assert file.read() == image_data
+    assert os.listdir(output_folder) == [os.path.basename(output_filename)]
+
+    message = pubsub.get_message()
+    assert message is not None
+    status, finished_thumbnail = decode_job_status(message["data"])
+    assert status == "true"
+    assert finished_thumbnail is not None and finished_thumbnail.image == image_data
+
+def test_invalid_images_not_stored(redis: fakeredis.FakeStrictRedis):
+    with pytest.raises(PremiereError):
+        finish_thumbnail(video_id, 5.3, None, False, False, b"")
+    with pytest.raises(ThumbnailGenerationError):
+        finish_thumbnail(video_id, 5.3, None, False, False, bytes(1000))
+
+    assert os.listdir(get_file_paths(video_id, 5.3, False)[0]) == []
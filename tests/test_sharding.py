@@ -0,0 +1,176 @@
+import time
+
+import fakeredis
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from constants.thumbnail import minimum_file_size
+import utils.batch_lookup as batch_lookup
+import utils.cleanup as cleanup
+import utils.redis_handler as redis_handler
+import utils.sharding as sharding
+from utils.batch_lookup import BatchResult, enqueue_missing
+from utils.config import config
+from utils.priority_queue import PriorityQueue, priority_score
+from utils.redis_handler import fetch_job, reset_async_redis_conn, set_async_redis_conn, take_over_job
+from utils.sharding import HashRing, ShardNode, ShardRoutingMiddleware, announce_node, get_nodes, get_ring
+from utils.storage import get_storage
+from utils.thumbnail import get_job_id
+
+video_ids = [f"video{i:06}" for i in range(2000)]
+
+@pytest.fixture
+def sharding_config(monkeypatch):
+    monkeypatch.setitem(config["sharding"], "enabled", True)
+    monkeypatch.setitem(config["sharding"], "node_id", "node-a")
+    monkeypatch.setitem(config["sharding"], "url", "http://node-a")
+    monkeypatch.setattr(sharding, "ring", None)
+
+def set_ring(monkeypatch, nodes: list[ShardNode]) -> None:
+    monkeypatch.setattr(sharding, "ring", HashRing(nodes, config["sharding"]["virtual_nodes"]))
+    monkeypatch.setattr(sharding, "ring_read_at", time.monotonic())
+
+def node_answer(node_id: str):
+    async def answer(request: Request) -> Response:
+        return Response(f"{node_id} {request.query_params['videoID']}", headers={"ETag": '"1"'})
+
+    return Starlette(routes=[Route("/api/v1/getThumbnail", answer, methods=["GET", "HEAD"])])
+
+def find_video_of(ring: HashRing, node_id: str) -> str:
+    return next(video_id for video_id in video_ids if ring.get_node(video_id).node_id == node_id) # pyright: ignore
+
+def test_ring_moves_few_videos():
+    nodes = [ShardNode(f"node-{i}", f"http://node-{i}") for i in range(3)]
+    ring = HashRing(nodes, 64)
+    owners = {video_id: ring.get_node(video_id).node_id for video_id in video_ids} # pyright: ignore
+    for node in nodes:
+        assert list(owners.values()).count(node.node_id) > len(video_ids) / 6
+
+    # Only the videos taken by the new node move
+    new_ring = HashRing(nodes + [ShardNode("node-3", "http://node-3")], 64)
+    moved = [video_id for video_id in video_ids if new_ring.get_node(video_id).node_id != owners[video_id]] # pyright: ignore
+    assert all(new_ring.get_node(video_id).node_id == "node-3" for video_id in moved) # pyright: ignore
+    assert len(video_ids) / 8 < len(moved) < len(video_ids) / 3
+
+    assert HashRing([], 64).get_node(video_ids[0]) is None
+
+@pytest.mark.asyncio
+async def test_membership(sharding_config, monkeypatch):
+    redis = fakeredis.aioredis.FakeRedis()
+    set_async_redis_conn(redis)
+    await announce_node()
+    monkeypatch.setitem(config["sharding"], "node_id", "node-b")
+    monkeypatch.setitem(config["sharding"], "url", "http://node-b")
+    await announce_node()
+    assert await get_nodes() == [ShardNode("node-a", "http://node-a"), ShardNode("node-b", "http://node-b")]
+
+    # Nodes that stop announcing themselves leave the ring
+    await redis.zadd(sharding.shard_nodes_key(), {"node-a": time.time() - config["sharding"]["node_ttl"] - 1})
+    assert await get_nodes() == [ShardNode("node-b", "http://node-b")]
+
+    ring = await get_ring()
+    assert ring is not None and ring.get_node(video_ids[0]) == ShardNode("node-b", "http://node-b")
+    reset_async_redis_conn()
+
+@pytest.mark.asyncio
+async def test_routing(sharding_config, monkeypatch):
+    nodes = [ShardNode("node-a", "http://node-a"), ShardNode("node-b", "http://node-b")]
+    set_ring(monkeypatch, nodes)
+    local_video = find_video_of(sharding.ring, "node-a") # pyright: ignore
+    remote_video = find_video_of(sharding.ring, "node-b") # pyright: ignore
+    monkeypatch.setattr(sharding, "proxy_client", httpx.AsyncClient(transport=httpx.ASGITransport(node_answer("node-b"))))
+
+    transport = httpx.ASGITransport(ShardRoutingMiddleware(node_answer("node-a")))
+    async with httpx.AsyncClient(transport=transport, base_url="http://node-a") as client:
+        response = await client.get("/api/v1/getThumbnail", params={"videoID": local_video})
+        assert response.text == f"node-a {local_video}"
+
+        response = await client.get("/api/v1/getThumbnail", params={"videoID": remote_video})
+        assert (response.status_code, response.text, response.headers["ETag"]) == (200, f"node-b {remote_video}", '"1"')
+
+        # Requests sent on by another node are never sent on again
+        response = await client.get("/api/v1/getThumbnail", params={"videoID": remote_video}, headers={sharding.forwarded_header: "1"})
+        assert response.text == f"node-a {remote_video}"
+
+        monkeypatch.setitem(config["sharding"], "read_mode", "redirect")
+        response = await client.get("/api/v1/getThumbnail", params={"videoID": remote_video, "time": "5.3"})
+        assert response.status_code == 307
+        assert response.headers["Location"] == f"http://node-b/api/v1/getThumbnail?videoID={remote_video}&time=5.3"
+
+def test_enqueue_on_owner(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(batch_lookup, "get_shard_queues",
+                        lambda node_id: (PriorityQueue(f"default-{node_id}", connection=connection),
+                                         PriorityQueue(f"render-{node_id}", connection=connection)))
+    monkeypatch.setattr(batch_lookup, "queue_resolve", PriorityQueue("default", connection=connection))
+    monkeypatch.setattr(batch_lookup, "queue_render", PriorityQueue("render", connection=connection))
+
+    ring = HashRing([ShardNode("node-a", "http://node-a"), ShardNode("node-b", "http://node-b")], 64)
+    video_a = find_video_of(ring, "node-a")
+    video_b = find_video_of(ring, "node-b")
+    enqueue_missing([BatchResult(video_a, 1.0, False, False), BatchResult(video_b, 1.0, False, False)], ring)
+
+    assert PriorityQueue("default-node-a", connection=connection).get_job_ids() == [get_job_id(video_a, 1.0)]
+    assert PriorityQueue("default-node-b", connection=connection).get_job_ids() == [get_job_id(video_b, 1.0)]
+    assert len(batch_lookup.queue_resolve) == 0
+
+def job_function() -> None:
+    pass
+
+def test_take_over_job(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    old_queue = PriorityQueue("default-node-a", connection=connection)
+    monkeypatch.setattr(redis_handler, "queue_resolve", PriorityQueue("default-node-b", connection=connection))
+    monkeypatch.setattr(redis_handler, "queue_render", PriorityQueue("render-node-b", connection=connection))
+
+    # Left on the queue of the node the videos belonged to before the ring changed
+    score = priority_score("low", 1000)
+    old_queue.enqueue(job_function, job_id="waiting", meta={"priority_score": score})
+    old_queue.enqueue(job_function, job_id="started", meta={"priority_score": score})
+    assert redis_handler.queue_resolve.fetch_job("waiting") is None
+
+    job = take_over_job(fetch_job("waiting")) # pyright: ignore
+    assert job.origin == "default-node-b"
+    assert redis_handler.queue_resolve.get_job_ids() == ["waiting"]
+    assert redis_handler.queue_resolve.get_score("waiting") == score
+    # Taken over once
+    assert take_over_job(fetch_job("waiting")).origin == "default-node-b" # pyright: ignore
+    assert len(redis_handler.queue_resolve) == 1
+
+    # Jobs a worker of the old node took are waited for there
+    PriorityQueue.dequeue_any([old_queue], None, connection=connection)
+    assert take_over_job(fetch_job("started")).origin == "default-node-a" # pyright: ignore
+    assert len(redis_handler.queue_resolve) == 1
+
+def test_cleanup_of_each_node(sharding_config, tmp_path, monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(cleanup, "redis_conn", connection)
+    # Room for one image on each node
+    monkeypatch.setattr(cleanup, "target_storage_size", minimum_file_size)
+
+    def use_node(node_id: str) -> None:
+        monkeypatch.setitem(config["sharding"], "node_id", node_id)
+        monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path / node_id))
+
+    # Each node has the thumbnails of its own videos in local storage
+    for node_id, node_videos in (("node-a", ["videoA1", "videoA2"]), ("node-b", ["videoB1", "videoB2"])):
+        use_node(node_id)
+        for last_used, video_id in enumerate(node_videos):
+            get_storage().write(f"{video_id}/1.0.webp", bytes(minimum_file_size))
+            connection.zadd(cleanup.last_used_key(), {cleanup.last_used_element_key(video_id): last_used})
+
+    use_node("node-a")
+    cleanup.cleanup()
+    assert get_storage().list_folders() == ["videoA2"]
+    assert connection.zrange(cleanup.last_used_key(), 0, -1) == [b"videoA2"]
+    assert int(connection.get(cleanup.storage_used_key())) == minimum_file_size # pyright: ignore
+
+    # The other node's storage and its usage are left alone
+    use_node("node-b")
+    assert sorted(get_storage().list_folders()) == ["videoB1", "videoB2"]
+    assert connection.zrange(cleanup.last_used_key(), 0, -1) == [b"videoB1", b"videoB2"]
+    assert connection.get(cleanup.storage_used_key()) is None
+    assert cleanup.get_cleanup_job_id() == "cleanup-node-b"
@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import utils.ffmpeg as ffmpeg
+from utils.ffmpeg import FFmpegNotFoundError, get_ffmpeg_path, run_ffmpeg_output
+
+@pytest.mark.parametrize("module", ["app", "worker"])
+def test_ytdlp_not_imported(module: str):
+    # A fresh interpreter, as the tests import everything
+    subprocess.run([sys.executable, "-c", f"import sys, {module}; assert 'yt_dlp' not in sys.modules"], check=True,
+                   env=dict(os.environ, CONFIG_PATH="tests/test_config.yaml"))
+
+def test_ffmpeg_found_on_use(monkeypatch):
+    monkeypatch.setattr(ffmpeg, "ffmpeg_path", None)
+    monkeypatch.setenv("PATH", "")
+    with pytest.raises(FFmpegNotFoundError):
+        run_ffmpeg_output("-version")
+    with pytest.raises(FFmpegNotFoundError):
+        get_ffmpeg_path()
@@ -0,0 +1,229 @@
+from email.utils import formatdate
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+import fakeredis
+import pytest
+from utils.config import config
+from utils.redis_handler import reset_async_redis_conn, set_async_redis_conn
+import utils.storage as storage_module
+from utils.storage import CachedStorage, S3Storage, Storage, StoredFile, get_storage
+from utils.thumbnail import get_file_names, get_thumbnail_from_files
+
+video_id = "jNQXAC9IVRw"
+bucket = "thumbnails"
+# Small pages, so that listings have to be continued
+page_size = 2
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """
+    The parts of the S3 API the storage uses, over objects kept in memory
+    """
+    objects: dict[str, tuple[bytes, float]]
+    requests: list[tuple[str, str]]
+
+    def do_GET(self) -> None:
+        self.handle_request()
+
+    def do_HEAD(self) -> None:
+        self.handle_request()
+
+    def do_PUT(self) -> None:
+        self.handle_request()
+
+    def do_DELETE(self) -> None:
+        self.handle_request()
+
+    def handle_request(self) -> None:
+        url = urlparse(self.path)
+        key = unquote(url.path).removeprefix(f"/{bucket}").removeprefix("/")
+        self.requests.append((self.command, key))
+
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 Credential=access/") \
+                or self.headers.get("x-amz-content-sha256") != hashlib.sha256(data).hexdigest():
+            self.send_body(403, b"")
+        elif self.command == "PUT":
+            self.objects[key] = (data, time.time())
+            self.send_body(200, b"")
+        elif self.command == "DELETE":
+            self.objects.pop(key, None)
+            self.send_body(204, b"")
+        elif key == "":
+            self.send_body(200, self.list_objects(parse_qs(url.query)))
+        elif key not in self.objects:
+            self.send_body(404, b"")
+        else:
+            content, last_modified = self.objects[key]
+            self.send_body(200, content, {"Last-Modified": formatdate(last_modified, usegmt=True), "ETag": get_etag(content)})
+
+    def list_objects(self, query: dict[str, list[str]]) -> bytes:
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [None])[0]
+        start = query.get("continuation-token", [""])[0]
+
+        contents: list[str] = []
+        prefixes: list[str] = []
+        keys = sorted(key for key in self.objects if key.startswith(prefix) and key > start)
+        truncated = False
+        for index, key in enumerate(keys):
+            if delimiter is not None and delimiter in key.removeprefix(prefix):
+                common_prefix = prefix + key.removeprefix(prefix).split(delimiter)[0] + delimiter
+                if common_prefix not in prefixes:
+                    prefixes.append(common_prefix)
+                continue
+
+            content, last_modified = self.objects[key]
+            contents.append(f"<Contents><Key>{escape(key)}</Key><Size>{len(content)}</Size><ETag>{escape(get_etag(content))}</ETag>"
+                            f"<LastModified>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(last_modified))}</LastModified></Contents>")
+            if len(contents) == page_size:
+                truncated = index < len(keys) - 1
+                break
+
+        token = f"<NextContinuationToken>{escape(key)}</NextContinuationToken>" if truncated else ""
+        return (f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+                f"{token}{''.join(contents)}{''.join(f'<CommonPrefixes><Prefix>{escape(prefix)}</Prefix></CommonPrefixes>' for prefix in prefixes)}"
+                "</ListBucketResult>").encode()
+
+    def send_body(self, status: int, body: bytes, headers: dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, *_) -> None:
+        pass
+
+def get_etag(content: bytes) -> str:
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+@pytest.fixture
+def s3_server():
+    handler = type("Handler", (FakeS3Handler,), {"objects": {}, "requests": []})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}", handler
+    server.shutdown()
+    server.server_close()
+
+def create_s3_storage(endpoint: str) -> S3Storage:
+    return S3Storage(endpoint, bucket, "us-east-1", "access", "secret")
+
+def test_s3_storage(s3_server):
+    storage = create_s3_storage(s3_server[0])
+    with pytest.raises(FileNotFoundError):
+        storage.read(f"{video_id}/5.3.webp")
+
+    written = storage.write(f"{video_id}/5.3.webp", b"image")
+    storage.write(f"{video_id}/5.3.txt", b"Title")
+    storage.write(f"{video_id}/6.webp", b"other image")
+    storage.write("bdq-IYxhByw/1.0.webp", b"image")
+
+    assert storage.read(f"{video_id}/5.3.webp") == (b"image", written)
+    assert storage.read_start(f"{video_id}/5.3.webp", 3) == b"ima"
+    # Listings have more precision than headers, and must give the same validators
+    assert storage.stat(f"{video_id}/5.3.webp") == written
+    assert [entry.file for entry in storage.list_files(video_id, "5.3.webp")] == [written]
+    assert sorted(entry.name for entry in storage.list_files(video_id)) == ["5.3.txt", "5.3.webp", "6.webp"]
+    assert sorted(storage.list_folders()) == ["bdq-IYxhByw", video_id]
+
+    # Written again within the same second
+    rewritten = storage.write(f"{video_id}/5.3.webp", b"other")
+    assert rewritten != written
+    assert storage.stat(f"{video_id}/5.3.webp") == rewritten
+
+    storage.delete_folder(video_id)
+    assert storage.list_files(video_id) == []
+    assert not storage.exists(f"{video_id}/5.3.webp")
+    assert storage.list_folders() == ["bdq-IYxhByw"]
+
+def test_read_cache(s3_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_module, "remote_cache_ttl", 0.2)
+    endpoint, handler = s3_server
+    backend = create_s3_storage(endpoint)
+    storage = CachedStorage(backend, str(tmp_path), 3000)
+    written = backend.write(f"{video_id}/5.3.webp", bytes(1000))
+    backend.write(f"{video_id}/5.3.txt", b"Title")
+
+    handler.requests.clear()
+    assert storage.read(f"{video_id}/5.3.webp") == (bytes(1000), written)
+    assert storage.read(f"{video_id}/5.3.webp") == (bytes(1000), written)
+    assert storage.stat(f"{video_id}/5.3.webp") == written
+    assert handler.requests == [("GET", f"{video_id}/5.3.webp")]
+
+    # Titles and listings can change, so they are only kept for a moment
+    storage.read(f"{video_id}/5.3.txt")
+    assert storage.stat(f"{video_id}/5.3.txt") == storage.read(f"{video_id}/5.3.txt")[1]
+    assert not storage.exists(f"{video_id}/6.txt")
+    assert not storage.exists(f"{video_id}/6.txt")
+    storage.list_files(video_id, "5.3")
+    storage.list_files(video_id, "5.3")
+    assert handler.requests.count(("GET", f"{video_id}/5.3.txt")) == 1
+    assert handler.requests.count(("GET", f"{video_id}/6.txt")) == 1
+    assert handler.requests.count(("GET", "")) == 1
+
+    time.sleep(0.3)
+    storage.read(f"{video_id}/5.3.txt")
+    assert handler.requests.count(("GET", f"{video_id}/5.3.txt")) == 2
+
+    # Writes are seen right away by the node that made them
+    storage.write(f"{video_id}/5.3.txt", b"New title")
+    assert storage.read(f"{video_id}/5.3.txt")[0] == b"New title"
+    assert [entry.name for entry in storage.list_files(video_id, "5.3")] == ["5.3.txt", "5.3.webp"]
+    assert handler.requests.count(("GET", "")) == 2
+
+    # The least recently read copies are removed first
+    for i in range(3):
+        storage.write(f"{video_id}/{i}.0.webp", bytes(1000))
+        storage.read(f"{video_id}/5.3.webp")
+    assert storage.cache.exists(f"{video_id}/5.3.webp")
+    assert not storage.cache.exists(f"{video_id}/0.0.webp")
+    assert storage.get_cache_size() <= 3000
+
+@pytest.mark.asyncio
+async def test_thumbnail_from_s3(s3_server, tmp_path, monkeypatch):
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+    monkeypatch.setitem(config["thumbnail_storage"], "backend", "s3")
+    monkeypatch.setitem(config["thumbnail_storage"], "s3", {
+        "endpoint": s3_server[0],
+        "bucket": bucket,
+        "region": "us-east-1",
+        "access_key": "access",
+        "secret_key": "secret",
+    })
+    monkeypatch.setitem(config["thumbnail_storage"], "read_cache_path", str(tmp_path / "read-cache"))
+    set_async_redis_conn(fakeredis.aioredis.FakeRedis())
+
+    # Stored with more precision than asked for, found through a listing
+    _, image_name, metadata_name = get_file_names(video_id, 5.3004, False)
+    get_storage().write(image_name, b"image")
+    get_storage().write(metadata_name, b"Title")
+
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False)
+    assert (thumbnail.image, thumbnail.time, thumbnail.title) == (b"image", 5.3004, "Title")
+
+    # Found again from the read cache alone
+    handler = s3_server[1]
+    handler.requests.clear()
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3004, False)
+    assert (thumbnail.image, thumbnail.title) == (b"image", "Title")
+    assert handler.requests == []
+    reset_async_redis_conn()
+
+def test_incomplete_backend():
+    class ReadOnlyStorage(Storage):
+        def read(self, name: str) -> tuple[bytes, StoredFile]:
+            return b"", StoredFile(0, 0)
+
+    # Missing methods fail when the backend is made rather than when they are first called
+    with pytest.raises(TypeError):
+        ReadOnlyStorage()
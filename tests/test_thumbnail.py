@@ -6,11 +6,11 @@ from unittest.mock import patch
 
 from fastapi import Response
 import pytest
-from rq.worker import Worker
 from app import get_thumbnail
 from utils.cleanup import cleanup, last_used_element_key, last_used_key
 from utils.redis_handler import get_async_redis_conn, reset_async_redis_conn, redis_conn
 from utils.thumbnail import generate_thumbnail, get_file_paths
+from utils.worker_slots import ThumbnailWorker
 
 # Clear test cache folder
 if os.path.exists("test-cache"):
@@ -44,7 +44,7 @@ async def test_thumbnail_with_title():
 
 @pytest.mark.asyncio
 async def test_thumbnail_with_title_generate_now():
-    worker = Worker("high", connection=redis_conn)
+    worker = ThumbnailWorker(["default", "render"], connection=redis_conn)
     thread = Process(target=worker.work, args=(worker,))
     thread.start()
 
@@ -58,15 +58,15 @@ async def test_thumbnail_with_title_generate_now():
 
     thread.kill()
 
-def fake_folder_size(path: str, _ = False) -> tuple[int, int]:
-    if path == "test-cache":
-        return (100001, 1)
-    else:
-        return (100, 0)
+def fake_folder_size(_: str, __ = False) -> tuple[int, int]:
+    return (100, 0)
+
+def fake_storage_size(_ = False) -> tuple[int, int]:
+    return (100001, 1)
 
 @pytest.mark.asyncio
 async def test_cleanup():
-    with patch("utils.cleanup.get_folder_size", wraps=fake_folder_size):
+    with patch("utils.cleanup.get_folder_size", wraps=fake_folder_size), patch("utils.cleanup.get_storage_size", wraps=fake_storage_size):
         new_video_id = "bdq-IYxhByw"
         old_video_id = "jNQXAC9IVRw"
 
@@ -0,0 +1,93 @@
+import os
+import subprocess
+
+import pytest
+import utils.cleanup as cleanup
+import utils.ffmpeg as ffmpeg
+from utils.config import config
+from utils.storage import LocalStorage
+from utils.thumbnail import find_thumbnail_file, get_file_paths, get_latest_thumbnail_from_files, get_thumbnail_from_files, get_variant_filename, \
+    get_variant_width, get_webp_width, is_variant_file
+
+video_id = "jNQXAC9IVRw"
+
+@pytest.fixture
+def original(tmp_path, monkeypatch, async_redis, ffmpeg_path: str) -> str:
+    monkeypatch.setitem(config["thumbnail_storage"], "path", str(tmp_path))
+    monkeypatch.setitem(config, "thumbnail_variant_widths", [320, 640])
+
+    output_folder, output_filename, _, _ = get_file_paths(video_id, 5.3, False)
+    os.makedirs(output_folder)
+    subprocess.run([ffmpeg_path, "-y", "-v", "error", "-f", "lavfi", "-i", "testsrc2=size=1280x720",
+                    "-vframes", "1", "-lossless", "0", "-pix_fmt", "bgra", output_filename], check=True)
+
+    return output_filename
+
+def test_variant_width(monkeypatch):
+    monkeypatch.setitem(config, "thumbnail_variant_widths", [320, 640])
+    assert get_variant_width(100) == 320
+    assert get_variant_width(320) == 320
+    assert get_variant_width(321) == 640
+    assert get_variant_width(1280) is None
+
+def test_variant_file():
+    assert is_variant_file(os.path.basename(get_variant_filename("cache/jNQXAC9IVRw/5.3.webp", 320)))
+    assert is_variant_file("5.3-live-320w.webp")
+    assert not is_variant_file("5.3.webp")
+    assert not is_variant_file("5.3-live.webp")
+
+@pytest.mark.asyncio
+async def test_variant_made_once(original: str, async_redis):
+    with open(original, "rb") as file:
+        assert get_webp_width(file.read()) == 1280
+
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False, width=320)
+    assert get_webp_width(thumbnail.image) == 320
+    assert thumbnail.time == 5.3
+
+    variant_filename = get_variant_filename(original, 320)
+    assert os.path.getsize(variant_filename) == len(thumbnail.image)
+    assert int(await async_redis.get(cleanup.storage_used_key())) == len(thumbnail.image)
+
+    # Served from the stored variant afterwards
+    with open(variant_filename, "wb") as file:
+        file.write(b"stored variant")
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False, width=320)
+    assert thumbnail.image == b"stored variant"
+
+    # The variant is not mistaken for a thumbnail of its own
+    thumbnail = await get_latest_thumbnail_from_files(video_id, False)
+    assert thumbnail.time == 5.3
+    assert get_webp_width(thumbnail.image) == 1280
+
+@pytest.mark.asyncio
+async def test_original_when_not_smaller(original: str):
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False, width=1280)
+    assert get_webp_width(thumbnail.image) == 1280
+    assert not os.path.exists(get_variant_filename(original, 1280))
+
+@pytest.mark.asyncio
+async def test_original_without_ffmpeg(original: str, monkeypatch):
+    # Made with ffmpeg, which the app can run without
+    monkeypatch.setattr(ffmpeg, "ffmpeg_path", None)
+    monkeypatch.setenv("PATH", "")
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False, width=320)
+    assert get_webp_width(thumbnail.image) == 1280
+    assert not os.path.exists(get_variant_filename(original, 320))
+
+@pytest.mark.asyncio
+async def test_variant_validators(original: str, monkeypatch):
+    def read(*_):
+        raise AssertionError("Only the start of the original is read to find its width")
+
+    # Nothing to revalidate against before the variant is made
+    with monkeypatch.context() as patch:
+        patch.setattr(LocalStorage, "read", read)
+        thumbnail_file = await find_thumbnail_file(video_id, 5.3, False, 320)
+    assert thumbnail_file.etag is None
+
+    thumbnail = await get_thumbnail_from_files(video_id, 5.3, False, width=320)
+    thumbnail_file = await find_thumbnail_file(video_id, 5.3, False, 320)
+    assert thumbnail_file.etag == thumbnail.etag
+    assert thumbnail_file.size == len(thumbnail.image)
+    assert thumbnail_file.etag != (await find_thumbnail_file(video_id, 5.3, False)).etag
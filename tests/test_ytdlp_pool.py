@@ -0,0 +1,49 @@
+import pytest
+from utils.video import YtdlpPool, YtdlpRatelimitError, is_ratelimit_error
+
+def test_reused_by_proxy():
+    pool = YtdlpPool(4, 10)
+    with pool.use(None) as direct:
+        pass
+    with pool.use("http://proxy:8080") as proxied:
+        assert proxied is not direct
+        assert proxied.params["proxy"] == "http://proxy:8080"
+
+    with pool.use(None) as ydl:
+        assert ydl is direct
+
+        # Not shared while in use
+        with pool.use(None) as other:
+            assert other is not direct
+
+def test_recycled_after_max_uses():
+    pool = YtdlpPool(4, 2)
+    with pool.use(None) as first:
+        pass
+    with pool.use(None) as second:
+        assert second is first
+    with pool.use(None) as third:
+        assert third is not first
+
+def test_recycled_on_ratelimit():
+    pool = YtdlpPool(4, 10)
+    with pytest.raises(YtdlpRatelimitError):
+        with pool.use(None) as first:
+            raise YtdlpRatelimitError("HTTP Error 429: Too Many Requests")
+
+    with pool.use(None) as ydl:
+        assert ydl is not first
+
+def test_bounded():
+    pool = YtdlpPool(2, 10)
+    pool.warm(["http://a:1", "http://b:1", "http://c:1"])
+    assert [pooled.proxy_url for pooled in pool.idle] == ["http://a:1", "http://b:1"]
+
+    with pool.use("http://c:1"):
+        pass
+    assert [pooled.proxy_url for pooled in pool.idle] == ["http://b:1", "http://c:1"]
+
+def test_ratelimit_error():
+    assert is_ratelimit_error(Exception("ERROR: [youtube] abc: Sign in to confirm you’re not a bot"))
+    assert is_ratelimit_error(Exception("HTTP Error 429: Too Many Requests"))
+    assert not is_ratelimit_error(Exception("Video unavailable"))
@@ -0,0 +1,59 @@
+import atexit
+import os
+import threading
+import time as time_module
+from typing import TextIO
+
+from utils.config import config
+from utils.logger import log_error
+import utils.process_state as process_state
+
+flush_interval = 5
+
+trace_file: TextIO | None = None
+last_flush = 0.0
+trace_lock = threading.Lock()
+
+def get_trace_file() -> TextIO | None:
+    global trace_file
+    if trace_file is None and config["access_trace_path"] is not None:
+        path = get_trace_path(config["access_trace_path"])
+        trace_file = open(path, "a", buffering=1 << 16)
+        atexit.register(trace_file.close)
+
+    return trace_file
+
+def get_trace_path(path: str) -> str:
+    """
+    Every app process writes its own file when the path contains {pid}. With several app processes
+    the process ID is added to paths without it, as lines written by several processes would mix.
+    """
+    if "{pid}" not in path and process_state.state_folder is not None:
+        path += ".{pid}"
+
+    return path.format(pid=os.getpid())
+
+def record_access(video_id: str, time: float | None, hit: bool, size: int) -> None:
+    """
+    Appends one line of timestamp,videoID,time,hit,bytes to the access trace.
+
+    The time is left empty for requests without one, and bytes is zero for misses
+    since the size is not known yet.
+    """
+    global last_flush
+    if config["access_trace_path"] is None:
+        return
+
+    try:
+        with trace_lock:
+            file = get_trace_file()
+            if file is None:
+                return
+
+            now = time_module.time()
+            file.write(f"{now:.3f},{video_id},{time if time is not None else ''},{int(hit)},{size}\n")
+            if now - last_flush > flush_interval:
+                file.flush()
+                last_flush = now
+    except Exception as e:
+        log_error("Failed to record access", e)
@@ -0,0 +1,103 @@
+import asyncio
+from dataclasses import dataclass
+import math
+import statistics
+import threading
+import time
+
+from redis import Redis
+from rq.job import Job
+from rq.utils import as_text
+from rq.worker import Worker, WorkerStatus
+from utils.priority_queue import PriorityQueue
+
+# Seconds a request waits for its thumbnail before giving up
+wait_timeout = 15
+# How long a throughput estimate is used before it is measured again
+refresh_interval = 5
+# Finished jobs used to measure how long a job takes
+duration_samples = 50
+
+@dataclass
+class StageEstimate:
+    workers: int
+    # Median seconds per job, None when nothing has finished recently
+    job_duration: float | None
+
+    def wait(self, jobs_ahead: int) -> float | None:
+        """
+        Seconds until a job with jobs_ahead jobs in front of it has finished
+        """
+        if self.job_duration is None:
+            return None
+        if self.workers == 0:
+            return math.inf
+
+        # Jobs ahead are spread over the workers, and then this job runs itself
+        return (jobs_ahead // self.workers + 1) * self.job_duration
+
+@dataclass
+class ThroughputEstimate:
+    stages: dict[str, StageEstimate]
+    measured_at: float
+
+current_estimate: ThroughputEstimate | None = None
+estimate_lock = threading.Lock()
+
+def recent_job_duration(queue: PriorityQueue) -> float | None:
+    # Finished jobs are scored by when their result expires, so the highest scores finished last
+    job_ids = [as_text(job_id) for job_id in queue.connection.zrevrange(queue.finished_job_registry.key, 0, duration_samples - 1)]
+    durations = [(job.ended_at - job.started_at).total_seconds()
+                    for job in Job.fetch_many(job_ids, connection=queue.connection)
+                    if job is not None and job.started_at is not None and job.ended_at is not None]
+
+    # Median so that the occasional cleanup or stuck job does not skew it
+    return statistics.median(durations) if len(durations) > 0 else None
+
+def measure_throughput(connection: Redis, queues: list[PriorityQueue]) -> ThroughputEstimate:
+    workers = [worker for worker in Worker.all(connection=connection) if worker.get_state() != WorkerStatus.SUSPENDED]
+
+    return ThroughputEstimate({
+        queue.name: StageEstimate(
+            sum(1 for worker in workers if queue.name in worker.queue_names()),
+            recent_job_duration(queue)
+        ) for queue in queues
+    }, time.time())
+
+async def get_throughput_estimate(connection: Redis, queues: list[PriorityQueue]) -> ThroughputEstimate:
+    estimate = current_estimate
+    if estimate is not None and time.time() - estimate.measured_at <= refresh_interval:
+        return estimate
+
+    # Measuring reads every worker and recent job with the sync client, which would hold up the event loop
+    return await asyncio.to_thread(refresh_throughput_estimate, connection, queues)
+
+def refresh_throughput_estimate(connection: Redis, queues: list[PriorityQueue]) -> ThroughputEstimate:
+    global current_estimate
+    with estimate_lock:
+        # Requests waiting for the lock use the estimate measured while they waited
+        if current_estimate is None or time.time() - current_estimate.measured_at > refresh_interval:
+            current_estimate = measure_throughput(connection, queues)
+
+        return current_estimate
+
+async def estimate_ready_in(job: Job, queue_resolve: PriorityQueue, queue_render: PriorityQueue) -> float | None:
+    """
+    Seconds until the thumbnail of a resolve or render job is expected to be ready,
+    or None when there is not enough data to tell
+    """
+    estimate = await get_throughput_estimate(queue_resolve.connection, [queue_resolve, queue_render])
+    render_stage = estimate.stages[queue_render.name]
+
+    # A job that is not waiting anymore is running
+    if job.origin == queue_render.name:
+        return render_stage.wait(queue_render.get_job_position(job) or 0)
+
+    resolve_position = queue_resolve.get_job_position(job) or 0
+    resolve_wait = estimate.stages[queue_resolve.name].wait(resolve_position)
+    # Every job resolved before this one is also rendered before it
+    render_wait = render_stage.wait(len(queue_render) + resolve_position)
+    if resolve_wait is None or render_wait is None:
+        return None
+
+    return resolve_wait + render_wait
@@ -0,0 +1,95 @@
+"""
+Serves the app from several processes on the same port.
+
+Each process binds its own socket with SO_REUSEPORT, so the kernel spreads connections between
+them without a process in front. The supervisor loads the app and maps the hot cache before
+forking the processes, so that they share the cache and the memory of the loaded modules, and
+starts processes again when they exit. Metrics and request profiles are shared through a
+folder made for them (see utils/process_state.py), so that any process answers for all.
+"""
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Any
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+from utils.hot_cache import get_hot_cache
+from utils.logger import log_error
+from utils.metrics import start_sharing_app_metrics, write_app_metrics
+from utils.process_state import share_process_state
+
+# Seconds to wait before starting a process that exited, so that one failing at startup does not spin
+restart_delay = 1
+
+def run_app_processes(app: str, host: str, port: int, processes: int, log_level: str) -> None:
+    loaded_app = import_from_string(app)
+    hot_cache = get_hot_cache()
+    state_folder = tempfile.mkdtemp(prefix="dearrow-app-")
+    share_process_state(state_folder)
+
+    children: dict[int, int] = {}
+    stopping = False
+
+    def start(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                start_sharing_app_metrics()
+                serve(loaded_app, host, port, log_level)
+                write_app_metrics()
+                exit_code = 0
+            except Exception as e:
+                log_error(f"App process {index} failed", e)
+            finally:
+                os._exit(exit_code)
+
+        children[pid] = index
+
+    def stop(signum: int, _: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for index in range(processes):
+        start(index)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while len(children) > 0:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            index = children.pop(pid, None)
+            if hot_cache is not None:
+                # The process may have been killed while holding the lock of the cache
+                hot_cache.recover()
+            if index is not None and not stopping:
+                log_error(f"App process {index} ({pid}) exited with status {os.waitstatus_to_exitcode(status)}, starting it again")
+                time.sleep(restart_delay)
+                if not stopping:
+                    start(index)
+    finally:
+        shutil.rmtree(state_folder, ignore_errors=True)
+
+def serve(app: Any, host: str, port: int, log_level: str) -> None:
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+                                backlog=2048, reuse_port=True)
+    server = uvicorn.Server(uvicorn.Config(app, log_level=log_level))
+    server.run(sockets=[sock])
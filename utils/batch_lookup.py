@@ -0,0 +1,200 @@
+"""
+Looks up the thumbnails of many videos at once, for clients that show a whole page of videos.
+
+All the Redis keys a batch needs are read with one MGET, and the files of up to
+max_concurrent_lookups entries are checked at once off the event loop, so a batch takes
+about as long as a few getThumbnail requests. An entry that fails to be checked is reported
+on its own without failing the rest of the batch.
+"""
+
+import asyncio
+from dataclasses import dataclass
+
+from rq import Queue
+from rq.job import Job
+from utils.cleanup import update_last_used_many
+from utils.config import config
+from utils.logger import log_error
+from utils.negative_cache import failure_key, failure_messages
+from utils.priority_queue import priority_score
+from utils.redis_handler import get_async_redis_conn, get_shard_queues, queue_render, queue_resolve
+from utils.sharding import HashRing, get_ring
+from utils.storage import get_storage
+from utils.test_utils import in_test
+from utils.thumbnail import find_latest_stored_time, find_stored_time, find_stored_time_in_frame, get_best_time_key, get_file_names, \
+    get_fps_key, get_frame_index, get_frame_time, get_job_id, get_render_job_id, resolve_thumbnail
+
+max_batch_size = 100
+# Entries of a batch checked in storage at once
+max_concurrent_lookups = 16
+
+@dataclass
+class BatchEntry:
+    video_id: str
+    # None for the latest thumbnail of the video
+    time: float | None
+    is_livestream: bool = False
+
+@dataclass
+class BatchResult:
+    video_id: str
+    # Requested time moved to the start of its frame
+    time: float | None
+    is_livestream: bool
+    available: bool
+    timestamp: float | None = None
+    title: str | None = None
+    image: bytes | None = None
+    failure_reason: str | None = None
+    # A job for the thumbnail is waiting or running
+    queued: bool = False
+    # Reason a thumbnail can not be made for any time of the video, see negative_cache
+    cached_failure: str | None = None
+    # The storage could not be checked, so it is not known to be missing
+    lookup_failed: bool = False
+
+async def lookup_thumbnails(entries: list[BatchEntry], include_images: bool, generate_missing: bool) -> list[BatchResult]:
+    keys: list[str] = []
+    for entry in entries:
+        keys += [get_fps_key(entry.video_id), get_best_time_key(entry.video_id), failure_key(entry.video_id)]
+
+    async_redis = await get_async_redis_conn()
+    values: list[bytes | None] = await async_redis.mget(keys) # pyright: ignore
+
+    results = await find_thumbnails(entries, values, include_images)
+
+    try:
+        await update_last_used_many(list({result.video_id for result in results if result.available}))
+    except Exception as e:
+        log_error("Failed to update last used", e)
+
+    if generate_missing:
+        enqueue_missing(results, await get_ring())
+
+    return results
+
+async def find_thumbnails(entries: list[BatchEntry], values: list[bytes | None], include_images: bool) -> list[BatchResult]:
+    semaphore = asyncio.Semaphore(max_concurrent_lookups)
+
+    async def find(i: int, entry: BatchEntry) -> BatchResult:
+        fps_value, best_time, failure = values[i * 3:i * 3 + 3]
+        fps = float(fps_value) if fps_value is not None and float(fps_value) > 0 else None
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(find_thumbnail, entry, fps, best_time, failure.decode() if failure is not None else None,
+                                               include_images)
+            except Exception as e:
+                log_error(f"Failed to look up the thumbnail of {entry.video_id} at {entry.time}", e)
+                return BatchResult(entry.video_id, entry.time, entry.is_livestream, False, failure_reason="Server error", lookup_failed=True)
+
+    return await asyncio.gather(*(find(i, entry) for i, entry in enumerate(entries)))
+
+def find_thumbnail(entry: BatchEntry, fps: float | None, best_time: bytes | None, failure: str | None,
+                   include_images: bool) -> BatchResult:
+    storage = get_storage()
+    time = entry.time
+    if time is not None and fps is not None:
+        time = get_frame_time(get_frame_index(time, fps), fps)
+
+    try:
+        if time is None:
+            thumbnail_time = find_latest_stored_time(entry.video_id, best_time)
+        else:
+            thumbnail_time = find_stored_time(entry.video_id, time)
+            if fps is not None and not storage.exists(get_file_names(entry.video_id, thumbnail_time, entry.is_livestream)[1]):
+                thumbnail_time = find_stored_time_in_frame(entry.video_id, thumbnail_time, fps)
+
+        _, image_name, metadata_name = get_file_names(entry.video_id, thumbnail_time, entry.is_livestream)
+        image: bytes | None = None
+        if include_images:
+            image = storage.read(image_name)[0]
+            size = len(image)
+        else:
+            size = storage.stat(image_name).size
+
+        if size == 0:
+            raise FileNotFoundError(f"Image file for {entry.video_id} at {thumbnail_time} zero bytes")
+    except FileNotFoundError:
+        return BatchResult(entry.video_id, time, entry.is_livestream, False,
+                           failure_reason=failure_messages.get(failure, "Failed to generate thumbnail") if failure is not None
+                                            else "Thumbnail not cached",
+                           cached_failure=failure)
+
+    title: str | None = None
+    try:
+        title = storage.read(metadata_name)[0].decode()
+    except FileNotFoundError:
+        pass
+
+    return BatchResult(entry.video_id, time, entry.is_livestream, True, thumbnail_time, title, image)
+
+def enqueue_missing(results: list[BatchResult], current_ring: HashRing | None = None) -> None:
+    """
+    Adds jobs at low priority for the missing thumbnails, with one fetch of the existing
+    jobs and one pipeline for the new ones on each node's queue
+    """
+    missing: dict[str, list[BatchResult]] = {}
+    for result in results:
+        # Only thumbnails at a known time can be made
+        if not result.available and result.time is not None and result.cached_failure is None and not result.lookup_failed:
+            missing.setdefault(get_job_id(result.video_id, result.time), []).append(result)
+
+    if len(missing) == 0:
+        return
+
+    job_ids = list(missing.keys())
+    jobs = Job.fetch_many(job_ids, connection=queue_resolve.connection)
+
+    # The playback url has been resolved for finished jobs, follow them through the render stage
+    finished = [job_id for job_id, job in zip(job_ids, jobs) if job is not None and job.is_finished]
+    render_jobs = dict(zip(finished, Job.fetch_many([get_render_job_id(missing[job_id][0].video_id, missing[job_id][0].time) # pyright: ignore
+                                                      for job_id in finished], connection=queue_render.connection)))
+
+    to_enqueue: list[str] = []
+    for job_id, job in zip(job_ids, jobs):
+        if job is not None and job.is_finished:
+            job = render_jobs[job_id]
+
+        if job is None or job.is_finished:
+            to_enqueue.append(job_id)
+        elif job.is_failed:
+            set_missing_status(missing[job_id], False, "Failed to generate thumbnail")
+        else:
+            set_missing_status(missing[job_id], True, "Thumbnail not generated yet")
+
+    # With sharding each job goes to the queue of the node the video belongs to
+    by_owner: dict[str | None, list[str]] = {}
+    for job_id in to_enqueue:
+        owner = current_ring.get_node(missing[job_id][0].video_id) if current_ring is not None else None
+        by_owner.setdefault(owner.node_id if owner is not None else None, []).append(job_id)
+
+    for owner_id, job_ids in by_owner.items():
+        enqueue_resolve_jobs(missing, get_shard_queues(owner_id)[0] if owner_id is not None else queue_resolve, job_ids)
+
+def enqueue_resolve_jobs(missing: dict[str, list[BatchResult]], queue: Queue, to_enqueue: list[str]) -> None:
+    room = max(0, config["priority"]["max_queued"]["low"] - len(queue))
+    for job_id in to_enqueue[room:]:
+        set_missing_status(missing[job_id], False, "Failed to generate thumbnail due to queue being too big")
+
+    to_enqueue = to_enqueue[:room]
+    if len(to_enqueue) == 0:
+        return
+
+    queue.enqueue_many([
+        Queue.prepare_data(resolve_thumbnail,
+                           args=(missing[job_id][0].video_id, missing[job_id][0].time, None, missing[job_id][0].is_livestream,
+                                 not in_test()),
+                           job_id=job_id,
+                           timeout=30,
+                           failure_ttl=500,
+                           meta={"priority": "low", "priority_score": priority_score("low")})
+        for job_id in to_enqueue
+    ])
+
+    for job_id in to_enqueue:
+        set_missing_status(missing[job_id], True, "Thumbnail not generated yet")
+
+def set_missing_status(results: list[BatchResult], queued: bool, failure_reason: str) -> None:
+    for result in results:
+        result.queued = queued
+        result.failure_reason = failure_reason
@@ -1,14 +1,12 @@
-import os
-import shutil
 import time
 from typing import Tuple
 
 from retry import retry
 from utils.config import config
-from utils.redis_handler import get_async_redis_conn, redis_conn, queue_high
+from utils.redis_handler import fetch_job, get_async_redis_conn, redis_conn, queue_resolve
+from utils.storage import get_storage
 from constants.thumbnail import image_format, minimum_file_size
 
-folder_path = config['thumbnail_storage']['path']
 max_size = config['thumbnail_storage']['max_size']
 target_storage_size = int(max_size * config['thumbnail_storage']['cleanup_multiplier'])
 redis_offset_allowed = config["thumbnail_storage"]["redis_offset_allowed"]
@@ -21,7 +19,7 @@ def cleanup() -> None:
         cleanup_internal(storage_used)
 
     before_storage_used = int(redis_conn.get(storage_used_key()) or 0)
-    (folder_size, file_count) = get_folder_size(folder_path, True)
+    (folder_size, file_count) = get_storage_size(True)
     after_storage_used = int(redis_conn.get(storage_used_key()) or 0)
 
     diff = after_storage_used - before_storage_used
@@ -40,19 +38,18 @@ def cleanup_internal(folder_size: int, file_count: int | None = None) -> int:
     if folder_size > target_storage_size:
         if file_count is not None and file_count - get_size_of_last_used() > redis_offset_allowed:
             # Need to delete extra video's files
-            with os.scandir(folder_path) as it:
-                for entry in it:
-                    if entry.is_dir() and get_last_used_rank(entry.name) is None:
-                        storage_saved += get_folder_size(entry.path)[0]
-                        shutil.rmtree(entry.path)
-                    if folder_size - storage_saved <= target_storage_size:
-                        break
+            for folder in get_storage().list_folders():
+                if get_last_used_rank(folder) is None:
+                    storage_saved += get_folder_size(folder)[0]
+                    get_storage().delete_folder(folder)
+                if folder_size - storage_saved <= target_storage_size:
+                    break
 
         if folder_size - storage_saved > target_storage_size:
             # Now use redis to find the best options to delete
             while folder_size - storage_saved > target_storage_size:
                 video_id = get_oldest_video_id()
-                storage_saved += get_folder_size(os.path.join(folder_path, video_id))[0]
+                storage_saved += get_folder_size(video_id)[0]
                 delete_video(video_id)
 
     return storage_saved
@@ -65,34 +62,40 @@ def check_if_cleanup_needed() -> None:
     # If it has been 30 minutes, call cleanup anyway
     if storage_used > max_size or time.time() - last_storage_check > 30 * 60:
         job_id = get_cleanup_job_id()
-        existing_job = queue_high.fetch_job(job_id)
+        # Shared storage is cleaned up by one job, which can be on the queue of any node
+        existing_job = fetch_job(job_id)
 
         if existing_job is None or (existing_job.is_failed or existing_job.is_finished
                                     or existing_job.is_canceled or existing_job.is_deferred
                                     or existing_job.is_stopped):
             if existing_job is not None:
                 existing_job.delete()
-            queue_high.enqueue(cleanup, job_id=job_id, at_front=True, job_timeout="2h")
+            queue_resolve.enqueue(cleanup, job_id=job_id, at_front=True, job_timeout="2h")
 
 
-def get_folder_size(path: str, delete_small_images: bool = False) -> Tuple[int, int]:
+def get_storage_size(delete_small_images: bool = False) -> Tuple[int, int]:
     total = 0
     file_count = 0
-    try:
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.is_file():
-                    file_size = entry.stat().st_size
-                    if delete_small_images and entry.name.endswith(image_format) and file_size < minimum_file_size:
-                        # Image is probably corrupt
-                        os.remove(entry.path)
-                    else:
-                        total += file_size
-                elif entry.is_dir():
-                    total += get_folder_size(entry.path, delete_small_images)[0]
-                file_count += 1
-    except FileNotFoundError:
-        pass
+    for folder in get_storage().list_folders():
+        total += get_folder_size(folder, delete_small_images)[0]
+        file_count += 1
+
+    return (total, file_count)
+
+def get_folder_size(folder: str, delete_small_images: bool = False) -> Tuple[int, int]:
+    storage = get_storage()
+    total = 0
+    file_count = 0
+    for entry in storage.list_files(folder):
+        if delete_small_images and entry.name.endswith(image_format) and entry.file.size < minimum_file_size:
+            # Image is probably corrupt
+            try:
+                storage.remove(f"{folder}/{entry.name}")
+            except FileNotFoundError:
+                pass
+        else:
+            total += entry.file.size
+        file_count += 1
 
     return (total, file_count)
 
@@ -112,7 +115,7 @@ def get_size_of_last_used() -> int:
 def delete_video(video_id: str) -> None:
     redis_conn.zrem(last_used_key(), last_used_element_key(video_id))
     try:
-        shutil.rmtree(os.path.join(folder_path, video_id))
+        get_storage().delete_folder(video_id)
     except FileNotFoundError:
         print(f"Could not find folder for video {video_id}")
 
@@ -122,21 +125,41 @@ async def update_last_used(video_id: str) -> None:
         last_used_element_key(video_id): int(time.time())
     })
 
+@retry(tries=5, delay=0.1, backoff=3)
+async def update_last_used_many(video_ids: list[str]) -> None:
+    if len(video_ids) == 0:
+        return
+
+    now = int(time.time())
+    await (await get_async_redis_conn()).zadd(name=last_used_key(), mapping={
+        last_used_element_key(video_id): now for video_id in video_ids
+    })
+
 @retry(tries=5, delay=0.1, backoff=3)
 async def add_storage_used(size: int) -> None:
     await (await get_async_redis_conn()).incrby(storage_used_key(), size)
 
+def get_storage_key_suffix() -> str:
+    """
+    With sharding on local storage each node only has the thumbnails of its own videos, so the
+    usage and cleanup of each node's storage is kept apart. S3 storage is shared by all nodes.
+    """
+    if config["sharding"]["enabled"] and config["thumbnail_storage"]["backend"] != "s3":
+        return f"-{config['sharding']['node_id']}"
+
+    return ""
+
 def last_used_key() -> str:
-    return "last-used"
+    return f"last-used{get_storage_key_suffix()}"
 
 def last_used_element_key(video_id: str) -> str:
     return video_id
 
 def storage_used_key() -> str:
-    return "storage-used"
+    return f"storage-used{get_storage_key_suffix()}"
 
 def last_storage_check_key() -> str:
-    return "last-storage-check"
+    return f"last-storage-check{get_storage_key_suffix()}"
 
 def get_cleanup_job_id() -> str:
-    return "cleanup"
+    return f"cleanup{get_storage_key_suffix()}"
@@ -1,3 +1,5 @@
+import os
+import socket
 import yaml
 from typing import TypedDict
 
@@ -9,13 +11,28 @@ class ServerSettings(TypedDict):
     worker_health_check_port: int
     reload: bool
 
+class S3StorageConfig(TypedDict):
+    # Like https://s3.us-east-1.amazonaws.com or http://minio:9000, buckets are addressed by path
+    endpoint: str
+    bucket: str
+    region: str
+    access_key: str
+    secret_key: str
+
 class ThumbnailStorage(TypedDict):
+    # Folder of the thumbnails with the local backend, and of videos being rendered with any backend
     path: str
     max_size: int
     cleanup_multiplier: float
     redis_offset_allowed: int
     max_before_async_generation: int
     max_queue_size: int
+    # "local" or "s3", see utils/storage.py
+    backend: str
+    s3: S3StorageConfig | None
+    # Local copies of images read from the s3 backend, up to read_cache_size bytes, 0 to disable
+    read_cache_path: str
+    read_cache_size: int
 
 class RedisConfig(TypedDict):
     host: str
@@ -29,11 +46,60 @@ class ProxyInfoConfig(TypedDict):
 class YTAuth(TypedDict):
     visitorData: str
 
+class ProfilingConfig(TypedDict):
+    enabled: bool
+    # Seconds of wall time after which a job or request is considered slow
+    job_threshold: float
+    request_threshold: float
+    interval: float
+    top: int
+    max_request_profiles: int
+
+class PriorityConfig(TypedDict):
+    # Score of a new job for each kind of request: low, high (generateNow) and front (front_auth)
+    scores: dict[str, float]
+    # Added each time a waiting thumbnail is requested again
+    request_boost: float
+    # Score gained per second of waiting, so that low priority jobs are not starved
+    aging: float
+    # New jobs of each kind are refused once this many jobs are waiting
+    max_queued: dict[str, int]
+
+class FormatSelectionConfig(TypedDict):
+    # Formats at least this tall are preferred, even when a shorter one is cheaper
+    target_height: int
+    # Seconds to decode a keyframe group at 1280x720 per codec, until render times have been measured
+    codec_costs: dict[str, float]
+    # Seconds of video downloaded per render and the bytes per second they are downloaded at
+    keyframe_interval: float
+    bandwidth: float
+
+class ShardingConfig(TypedDict):
+    enabled: bool
+    # This node, and the base URL the app nodes reach its app at
+    node_id: str
+    url: str
+    # Points of each node on the hash ring, more spread videos more evenly between nodes
+    virtual_nodes: int
+    # Seconds between announcements of this node, and after the last one until it is dropped
+    heartbeat_interval: float
+    node_ttl: float
+    # "redirect" sends clients to the node a video belongs to, "proxy" fetches from it for them
+    read_mode: str
+
 class Config(TypedDict):
     server: ServerSettings
     thumbnail_storage: ThumbnailStorage
     redis: RedisConfig
     default_max_height: int
+    # Widths thumbnails can be asked for at, each made once from the original when first asked for
+    thumbnail_variant_widths: list[int]
+    # Largest image in bytes sent with the completion message to the requests waiting for it
+    completion_image_max_size: int
+    # App processes serving on the same port, see utils/app_processes.py
+    app_processes: int
+    # Bytes of memory shared by the app processes for recently served thumbnails, 0 to disable
+    hot_cache_size: int
     status_auth_password: str
     yt_auth: YTAuth
     try_floatie: bool
@@ -41,18 +107,129 @@ class Config(TypedDict):
     try_ytdlp: bool
     skip_local_ffmpeg: bool
     max_concurrent_renders: int
+    # Download only the keyframe group with the frame instead of letting ffmpeg seek the whole video
+    range_rendering: bool
     max_concurrent_ytdlp: int
+    # Idle YoutubeDL objects kept for reuse, and how many extractions each is used for
+    ytdlp_pool_size: int
+    ytdlp_max_uses: int
+    # Jobs run at the same time by one worker process
+    worker_concurrency: int
+    # Queues a worker listens on by default: resolve, render or all
+    worker_stage: str
     proxy_url: str | None
     proxy_urls: list[ProxyInfoConfig] | None
     proxy_token: str | None
     front_auth: str | None
     floatie_auth: str | None
+    # Seconds visitor data from the watch page is used for, per proxy
+    floatie_visitor_data_ttl: int
+    youtube_url: str
+    access_trace_path: str | None
+    # Seconds to answer requests for a video from its last failure instead of trying again, by reason
+    negative_cache_ttls: dict[str, int]
+    profiling: ProfilingConfig
+    priority: PriorityConfig
+    format_selection: FormatSelectionConfig
+    # Routes each video to one node, see utils/sharding.py
+    sharding: ShardingConfig
     debug: bool
 
 
-config: Config = yaml.safe_load(open("config.yaml" if not in_test() else "tests/test_config.yaml"))
+def get_config_path() -> str:
+    if in_test():
+        return "tests/test_config.yaml"
+
+    # Lets benchmarks and local harnesses run against their own config file
+    return os.environ.get("CONFIG_PATH", "config.yaml")
+
+config: Config = yaml.safe_load(open(get_config_path()))
 
 if "proxy_url" not in config:
     config["proxy_url"] = None
 if "proxy_token" not in config:
     config["proxy_token"] = None
+if "worker_concurrency" not in config:
+    config["worker_concurrency"] = 1
+if "ytdlp_pool_size" not in config:
+    config["ytdlp_pool_size"] = 8
+if "ytdlp_max_uses" not in config:
+    config["ytdlp_max_uses"] = 100
+if "backend" not in config["thumbnail_storage"]:
+    config["thumbnail_storage"]["backend"] = "local"
+if "s3" not in config["thumbnail_storage"]:
+    config["thumbnail_storage"]["s3"] = None
+if "read_cache_path" not in config["thumbnail_storage"]:
+    config["thumbnail_storage"]["read_cache_path"] = "read-cache"
+if "read_cache_size" not in config["thumbnail_storage"]:
+    config["thumbnail_storage"]["read_cache_size"] = 1024 * 1024 * 1024
+if "thumbnail_variant_widths" not in config:
+    config["thumbnail_variant_widths"] = [320, 640]
+if "completion_image_max_size" not in config:
+    config["completion_image_max_size"] = 128 * 1024
+if "app_processes" not in config:
+    config["app_processes"] = 1
+if "hot_cache_size" not in config:
+    config["hot_cache_size"] = 64 * 1024 * 1024
+if "range_rendering" not in config:
+    config["range_rendering"] = True
+if "worker_stage" not in config:
+    config["worker_stage"] = "all"
+if "floatie_visitor_data_ttl" not in config:
+    config["floatie_visitor_data_ttl"] = 60 * 60
+if "youtube_url" not in config:
+    config["youtube_url"] = "https://www.youtube.com"
+if "access_trace_path" not in config:
+    config["access_trace_path"] = None
+if "negative_cache_ttls" not in config:
+    config["negative_cache_ttls"] = {
+        "unplayable": 6 * 60 * 60,
+        "login_required": 60 * 60,
+        "premiere": 10 * 60,
+    }
+if "profiling" not in config:
+    config["profiling"] = {
+        "enabled": False,
+        "job_threshold": 10,
+        "request_threshold": 2,
+        "interval": 0.01,
+        "top": 15,
+        "max_request_profiles": 20,
+    }
+if "format_selection" not in config:
+    config["format_selection"] = {
+        "target_height": config["default_max_height"],
+        "codec_costs": {
+            "h264": 0.15,
+            "vp9": 0.25,
+            "h265": 0.3,
+            "av1": 0.6,
+        },
+        "keyframe_interval": 5,
+        "bandwidth": 12_500_000,
+    }
+if "sharding" not in config:
+    config["sharding"] = {
+        "enabled": False,
+        "node_id": socket.gethostname(),
+        "url": f"http://{config['server']['host']}:{config['server']['port']}",
+        "virtual_nodes": 64,
+        "heartbeat_interval": 10,
+        "node_ttl": 30,
+        "read_mode": "proxy",
+    }
+if "priority" not in config:
+    config["priority"] = {
+        "scores": {
+            "low": 0,
+            "high": 60,
+            "front": 1_000_000,
+        },
+        "request_boost": 5,
+        "aging": 1,
+        "max_queued": {
+            "low": config["thumbnail_storage"]["max_queue_size"],
+            "high": config["thumbnail_storage"]["max_queue_size"] * 2,
+            "front": config["thumbnail_storage"]["max_queue_size"] * 2,
+        },
+    }
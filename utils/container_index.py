@@ -0,0 +1,350 @@
+"""
+Finds the bytes needed to decode one frame of a DASH stream.
+
+YouTube serves adaptive streams either as fragmented MP4 (ftyp, moov, sidx, then moof/mdat
+pairs) or as WebM with the Cues before the first Cluster. Both start with an index of where
+every keyframe group starts, so only the header, the index and one group have to be downloaded.
+
+The group is decoded from a file with just the init segment in front of it. Fragments and
+clusters carry absolute timestamps, so the file starts at the time of the group.
+"""
+
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Callable
+
+# Bytes fetched before anything is known about the stream, enough for the index of most videos
+initial_fetch_size = 32 * 1024
+
+# Fetches [start, end) of the stream, returning less only at the end of the file
+Fetch = Callable[[int, int], bytes]
+
+ebml_header_id = 0x1A45DFA3
+segment_id = 0x18538067
+seek_head_id = 0x114D9B74
+seek_id = 0x4DBB
+seek_element_id = 0x53AB
+seek_position_id = 0x53AC
+info_id = 0x1549A966
+timecode_scale_id = 0x2AD7B1
+cues_id = 0x1C53BB6B
+cue_point_id = 0xBB
+cue_time_id = 0xB3
+cue_track_positions_id = 0xB7
+cue_cluster_position_id = 0xF1
+cluster_id = 0x1F43B675
+void_id = 0xEC
+
+class ContainerIndexError(Exception):
+    pass
+
+@dataclass
+class Segment:
+    # Presentation time of the first frame in seconds
+    time: float
+    start: int
+    end: int
+
+@dataclass
+class ContainerIndex:
+    # Header a decoder needs in front of any segment, with the index left out since
+    # its offsets are wrong once segments are moved
+    init: bytes
+    segments: list[Segment]
+
+    def find_segment(self, frame_time: float, frame_duration: float) -> Segment:
+        """
+        Finds the keyframe group the frame shown at this time is in
+        """
+        times = [segment.time for segment in self.segments]
+        # Allow for the rounding of frame times in either direction
+        return self.segments[max(0, bisect_right(times, frame_time + frame_duration / 2) - 1)]
+
+class RangeReader:
+    """
+    Keeps every range fetched so the index and the frame data are only downloaded once
+    """
+
+    def __init__(self, fetch: Fetch):
+        self.fetch = fetch
+        # Start offset to contiguous data, merged when fetches touch
+        self.chunks: dict[int, bytes] = {}
+
+    def read(self, start: int, end: int) -> bytes:
+        for chunk_start, chunk in self.chunks.items():
+            chunk_end = chunk_start + len(chunk)
+            if chunk_start <= start <= chunk_end:
+                if end > chunk_end:
+                    chunk += self.fetch(chunk_end, end)
+                    self.chunks[chunk_start] = chunk
+
+                return chunk[start - chunk_start:end - chunk_start]
+
+        data = self.fetch(start, end)
+        self.chunks[start] = data
+        return data
+
+def write_segment_file(reader: RangeReader, index: ContainerIndex, frame_time: float, fps: float, filename: str) -> float:
+    """
+    Downloads the keyframe group with the frame and writes it after the init segment.
+
+    Returns the time to seek to in the written file, which starts at the time of the group.
+    """
+    segment = index.find_segment(frame_time, 1 / fps)
+    data = read_exactly(reader, segment.start, segment.end)
+    with open(filename, "wb") as file:
+        file.write(index.init)
+        file.write(data)
+
+    # Half a frame early so the frame is the first one at or after the seek time even with rounding
+    return max(0, frame_time - segment.time - 0.5 / fps)
+
+def read_index(reader: RangeReader) -> ContainerIndex:
+    header = reader.read(0, initial_fetch_size)
+    if header[4:8] == b"ftyp":
+        return read_mp4_index(reader)
+    elif header[:4] == ebml_header_id.to_bytes(4, "big"):
+        return read_webm_index(reader)
+    else:
+        raise ContainerIndexError("Unknown container")
+
+def read_exactly(reader: RangeReader, start: int, end: int) -> bytes:
+    data = reader.read(start, end)
+    if len(data) < end - start:
+        raise ContainerIndexError(f"Stream ended at {start + len(data)} before {end}")
+
+    return data
+
+def read_mp4_index(reader: RangeReader) -> ContainerIndex:
+    init_end: int | None = None
+    position = 0
+    while True:
+        box_header = read_exactly(reader, position, position + 16)
+        box_size = int.from_bytes(box_header[0:4], "big")
+        box_type = box_header[4:8]
+        header_size = 8
+        if box_size == 1:
+            box_size = int.from_bytes(box_header[8:16], "big")
+            header_size = 16
+        if box_size < header_size:
+            raise ContainerIndexError(f"Invalid {box_type!r} box size {box_size}")
+
+        if box_type == b"moov":
+            init_end = position + box_size
+        elif box_type == b"sidx":
+            if init_end is None:
+                raise ContainerIndexError("No moov box before the sidx box")
+
+            box = read_exactly(reader, position + header_size, position + box_size)
+            return ContainerIndex(read_exactly(reader, 0, init_end), parse_sidx(box, position + box_size))
+        elif box_type in (b"moof", b"mdat"):
+            raise ContainerIndexError("No sidx box before the media data")
+
+        position += box_size
+
+def parse_sidx(box: bytes, end_of_box: int) -> list[Segment]:
+    version = box[0]
+    timescale = int.from_bytes(box[8:12], "big")
+    if version == 0:
+        earliest_time = int.from_bytes(box[12:16], "big")
+        first_offset = int.from_bytes(box[16:20], "big")
+        position = 20
+    else:
+        earliest_time = int.from_bytes(box[12:20], "big")
+        first_offset = int.from_bytes(box[20:28], "big")
+        position = 28
+
+    reference_count = int.from_bytes(box[position + 2:position + 4], "big")
+    position += 4
+
+    segments: list[Segment] = []
+    offset = end_of_box + first_offset
+    presentation_time = earliest_time
+    for _ in range(reference_count):
+        reference = int.from_bytes(box[position:position + 4], "big")
+        duration = int.from_bytes(box[position + 4:position + 8], "big")
+        position += 12
+
+        if reference >> 31 == 1:
+            raise ContainerIndexError("Hierarchical sidx boxes are not supported")
+
+        size = reference & 0x7FFFFFFF
+        segments.append(Segment(presentation_time / timescale, offset, offset + size))
+        offset += size
+        presentation_time += duration
+
+    if len(segments) == 0:
+        raise ContainerIndexError("Empty sidx box")
+
+    return segments
+
+def read_vint(data: bytes, position: int, keep_marker: bool = False) -> tuple[int, int]:
+    """
+    Reads an EBML variable size integer, returning the value and its length
+    """
+    if position >= len(data) or data[position] == 0:
+        raise ContainerIndexError(f"Invalid EBML integer at {position}")
+
+    length = 9 - data[position].bit_length()
+    value = int.from_bytes(data[position:position + length], "big")
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+
+    return value, length
+
+def read_element_header(data: bytes, position: int) -> tuple[int, int, int | None]:
+    """
+    Returns the element id, the length of the header and the size of the data (None if unknown)
+    """
+    element_id, id_length = read_vint(data, position, keep_marker=True)
+    size, size_length = read_vint(data, position + id_length)
+    if size == (1 << (7 * size_length)) - 1:
+        return element_id, id_length + size_length, None
+
+    return element_id, id_length + size_length, size
+
+def iterate_elements(data: bytes, start: int, end: int):
+    position = start
+    while position < end:
+        element_id, header_length, size = read_element_header(data, position)
+        if size is None:
+            raise ContainerIndexError(f"Unknown size for element {element_id:X}")
+
+        data_start = position + header_length
+        yield element_id, data_start, data_start + size
+        position = data_start + size
+
+def read_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+def read_webm_index(reader: RangeReader) -> ContainerIndex:
+    header = read_exactly(reader, 0, 12)
+    _, header_length, size = read_element_header(header, 0)
+    if size is None:
+        raise ContainerIndexError("Unknown EBML header size")
+
+    position = header_length + size
+    segment_header = read_exactly(reader, position, position + 12)
+    element_id, header_length, segment_size = read_element_header(segment_header, 0)
+    if element_id != segment_id:
+        raise ContainerIndexError("No Segment after the EBML header")
+
+    segment_start = position + header_length
+    segment_end = segment_start + segment_size if segment_size is not None else None
+
+    timecode_scale = 1_000_000
+    cues_position: int | None = None
+    cues: tuple[bytes, int, int] | None = None
+    # Elements with offsets that are wrong once the clusters are moved
+    void_ranges: list[tuple[int, int]] = []
+    position = segment_start
+    while True:
+        element_header = read_exactly(reader, position, position + 12)
+        element_id, header_length, size = read_element_header(element_header, 0)
+        if element_id == cluster_id:
+            first_cluster = position
+            break
+        elif size is None:
+            raise ContainerIndexError(f"Unknown size for element {element_id:X}")
+
+        data_end = position + header_length + size
+        if element_id in (seek_head_id, cues_id):
+            void_ranges.append((position, data_end))
+        if element_id in (seek_head_id, info_id, cues_id):
+            element = read_exactly(reader, 0, data_end)
+            if element_id == seek_head_id:
+                cues_position = find_cues_position(element, position + header_length, data_end, segment_start)
+            elif element_id == info_id:
+                for child_id, child_start, child_end in iterate_elements(element, position + header_length, data_end):
+                    if child_id == timecode_scale_id:
+                        timecode_scale = read_uint(element, child_start, child_end)
+            else:
+                cues = (element, position + header_length, data_end)
+
+        position = data_end
+
+    init = bytearray(read_exactly(reader, 0, first_cluster))
+    for start, end in void_ranges:
+        write_void(init, start, end)
+
+    # Clusters end where the Cues start when they are written after them
+    clusters_end = segment_end
+    if cues is None:
+        if cues_position is None:
+            raise ContainerIndexError("No Cues in the stream")
+
+        cues_header = read_exactly(reader, cues_position, cues_position + 12)
+        element_id, header_length, size = read_element_header(cues_header, 0)
+        if element_id != cues_id or size is None:
+            raise ContainerIndexError("SeekHead does not point to the Cues")
+
+        cues_end = cues_position + header_length + size
+        cues = (read_exactly(reader, cues_position, cues_end), header_length, header_length + size)
+        if cues_position > first_cluster:
+            clusters_end = cues_position
+
+    if clusters_end is None:
+        raise ContainerIndexError("Unknown Segment size")
+
+    segment_times = parse_cues(*cues, segment_start, timecode_scale)
+    segments: list[Segment] = []
+    for i, (time, start) in enumerate(segment_times):
+        end = segment_times[i + 1][1] if i + 1 < len(segment_times) else clusters_end
+        segments.append(Segment(time, start, end))
+
+    if len(segments) == 0:
+        raise ContainerIndexError("Empty Cues")
+
+    return ContainerIndex(bytes(init), segments)
+
+def write_void(data: bytearray, start: int, end: int) -> None:
+    """
+    Overwrites an element with a Void element of the same length
+    """
+    if end - start < 9:
+        raise ContainerIndexError(f"Element at {start} is too small to be replaced")
+
+    data[start:end] = bytes([void_id, 0x01]) + (end - start - 9).to_bytes(7, "big") + bytes(end - start - 9)
+
+def find_cues_position(data: bytes, start: int, end: int, segment_start: int) -> int | None:
+    for element_id, seek_start, seek_end in iterate_elements(data, start, end):
+        if element_id != seek_id:
+            continue
+
+        target_id: bytes | None = None
+        target_position: int | None = None
+        for child_id, child_start, child_end in iterate_elements(data, seek_start, seek_end):
+            if child_id == seek_element_id:
+                target_id = data[child_start:child_end]
+            elif child_id == seek_position_id:
+                target_position = read_uint(data, child_start, child_end)
+
+        if target_id == cues_id.to_bytes(4, "big") and target_position is not None:
+            return segment_start + target_position
+
+    return None
+
+def parse_cues(data: bytes, start: int, end: int, segment_start: int, timecode_scale: int) -> list[tuple[float, int]]:
+    """
+    Returns the time and cluster offset of each cue point, one per cluster
+    """
+    cue_points: dict[int, float] = {}
+    for element_id, point_start, point_end in iterate_elements(data, start, end):
+        if element_id != cue_point_id:
+            continue
+
+        cue_time: int | None = None
+        cluster_position: int | None = None
+        for child_id, child_start, child_end in iterate_elements(data, point_start, point_end):
+            if child_id == cue_time_id:
+                cue_time = read_uint(data, child_start, child_end)
+            elif child_id == cue_track_positions_id and cluster_position is None:
+                for position_id, position_start, position_end in iterate_elements(data, child_start, child_end):
+                    if position_id == cue_cluster_position_id:
+                        cluster_position = read_uint(data, position_start, position_end)
+
+        if cue_time is not None and cluster_position is not None:
+            offset = segment_start + cluster_position
+            cue_points.setdefault(offset, cue_time * timecode_scale / 1_000_000_000)
+
+    return sorted((time, offset) for offset, time in cue_points.items())
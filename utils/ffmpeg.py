@@ -2,9 +2,26 @@ import subprocess
 import shutil
 
 TimeoutExpired = subprocess.TimeoutExpired
-ffmpeg_path = shutil.which("ffmpeg")
-if ffmpeg_path is None:
-    raise RuntimeError("ffmpeg binary couldn't be found on the PATH")
+ffmpeg_path: str | None = None
+
+
+class FFmpegNotFoundError(RuntimeError):
+    pass
+
+
+def get_ffmpeg_path() -> str:
+    """
+    Looked up on first use, so that the app only needs FFmpeg for resized variants.
+
+    Raises FFmpegNotFoundError if there is no ffmpeg binary on the PATH.
+    """
+    global ffmpeg_path
+    if ffmpeg_path is None:
+        ffmpeg_path = shutil.which("ffmpeg")
+        if ffmpeg_path is None:
+            raise FFmpegNotFoundError("ffmpeg binary couldn't be found on the PATH")
+
+    return ffmpeg_path
 
 
 class FFmpegError(Exception):
@@ -15,21 +32,25 @@ class FFmpegError(Exception):
         self.exit_code = exit_code
 
 
-def run_ffmpeg(*args: str, timeout: float | None = None):
+def run_ffmpeg_output(*args: str, input: bytes | None = None, timeout: float | None = None) -> bytes:
     """
-    Runs FFmpeg. Any output is /dev/null'd.
+    Runs FFmpeg with its output written to stdout ("pipe:1"), and returns that output.
+    The input is given on stdin ("pipe:0").
 
     Raises subprocess.TimeoutExpired on timeout. (reexported here for convenience)
     Raises FFmpegError if FFmpeg exits with a non-zero code.
+    Raises FFmpegNotFoundError if there is no ffmpeg binary on the PATH.
     """
     proc = subprocess.run(
-        [ffmpeg_path, *args],
+        [get_ffmpeg_path(), *args],
         shell=False,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.DEVNULL,
+        input=input if input is not None else b"",
+        stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
         timeout=timeout,
     )
 
     if proc.returncode != 0:
         raise FFmpegError(proc.returncode)
+
+    return proc.stdout
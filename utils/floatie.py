@@ -1,8 +1,13 @@
+from collections import OrderedDict
 from dataclasses import dataclass
 import re
+import threading
+import time
 from typing import Any
+import httpx
 import requests
 import json
+from utils.config import config
 
 class InnertubeError(Exception):
     pass
@@ -13,6 +18,13 @@ class InnertubePlayabilityError(Exception):
 class InnertubeLoginRequiredError(Exception):
     pass
 
+class InnertubeBotCheckError(InnertubeLoginRequiredError):
+    """
+    Login required to confirm that the request is not from a bot, which depends on the proxy
+    and visitor data rather than the video
+    """
+    pass
+
 @dataclass
 class InnertubeDetails:
     api_key: str
@@ -34,59 +46,167 @@ context = {
   }
 }
 
-def fetch_video_data(video_id: str, proxy_url: str | None) -> dict[str, Any]:
-    proxies = {
-        "http": proxy_url,
-        "https": proxy_url
-    } if proxy_url is not None else None
+@dataclass
+class CachedVisitorData:
+    visitor_data: str
+    fetched_at: float
+
+# Fetching the visitor data means downloading the whole watch page, so it is kept for a while per proxy
+visitor_data_cache: dict[str | None, CachedVisitorData] = {}
+# Kept alive per proxy so that connections are reused, least recently used first
+sessions: OrderedDict[str | None, requests.Session] = OrderedDict()
+async_clients: OrderedDict[str | None, httpx.AsyncClient] = OrderedDict()
+max_sessions = 32
+floatie_lock = threading.Lock()
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/147.0.0.0 Safari/537.36'
+player_headers = {
+    'Content-Type': 'application/json'
+}
 
-    if proxy_url:
-        print(f"Using proxy {proxy_url}")
+def get_session(proxy_url: str | None) -> requests.Session:
+    evicted: list[requests.Session] = []
+    with floatie_lock:
+        session = sessions.get(proxy_url)
+        if session is None:
+            session = requests.Session()
+            session.headers["User-Agent"] = user_agent
+            if proxy_url is not None:
+                session.proxies = {
+                    "http": proxy_url,
+                    "https": proxy_url
+                }
+
+            sessions[proxy_url] = session
+            while len(sessions) > max_sessions:
+                evicted.append(sessions.popitem(last=False)[1])
+        else:
+            sessions.move_to_end(proxy_url)
 
-    # Get the visitor data token
-    url = f"https://www.youtube.com/watch?v={video_id}"
+    for old_session in evicted:
+        old_session.close()
+
+    return session
+
+async def get_async_client(proxy_url: str | None) -> httpx.AsyncClient:
+    client = async_clients.get(proxy_url)
+    if client is None:
+        client = httpx.AsyncClient(proxy=proxy_url, headers={"User-Agent": user_agent}, timeout=10)
+        async_clients[proxy_url] = client
+        while len(async_clients) > max_sessions:
+            await async_clients.popitem(last=False)[1].aclose()
+    else:
+        async_clients.move_to_end(proxy_url)
+
+    return client
 
-    response = requests.request("GET", url, proxies=proxies, timeout=10)
-    if not response.ok:
-        raise InnertubeError(f"Google token fetch failed with {response.status_code}")
+def get_cached_visitor_data(proxy_url: str | None) -> str | None:
+    with floatie_lock:
+        cached = visitor_data_cache.get(proxy_url)
+        if cached is None or time.time() - cached.fetched_at > config["floatie_visitor_data_ttl"]:
+            return None
 
-    visitor_data_match = re.search(r'"VISITOR_DATA":"([^"]+)"', response.text)
-    visitor_data = visitor_data_match.group(1) if visitor_data_match else None
+        return cached.visitor_data
 
+def cache_visitor_data(proxy_url: str | None, visitor_data: str | None) -> None:
     if not visitor_data:
         print("Failed to get visitor data")
+        return
+
+    with floatie_lock:
+        visitor_data_cache[proxy_url] = CachedVisitorData(visitor_data, time.time())
+
+def forget_visitor_data(proxy_url: str | None) -> None:
+    with floatie_lock:
+        visitor_data_cache.pop(proxy_url, None)
+
+def get_watch_url(video_id: str) -> str:
+    return f"{config['youtube_url']}/watch?v={video_id}"
+
+def parse_visitor_data(page: str) -> str | None:
+    visitor_data_match = re.search(r'"VISITOR_DATA":"([^"]+)"', page)
+    return visitor_data_match.group(1) if visitor_data_match else None
 
-    url = f"https://www.youtube.com/youtubei/v1/player?key={innertube_details.api_key}"
+def get_player_request(video_id: str) -> tuple[str, str]:
+    url = f"{config['youtube_url']}/youtubei/v1/player?key={innertube_details.api_key}"
 
     payload = json.dumps({
         "context": context,
         "videoId": video_id
     })
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/147.0.0.0 Safari/537.36',
-        'Content-Type': 'application/json'
-    }
 
-    response = requests.request("POST", url, headers=headers, data=payload, proxies=proxies, timeout=10)
-    if not response.ok:
-        raise InnertubeError(f"Innertube failed with status code {response.status_code}")
+    return url, payload
 
-    data = response.json()
+def check_video_data(video_id: str, proxy_url: str | None, status_code: int, data: Any) -> dict[str, Any]:
+    if status_code >= 400:
+        # The visitor data might be the problem, get a new one next time
+        forget_visitor_data(proxy_url)
+        raise InnertubeError(f"Innertube failed with status code {status_code}")
 
     if data["videoDetails"]["videoId"] != video_id:
         raise InnertubeError(f"Innertube returned wrong video ID: {data['videoDetails']['videoId']} vs. {video_id}")
 
     return data
 
+def fetch_video_data(video_id: str, proxy_url: str | None) -> dict[str, Any]:
+    if proxy_url:
+        print(f"Using proxy {proxy_url}")
+
+    session = get_session(proxy_url)
+
+    # Get the visitor data token
+    visitor_data = get_cached_visitor_data(proxy_url)
+    if visitor_data is None:
+        response = session.get(get_watch_url(video_id), timeout=10)
+        if not response.ok:
+            raise InnertubeError(f"Google token fetch failed with {response.status_code}")
+
+        visitor_data = parse_visitor_data(response.text)
+        cache_visitor_data(proxy_url, visitor_data)
+
+    url, payload = get_player_request(video_id)
+    response = session.post(url, headers=player_headers, data=payload, timeout=10)
+
+    return check_video_data(video_id, proxy_url, response.status_code, response.json() if response.ok else None)
+
+async def fetch_video_data_async(video_id: str, proxy_url: str | None) -> dict[str, Any]:
+    """
+    Same as fetch_video_data, for use from the app's event loop
+    """
+    client = await get_async_client(proxy_url)
+
+    visitor_data = get_cached_visitor_data(proxy_url)
+    if visitor_data is None:
+        response = await client.get(get_watch_url(video_id))
+        if not response.is_success:
+            raise InnertubeError(f"Google token fetch failed with {response.status_code}")
+
+        visitor_data = parse_visitor_data(response.text)
+        cache_visitor_data(proxy_url, visitor_data)
+
+    url, payload = get_player_request(video_id)
+    response = await client.post(url, headers=player_headers, content=payload)
+
+    return check_video_data(video_id, proxy_url, response.status_code, response.json() if response.is_success else None)
+
 def fetch_playback_urls(video_id: str, proxy_url: str | None) -> list[dict[str, str | int]]:
     data = fetch_video_data(video_id, proxy_url)
 
     playability_status = data["playabilityStatus"]["status"]
     if playability_status != "OK":
         if playability_status == "LOGIN_REQUIRED":
-            raise InnertubeLoginRequiredError(f"Login required: {data['playabilityStatus'].get('reason', 'no reason')}")
+            # Often a bot check, try again with new visitor data
+            forget_visitor_data(proxy_url)
+            reason = data["playabilityStatus"].get("reason")
+            if reason is None or is_bot_check(reason):
+                raise InnertubeBotCheckError(f"Login required: {reason or 'no reason'}")
+            raise InnertubeLoginRequiredError(f"Login required: {reason}")
         else:
             print(data)
             raise InnertubePlayabilityError(f"Not Playable: {data['playabilityStatus']['status']}")
 
     return data["streamingData"]["adaptiveFormats"]
+
+def is_bot_check(reason: str) -> bool:
+    # "Sign in to confirm you're not a bot", with either apostrophe
+    return "not a bot" in reason.lower()
@@ -0,0 +1,158 @@
+"""
+Chooses which of a video's formats to render from.
+
+A format costs the time to download a keyframe group and decode it, which mostly depends on the
+codec and the resolution. Once renders of a codec and height have been measured, the measured
+time is used instead of the estimate from the format list.
+"""
+
+import re
+import statistics
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+
+from utils.config import config
+from utils.logger import log_error
+from utils.redis_handler import redis_conn
+
+if TYPE_CHECKING:
+    from utils.video import PlaybackUrl
+
+# Render times kept per codec and height, and how many are needed before they are trusted
+render_time_samples = 50
+min_render_time_samples = 5
+render_time_ttl = 24 * 60 * 60
+# How long measured render times are used before they are read again
+refresh_interval = 60
+
+chosen_formats_key = "chosen-formats"
+
+codec_prefixes = {
+    "av01": "av1",
+    "vp09": "vp9",
+    "vp9": "vp9",
+    "avc1": "h264",
+    "avc3": "h264",
+    "hev1": "h265",
+    "hvc1": "h265",
+}
+
+# (codec, height) to the median render time and when it was read
+measured_render_times: dict[tuple[str, int], tuple[float | None, float]] = {}
+measured_lock = threading.Lock()
+
+def get_codec(format: dict[str, Any]) -> str:
+    # floatie gives 'video/mp4; codecs="avc1.64001f"', yt-dlp gives "avc1.64001f"
+    codecs = format.get("vcodec")
+    if codecs is None and "mimeType" in format:
+        match = re.search(r'codecs="([^"]*)"', format["mimeType"])
+        codecs = match.group(1) if match is not None else None
+
+    if codecs is None:
+        return "unknown"
+
+    return codec_prefixes.get(codecs.split(".")[0].strip(), "unknown")
+
+def get_bitrate(format: dict[str, Any]) -> int | None:
+    """
+    Bits per second of the format, from the bitrate or else the file size
+    """
+    # floatie gives the peak bitrate as well, which is far from what a keyframe group costs
+    if format.get("averageBitrate") is not None:
+        return int(format["averageBitrate"])
+    if format.get("bitrate") is not None:
+        return int(format["bitrate"])
+    if format.get("tbr") is not None:
+        return int(format["tbr"] * 1000)
+
+    size = format.get("contentLength") or format.get("filesize") or format.get("filesize_approx")
+    duration = int(format["approxDurationMs"]) / 1000 if format.get("approxDurationMs") is not None \
+                else format.get("duration")
+    if size is not None and duration:
+        return int(int(size) * 8 / duration)
+
+    return None
+
+def estimate_render_time(url: "PlaybackUrl") -> float:
+    """
+    Seconds to download and decode a keyframe group of the format, before anything was measured
+    """
+    selection = config["format_selection"]
+    codec_costs = selection["codec_costs"]
+    decode_time = codec_costs.get(url.codec, max(codec_costs.values())) * url.width * url.height / (1280 * 720)
+    download_time = (url.bitrate or 0) / 8 * selection["keyframe_interval"] / selection["bandwidth"]
+
+    return decode_time + download_time
+
+def get_measured_render_times(keys: set[tuple[str, int]]) -> dict[tuple[str, int], float | None]:
+    now = time.time()
+    with measured_lock:
+        missing = [key for key in keys
+                    if key not in measured_render_times or now - measured_render_times[key][1] > refresh_interval]
+
+        if len(missing) > 0:
+            try:
+                pipeline = redis_conn.pipeline(transaction=False)
+                for codec, height in missing:
+                    pipeline.lrange(get_render_times_key(codec, height), 0, -1)
+
+                for key, samples in zip(missing, pipeline.execute()):
+                    durations = [float(sample) for sample in samples]
+                    measured_render_times[key] = \
+                        (statistics.median(durations) if len(durations) >= min_render_time_samples else None, now)
+            except Exception as e:
+                log_error("Failed to read render times", e)
+
+        return {key: measured_render_times[key][0] if key in measured_render_times else None for key in keys}
+
+def get_render_cost(url: "PlaybackUrl", measured: dict[tuple[str, int], float | None]) -> float:
+    measured_time = measured.get((url.codec, url.height))
+    return measured_time if measured_time is not None else estimate_render_time(url)
+
+def select_format(urls: list["PlaybackUrl"], max_height: int) -> tuple["PlaybackUrl", float]:
+    """
+    Picks the cheapest format to render that is as tall as the quality target, or as
+    tall as possible when no format is. Returns the format and its expected render time.
+    """
+    candidates = [url for url in urls if url.height <= max_height]
+    if len(candidates) == 0:
+        raise ValueError(f"Failed to find playback URL with height <= {max_height}")
+
+    target_height = min(config["format_selection"]["target_height"], max(url.height for url in candidates))
+    candidates = [url for url in candidates if url.height >= target_height]
+
+    measured = get_measured_render_times({(url.codec, url.height) for url in candidates})
+    # Taller formats win ties
+    chosen = min(candidates, key=lambda url: (get_render_cost(url, measured), -url.height))
+
+    return chosen, get_render_cost(chosen, measured)
+
+def record_chosen_format(url: "PlaybackUrl") -> None:
+    try:
+        redis_conn.hincrby(chosen_formats_key, f"{url.codec} {url.height}")
+    except Exception as e:
+        log_error("Failed to record chosen format", e)
+
+def record_render_time(url: "PlaybackUrl", duration: float) -> None:
+    key = get_render_times_key(url.codec, url.height)
+    try:
+        pipeline = redis_conn.pipeline(transaction=False)
+        pipeline.lpush(key, duration)
+        pipeline.ltrim(key, 0, render_time_samples - 1)
+        pipeline.expire(key, render_time_ttl)
+        pipeline.execute()
+    except Exception as e:
+        log_error("Failed to record render time", e)
+
+def get_chosen_formats() -> dict[tuple[str, int], int]:
+    chosen: dict[bytes, bytes] = redis_conn.hgetall(chosen_formats_key) # pyright: ignore
+    result: dict[tuple[str, int], int] = {}
+    for name, count in chosen.items():
+        codec, height = name.decode().split(" ")
+        result[(codec, int(height))] = int(count)
+
+    return result
+
+def get_render_times_key(codec: str, height: int) -> str:
+    return f"render-times-{codec}-{height}"
@@ -0,0 +1,188 @@
+"""
+Recently served thumbnails, kept in memory that is shared by all app processes.
+
+The memory is mapped before the app processes are forked (see utils/app_processes.py), so
+every process reads and fills the same cache. Adding processes then neither splits the hits
+between them nor adds a copy of the cache for each.
+
+Entries are appended to a ring and found through a hash index with a few entries per bucket.
+The oldest entries are overwritten first, and entries close to being overwritten are copied to
+the front when they are read, so that popular thumbnails stay.
+
+A process killed while holding the lock would leave it held, so the lock is only waited for
+briefly and the cache is skipped when it can not be had. The supervisor then frees it with
+recover() once it sees the process exit.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import mmap
+import multiprocessing
+import struct
+from typing import Iterator
+
+from utils.config import config
+from utils.logger import log_error
+
+# Write position in the ring, hits and misses
+header_format = struct.Struct("<QQQ")
+# Hash of the key, position in the ring and length of the record
+index_entry_format = struct.Struct("<QQI")
+key_length_format = struct.Struct("<H")
+# Index entries per bucket
+ways = 4
+# Bytes of ring per index entry, well below the size of a thumbnail so that buckets rarely fill up
+bytes_per_index_entry = 1024
+# Entries this far back in the ring are copied to the front when read
+refresh_fraction = 0.75
+# Seconds to wait for the lock before treating the request as a miss, far longer than it is ever held
+lock_timeout = 0.05
+# Seconds the lock has to stay held after a process exited for it to be taken as held by that process
+recover_timeout = 1
+
+class SharedCache:
+    def __init__(self, size: int):
+        index_entries = max(ways, size // bytes_per_index_entry // ways * ways)
+        self.buckets = index_entries // ways
+        self.index_start = header_format.size
+        self.ring_start = self.index_start + index_entries * index_entry_format.size
+        self.ring_size = size
+        # Anonymous mappings are shared with processes forked afterwards
+        self.memory = mmap.mmap(-1, self.ring_start + size)
+        self.lock = multiprocessing.Lock()
+
+    def get(self, key: bytes) -> bytes | None:
+        key_hash = get_key_hash(key)
+        bucket_start = self.get_bucket_start(key_hash)
+
+        with self.locked() as acquired:
+            if not acquired:
+                return None
+
+            write_position, hits, misses = header_format.unpack_from(self.memory, 0)
+            for way in range(ways):
+                entry_hash, position, length = index_entry_format.unpack_from(self.memory, bucket_start + way * index_entry_format.size)
+                if length == 0 or entry_hash != key_hash or not self.is_valid(position, write_position):
+                    continue
+
+                start = self.ring_start + position % self.ring_size
+                key_length, = key_length_format.unpack_from(self.memory, start)
+                value_start = start + key_length_format.size + key_length
+                if self.memory[start + key_length_format.size:value_start] != key:
+                    continue
+
+                value = self.memory[value_start:start + length]
+                if write_position - position > self.ring_size * refresh_fraction:
+                    write_position = self.append(key, key_hash, value, write_position)
+
+                header_format.pack_into(self.memory, 0, write_position, hits + 1, misses)
+                return value
+
+            header_format.pack_into(self.memory, 0, write_position, hits, misses + 1)
+            return None
+
+    def put(self, key: bytes, value: bytes) -> None:
+        # Large entries would push out many others
+        if key_length_format.size + len(key) + len(value) > self.ring_size // 8:
+            return
+
+        with self.locked() as acquired:
+            if not acquired:
+                return
+
+            write_position, hits, misses = header_format.unpack_from(self.memory, 0)
+            write_position = self.append(key, get_key_hash(key), value, write_position)
+            header_format.pack_into(self.memory, 0, write_position, hits, misses)
+
+    def stats(self) -> tuple[int, int, int]:
+        """
+        Hits, misses and bytes of the ring in use
+        """
+        # Only read, so a torn read at worst gives a slightly wrong count
+        write_position, hits, misses = header_format.unpack_from(self.memory, 0)
+        return hits, misses, min(write_position, self.ring_size)
+
+    @contextmanager
+    def locked(self) -> Iterator[bool]:
+        acquired = self.lock.acquire(timeout=lock_timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.lock.release()
+
+    def recover(self) -> None:
+        """
+        Frees the lock if it is still held after a process exited, forgetting every entry since
+        the process may have been writing one. Called by the supervisor, which does not use the cache.
+        """
+        if self.lock.acquire(timeout=recover_timeout):
+            self.lock.release()
+            return
+
+        log_error("Hot cache lock held by a process that exited, clearing the cache")
+        self.memory[self.index_start:self.ring_start] = bytes(self.ring_start - self.index_start)
+        # Any process can release a multiprocessing lock
+        self.lock.release()
+
+    def append(self, key: bytes, key_hash: int, value: bytes, write_position: int) -> int:
+        """
+        Writes a record at the write position and points the index at it, returning the new write position.
+        Must be called with the lock held.
+        """
+        length = key_length_format.size + len(key) + len(value)
+        position = write_position
+        offset = position % self.ring_size
+        if offset + length > self.ring_size:
+            # Records are never split, the rest of the ring is skipped instead
+            position += self.ring_size - offset
+            offset = 0
+
+        start = self.ring_start + offset
+        key_length_format.pack_into(self.memory, start, len(key))
+        value_start = start + key_length_format.size + len(key)
+        self.memory[start + key_length_format.size:value_start] = key
+        self.memory[value_start:start + length] = value
+        write_position = position + length
+
+        # Replaces the entry for the same key, or else an unused or overwritten entry, or else the oldest one
+        bucket_start = self.get_bucket_start(key_hash)
+        chosen_way = 0
+        chosen_position: int | None = None
+        for way in range(ways):
+            entry_hash, entry_position, entry_length = \
+                index_entry_format.unpack_from(self.memory, bucket_start + way * index_entry_format.size)
+            if entry_length > 0 and entry_hash == key_hash:
+                chosen_way = way
+                break
+            elif entry_length == 0 or not self.is_valid(entry_position, write_position):
+                chosen_way, chosen_position = way, -1
+            elif chosen_position is None or entry_position < chosen_position:
+                chosen_way, chosen_position = way, entry_position
+
+        index_entry_format.pack_into(self.memory, bucket_start + chosen_way * index_entry_format.size, key_hash, position, length)
+        return write_position
+
+    def is_valid(self, position: int, write_position: int) -> bool:
+        # Not overwritten by records written since
+        return write_position - position <= self.ring_size
+
+    def get_bucket_start(self, key_hash: int) -> int:
+        return self.index_start + (key_hash % self.buckets) * ways * index_entry_format.size
+
+def get_key_hash(key: bytes) -> int:
+    # Not hash(), which is salted differently in processes that were not forked from the same one
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+hot_cache: SharedCache | None = None
+
+def get_hot_cache() -> SharedCache | None:
+    """
+    The cache of this process, made the first time it is needed. The app process supervisor
+    makes it before forking so that the processes share it.
+    """
+    global hot_cache
+    if hot_cache is None and config["hot_cache_size"] > 0:
+        hot_cache = SharedCache(config["hot_cache_size"])
+
+    return hot_cache
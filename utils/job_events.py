@@ -0,0 +1,154 @@
+"""
+Tells clients when thumbnail jobs finish, from the status workers publish in publish_job_status.
+
+Every app process keeps a single Redis subscription that is shared by all of its clients. A job's
+channel is subscribed while at least one client is waiting on it, and each message is handed to
+the queues of the clients waiting on that job.
+"""
+
+import asyncio
+import json
+import re
+from typing import Any, AsyncIterator, cast
+
+from redis.asyncio.client import PubSub
+from rq.job import Job
+from utils.logger import log_error
+from utils.redis_handler import get_redis_pubsub, queue_render, queue_resolve
+from utils.thumbnail import get_job_id, get_job_status, get_render_job_id
+from utils.video import valid_video_id
+
+max_jobs_per_client = 100
+# Comments are sent this often so that proxies keep idle streams open
+keepalive_interval = 15
+# Clients can connect again for the jobs still running after this
+max_stream_duration = 5 * 60
+
+subscribers: dict[str, set["asyncio.Queue[tuple[str, str]]"]] = {}
+pubsub: PubSub | None = None
+listener: "asyncio.Task[None] | None" = None
+subscription_lock = asyncio.Lock()
+
+def parse_job_id(job_id: str) -> tuple[str, float] | None:
+    """
+    Video ID and time of a job ID made by get_job_id, None for anything else
+    """
+    match = re.fullmatch(r"(.+)-(\d+(?:\.\d+)?)", job_id)
+    if match is None or not valid_video_id(match.group(1)):
+        return None
+
+    video_id, time = match.group(1), float(match.group(2))
+    return (video_id, time) if get_job_id(video_id, time) == job_id else None
+
+async def subscribe(job_ids: list[str]) -> "asyncio.Queue[tuple[str, str]]":
+    global pubsub, listener
+
+    queue: "asyncio.Queue[tuple[str, str]]" = asyncio.Queue()
+    async with subscription_lock:
+        new_job_ids = [job_id for job_id in job_ids if job_id not in subscribers]
+        for job_id in job_ids:
+            subscribers.setdefault(job_id, set()).add(queue)
+
+        if len(new_job_ids) > 0:
+            if pubsub is None:
+                pubsub = await get_redis_pubsub()
+            await pubsub.subscribe(*new_job_ids)
+
+        if listener is None or listener.done():
+            listener = asyncio.create_task(listen(pubsub))
+
+    return queue
+
+async def unsubscribe(queue: "asyncio.Queue[tuple[str, str]]", job_ids: list[str]) -> None:
+    async with subscription_lock:
+        unused_job_ids: list[str] = []
+        for job_id in job_ids:
+            queues = subscribers.get(job_id)
+            if queues is None:
+                continue
+
+            queues.discard(queue)
+            if len(queues) == 0:
+                del subscribers[job_id]
+                unused_job_ids.append(job_id)
+
+        if len(unused_job_ids) > 0 and pubsub is not None:
+            try:
+                await pubsub.unsubscribe(*unused_job_ids)
+            except Exception as e:
+                log_error("Failed to unsubscribe from job status", e)
+
+async def listen(pubsub: PubSub | None) -> None:
+    if pubsub is None:
+        return
+
+    while len(subscribers) > 0:
+        try:
+            message = cast(dict[str, Any] | None, await pubsub.get_message(ignore_subscribe_messages=True, timeout=1))
+        except Exception as e:
+            # The subscriptions are sent again when the connection is made again
+            log_error("Failed to read job status", e)
+            await asyncio.sleep(1)
+            continue
+
+        if message is None or message["type"] != "message":
+            continue
+
+        job_id = message["channel"].decode()
+        for queue in subscribers.get(job_id, ()):
+            queue.put_nowait((job_id, get_job_status(message["data"])))
+
+def get_job_statuses(job_ids: list[str]) -> dict[str, str]:
+    """
+    Statuses of jobs that ended before the client subscribed, "true" or "false" like
+    publish_job_status. Jobs still running, and jobs no longer known, are left out.
+    """
+    statuses: dict[str, str] = {}
+    jobs = Job.fetch_many(job_ids, connection=queue_resolve.connection)
+    finished = [job_id for job_id, job in zip(job_ids, jobs) if job is not None and job.is_finished]
+    render_jobs = Job.fetch_many([get_render_job_id(*parse_job_id(job_id)) for job_id in finished], # pyright: ignore
+                                 connection=queue_render.connection)
+
+    for job_id, job in zip(job_ids, jobs):
+        if job is not None and job.is_failed:
+            statuses[job_id] = "false"
+    for job_id, render_job in zip(finished, render_jobs):
+        if render_job is not None and render_job.is_failed:
+            statuses[job_id] = "false"
+        elif render_job is not None and render_job.is_finished:
+            statuses[job_id] = "true"
+
+    return statuses
+
+async def stream_job_events(job_ids: list[str]) -> AsyncIterator[str]:
+    """
+    Server-Sent Events with the status of each job as it finishes, ending once all of them have
+    """
+    # Subscribed from inside the stream so that a client leaving before it starts leaves nothing behind
+    queue = await subscribe(job_ids)
+    pending = set(job_ids)
+    try:
+        # Subscribed first, so that a job ending in between is seen here or published after
+        for job_id, status in get_job_statuses(job_ids).items():
+            pending.discard(job_id)
+            await unsubscribe(queue, [job_id])
+            yield format_event(job_id, status)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_stream_duration
+        while len(pending) > 0 and loop.time() < deadline:
+            try:
+                job_id, status = await asyncio.wait_for(queue.get(), min(keepalive_interval, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+
+            if job_id in pending:
+                pending.discard(job_id)
+                await unsubscribe(queue, [job_id])
+                yield format_event(job_id, status)
+    finally:
+        await unsubscribe(queue, list(pending))
+
+def format_event(job_id: str, status: str) -> str:
+    return f"data: {json.dumps({'jobID': job_id, 'ready': status == 'true'})}\n\n"
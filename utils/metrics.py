@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any
+
+from utils.logger import log_error
+import utils.process_state as process_state
+
+# Seconds between writes of a process's metrics for the other app processes to read
+share_interval = 5
+# Roughly covers everything from a warm cache hit to a synchronous wait hitting the 15 second timeout
+default_buckets: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+Labels = tuple[tuple[str, str], ...]
+
+def format_labels(labels: Labels, extra: tuple[tuple[str, str], ...] = ()) -> str:
+    all_labels = labels + extra
+    if len(all_labels) == 0:
+        return ""
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in all_labels) + "}"
+
+def format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else str(value)
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> list[Any]:
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, snapshots: list[list[Any]]) -> dict[Labels, float]:
+        values: dict[Labels, float] = {}
+        for snapshot in snapshots:
+            for labels, value in snapshot:
+                key = tuple((name, label_value) for name, label_value in labels)
+                values[key] = values.get(key, 0) + value
+
+        return values
+
+    def render(self, merged: dict[Labels, float] | None = None) -> list[str]:
+        with self.lock:
+            values = list((merged if merged is not None else self.values).items())
+
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+            *[f"{self.name}{format_labels(labels)} {format_value(value)}" for labels, value in values],
+        ]
+
+@dataclass
+class HistogramValue:
+    bucket_counts: list[int]
+    count: int = 0
+    sum: float = 0
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = default_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values: dict[Labels, HistogramValue] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            histogram_value = self.values.get(key)
+            if histogram_value is None:
+                histogram_value = HistogramValue([0] * len(self.buckets))
+                self.values[key] = histogram_value
+
+            # Buckets are stored non-cumulatively and summed up when rendering
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram_value.bucket_counts[index] += 1
+            histogram_value.count += 1
+            histogram_value.sum += value
+
+    def snapshot(self) -> list[Any]:
+        with self.lock:
+            return [[list(labels), value.bucket_counts, value.count, value.sum] for labels, value in self.values.items()]
+
+    def merge(self, snapshots: list[list[Any]]) -> dict[Labels, HistogramValue]:
+        values: dict[Labels, HistogramValue] = {}
+        for snapshot in snapshots:
+            for labels, bucket_counts, count, value_sum in snapshot:
+                key = tuple((name, label_value) for name, label_value in labels)
+                histogram_value = values.setdefault(key, HistogramValue([0] * len(self.buckets)))
+                histogram_value.bucket_counts = [total + bucket_count for total, bucket_count in zip(histogram_value.bucket_counts, bucket_counts)]
+                histogram_value.count += count
+                histogram_value.sum += value_sum
+
+        return values
+
+    def render(self, merged: dict[Labels, HistogramValue] | None = None) -> list[str]:
+        with self.lock:
+            values = [(labels, HistogramValue(list(value.bucket_counts), value.count, value.sum))
+                        for labels, value in (merged if merged is not None else self.values).items()]
+
+        result = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for labels, value in values:
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, value.bucket_counts):
+                cumulative += bucket_count
+                result.append(f"{self.name}_bucket{format_labels(labels, (('le', str(bucket)),))} {cumulative}")
+            result.append(f"{self.name}_bucket{format_labels(labels, (('le', '+Inf'),))} {value.count}")
+            result.append(f"{self.name}_sum{format_labels(labels)} {value.sum}")
+            result.append(f"{self.name}_count{format_labels(labels)} {value.count}")
+
+        return result
+
+request_count = Counter("dearrow_requests_total",
+                        "Number of getThumbnail requests handled by this app process, by outcome")
+request_redirect_count = Counter("dearrow_request_redirects_total",
+                        "Number of getThumbnail requests answered with a redirect to redirectUrl, by outcome")
+request_duration = Histogram("dearrow_request_duration_seconds",
+                        "Time taken to answer getThumbnail requests, by outcome")
+thumbnail_response_duration = Histogram("dearrow_thumbnail_response_duration_seconds",
+                        "Time taken to load a thumbnail from storage and build the response")
+
+app_metrics: list[Counter | Histogram] = [
+    request_count,
+    request_redirect_count,
+    request_duration,
+    thumbnail_response_duration,
+]
+
+def bool_label(value: bool) -> str:
+    return "true" if value else "false"
+
+@dataclass
+class RequestMetrics:
+    """
+    Tracks a single getThumbnail request so that every exit point records
+    exactly one outcome
+    """
+    generate_now: bool
+    is_livestream: bool
+    start_time: float = field(default_factory=time.perf_counter)
+    recorded: bool = False
+
+    def record(self, outcome: str, redirected: bool = False) -> None:
+        if self.recorded:
+            return
+        self.recorded = True
+
+        labels = {
+            "outcome": outcome,
+            "generate_now": bool_label(self.generate_now),
+            "is_livestream": bool_label(self.is_livestream),
+        }
+        request_count.inc(**labels)
+        if redirected:
+            request_redirect_count.inc(**labels)
+        request_duration.observe(time.perf_counter() - self.start_time, **labels)
+
+def render_app_metrics() -> list[str]:
+    """
+    Metrics of this process, or of all app processes when there are several
+    """
+    if process_state.state_folder is None:
+        return [line for metric in app_metrics for line in metric.render()]
+
+    write_app_metrics()
+    states = process_state.read_process_states("metrics")
+    return [line for metric in app_metrics
+            for line in metric.render(metric.merge([state.get(metric.name, []) for state in states]))] # pyright: ignore
+
+def write_app_metrics() -> None:
+    process_state.write_process_state("metrics", {metric.name: metric.snapshot() for metric in app_metrics})
+
+def start_sharing_app_metrics() -> None:
+    """
+    Writes this process's metrics every share_interval seconds, so that the values of the other
+    app processes are at most that old when one of them is scraped
+    """
+    def run() -> None:
+        while True:
+            time.sleep(share_interval)
+            try:
+                write_app_metrics()
+            except Exception as e:
+                log_error("Failed to write app metrics", e)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,30 @@
+from utils.config import config
+from utils.logger import log_error
+from utils.redis_handler import get_async_redis_conn, redis_conn
+
+# Sent as the X-Failure-Reason for videos that failed recently
+failure_messages = {
+    "unplayable": "Video is not playable",
+    "login_required": "Video requires login",
+    "premiere": "Video has not premiered yet",
+}
+
+def failure_key(video_id: str) -> str:
+    return f"failed-{video_id}"
+
+def cache_failure(video_id: str, reason: str) -> None:
+    """
+    Remembers that no thumbnail can be made for any time of this video for the TTL of the reason
+    """
+    ttl = config["negative_cache_ttls"].get(reason, 0)
+    if ttl <= 0:
+        return
+
+    try:
+        redis_conn.set(failure_key(video_id), reason, ex=ttl)
+    except Exception as e:
+        log_error("Failed to cache failure", e)
+
+async def get_cached_failure(video_id: str) -> str | None:
+    reason: bytes | None = await (await get_async_redis_conn()).get(failure_key(video_id))
+    return reason.decode() if reason is not None else None
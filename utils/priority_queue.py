@@ -0,0 +1,164 @@
+import math
+import time
+from typing import TYPE_CHECKING, Any, Optional, Type
+
+from redis import Redis
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.queue import Queue
+from rq.utils import as_text, backend_class
+from utils.config import config
+
+if TYPE_CHECKING:
+    from redis.client import Pipeline
+
+# Scores are stored relative to this so that they keep their precision
+priority_epoch = 1_700_000_000
+
+def priority_score(priority: str, now: float | None = None) -> float:
+    """
+    Score of a new entry with the given priority.
+
+    Entries gain config["priority"]["aging"] points per second while they wait. Since every
+    entry ages at the same rate, this is stored as a penalty on the time it was added
+    instead of rescoring the whole set.
+    """
+    now = now if now is not None else time.time()
+    return config["priority"]["scores"][priority] - config["priority"]["aging"] * (now - priority_epoch)
+
+def get_priority_key(queue_name: str) -> str:
+    return f"rq:priority:{queue_name}"
+
+class PriorityJob(Job):
+    """
+    rq job that is taken out of the sorted set of its queue when it is cancelled or deleted.
+
+    rq removes jobs from their queue through a plain Queue made from the origin, which only
+    knows about the list.
+    """
+
+    def _remove_from_registries(self, pipeline: Optional["Pipeline"] = None, remove_from_queue: bool = True) -> None:
+        if remove_from_queue:
+            (pipeline if pipeline is not None else self.connection).zrem(get_priority_key(self.origin), self.id)
+        super()._remove_from_registries(pipeline=pipeline, remove_from_queue=remove_from_queue)
+
+class PriorityQueue(Queue):
+    """
+    rq queue where job ids are kept in a sorted set, the highest score is run first.
+
+    The rq list for the queue stays empty, so it still works with anything using Queue.all.
+    The score of a job is taken from job.meta["priority_score"] when it is enqueued, and
+    jobs enqueued at_front get an infinite score.
+    """
+    job_class = PriorityJob
+
+    @property
+    def priority_key(self) -> str:
+        return get_priority_key(self.name)
+
+    @property
+    def count(self) -> int:
+        return self.connection.zcard(self.priority_key)
+
+    def count_ahead_of(self, priority: str) -> int:
+        """
+        Amount of waiting jobs that would be run before a new job with the given priority
+        """
+        return self.connection.zcount(self.priority_key, priority_score(priority), math.inf)
+
+    def get_job_ids(self, offset: int = 0, length: int = -1) -> list[str]:
+        end = offset + (length - 1) if length >= 0 else length
+        return [as_text(job_id) for job_id in self.connection.zrevrange(self.priority_key, offset, end)]
+
+    def get_job_position(self, job_or_id: Job | str) -> Optional[int]:
+        job_id = job_or_id.id if isinstance(job_or_id, Job) else job_or_id
+        return self.connection.zrevrank(self.priority_key, job_id)
+
+    def get_score(self, job_or_id: Job | str) -> Optional[float]:
+        job_id = job_or_id.id if isinstance(job_or_id, Job) else job_or_id
+        return self.connection.zscore(self.priority_key, job_id)
+
+    def remove(self, job_or_id: Job | str, pipeline: Optional["Pipeline"] = None) -> Any:
+        job_id = job_or_id.id if isinstance(job_or_id, Job) else job_or_id
+        return (pipeline if pipeline is not None else self.connection).zrem(self.priority_key, job_id)
+
+    def empty(self) -> int:
+        job_ids = self.get_job_ids()
+        pipe = self.connection.pipeline()
+        for job_id in job_ids:
+            pipe.delete(Job.key_for(job_id), Job.dependents_key_for(job_id))
+        pipe.delete(self.priority_key)
+        pipe.execute()
+
+        return len(job_ids)
+
+    def push_job_id(self, job_id: str, pipeline: Optional["Pipeline"] = None, at_front: bool = False) -> None:
+        # The job is added to the sorted set by _enqueue_job, which knows its score
+        pass
+
+    def _enqueue_job(self, job: Job, pipeline: Optional["Pipeline"] = None, at_front: bool = False) -> Job:
+        pipe = pipeline if pipeline is not None else self.connection.pipeline()
+        job = super()._enqueue_job(job, pipeline=pipe, at_front=at_front)
+
+        score = math.inf if at_front else job.meta.get("priority_score", priority_score("low"))
+        pipe.zadd(self.priority_key, {job.id: score})
+        if pipeline is None:
+            pipe.execute()
+
+        return job
+
+    def boost(self, job_or_id: Job | str, amount: float, minimum: float = -math.inf) -> Optional[float]:
+        """
+        Raises the score of a waiting job to at least minimum and then adds amount.
+
+        Returns the new score, or None if the job is not waiting in this queue anymore.
+        """
+        job_id = job_or_id.id if isinstance(job_or_id, Job) else job_or_id
+        pipe = self.connection.pipeline()
+        # XX so that jobs taken by a worker in the meantime are not added back
+        pipe.zadd(self.priority_key, {job_id: minimum}, xx=True, gt=True)
+        pipe.zadd(self.priority_key, {job_id: amount}, xx=True, incr=True)
+        return pipe.execute()[1]
+
+    @classmethod
+    def dequeue_any(cls, queues: list[Queue], timeout: Optional[int], connection: Optional[Redis] = None,
+                    job_class: Optional[Type[Job]] = None, serializer: Any = None,
+                    death_penalty_class: Any = None) -> Any:
+        """
+        Takes the highest scored job of the first queue in the list that is not empty,
+        blocking for up to timeout seconds if they are all empty
+        """
+        job_class = backend_class(cls, "job_class", override=job_class)
+        queues_by_key = {queue.priority_key: queue for queue in queues if isinstance(queue, PriorityQueue)}
+        priority_keys = list(queues_by_key)
+        redis = connection if connection is not None else queues[0].connection
+
+        while True:
+            result = None
+            if timeout is not None:
+                result = redis.bzpopmax(priority_keys, timeout)
+                if result is None:
+                    raise DequeueTimeout(timeout, priority_keys)
+            else:
+                for priority_key in priority_keys:
+                    popped = redis.zpopmax(priority_key)
+                    if len(popped) > 0:
+                        result = (priority_key, *popped[0])
+                        break
+
+            if result is None:
+                return None
+
+            priority_key, job_id, score = as_text(result[0]), as_text(result[1]), float(result[2])
+            queue = queues_by_key[priority_key]
+            try:
+                job = job_class.fetch(job_id, connection=redis, serializer=serializer)
+            except NoSuchJobError:
+                continue
+            # Jobs cancelled through a class that does not know about the sorted set are left in it
+            if job.get_status(refresh=False) != JobStatus.QUEUED:
+                continue
+
+            # Lets the job pass its place in line on to the jobs it enqueues
+            job.meta["priority_score"] = score
+            return job, queue
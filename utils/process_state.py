@@ -0,0 +1,51 @@
+"""
+State each app process shares with the others, so that whichever process a request reaches can
+answer for all of them (see utils/app_processes.py).
+
+Each process writes its state to its own file in a folder made by the supervisor before forking,
+and readers combine the files of every process. Files of processes that exited are kept, so that
+counters summed over them never go backwards.
+"""
+
+import json
+import os
+import time
+from typing import Any
+
+# None when the app runs in a single process
+state_folder: str | None = None
+# Process ID and start time, so that a new process given the ID of an old one does not overwrite its file
+process_key: str | None = None
+
+def share_process_state(folder: str | None) -> None:
+    global state_folder
+    state_folder = folder
+
+def write_process_state(name: str, state: Any) -> None:
+    global process_key
+    if state_folder is None:
+        return
+
+    if process_key is None or not process_key.startswith(f"{os.getpid()}-"):
+        process_key = f"{os.getpid()}-{time.time_ns()}"
+
+    path = os.path.join(state_folder, f"{name}-{process_key}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(state, file)
+    # Readers never see a partly written file
+    os.replace(f"{path}.tmp", path)
+
+def read_process_states(name: str) -> list[Any]:
+    if state_folder is None:
+        return []
+
+    states: list[Any] = []
+    for filename in os.listdir(state_folder):
+        if filename.startswith(f"{name}-") and filename.endswith(".json"):
+            try:
+                with open(os.path.join(state_folder, filename)) as file:
+                    states.append(json.load(file))
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+
+    return states
@@ -0,0 +1,222 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+import mmap
+import struct
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Any, Iterator
+from urllib.parse import parse_qsl, urlencode
+
+from rq.job import Job
+from utils.config import config
+from utils.logger import log
+import utils.process_state as process_state
+
+max_stack_depth = 64
+# Whether request profiling is enabled, and its threshold
+settings_format = struct.Struct("<?d")
+
+def frame_name(frame: FrameType) -> str:
+    return f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})"
+
+class SamplingProfiler:
+    """
+    Periodically samples the stack of one thread from a background thread.
+
+    Nothing is hooked into the profiled thread itself, so the cost is bounded
+    by the sampling interval rather than by how much code runs.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.self_counts: Counter[str] = Counter()
+        self.cumulative_counts: Counter[str] = Counter()
+        self.stack_counts: Counter[tuple[str, ...]] = Counter()
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.start_time = time.monotonic()
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+            self.on_sample()
+
+    def on_sample(self) -> None:
+        pass
+
+    def sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        stack: list[str] = []
+        current: FrameType | None = frame
+        while current is not None and len(stack) < max_stack_depth:
+            stack.append(frame_name(current))
+            current = current.f_back
+
+        with self.lock:
+            self.samples += 1
+            self.self_counts[stack[0]] += 1
+            for name in set(stack):
+                self.cumulative_counts[name] += 1
+            # Outermost first, like a collapsed flamegraph stack
+            self.stack_counts[tuple(reversed(stack))] += 1
+
+    def summary(self, top: int) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "wall_time": round(self.elapsed(), 3),
+                "samples": self.samples,
+                "interval": self.interval,
+                "top_self": self.self_counts.most_common(top),
+                "top_cumulative": self.cumulative_counts.most_common(top),
+                "top_stacks": [[";".join(stack), count] for stack, count in self.stack_counts.most_common(top)],
+            }
+
+class JobProfiler(SamplingProfiler):
+    """
+    Once a job has been running for longer than the threshold, its profile so far
+    is written into the job's meta so it is visible in the current_job output
+    of the status and health check endpoints while the job is still running
+    """
+
+    def __init__(self, job: Job, thread_id: int, interval: float, threshold: float, top: int):
+        super().__init__(thread_id, interval)
+        self.job = job
+        self.threshold = threshold
+        self.top = top
+        self.last_publish = 0.0
+
+    def on_sample(self) -> None:
+        now = time.monotonic()
+        if self.elapsed() > self.threshold and now - self.last_publish > 1:
+            self.last_publish = now
+            try:
+                # Write a copy so the dict is never mutated while the job thread saves the job
+                meta = dict(self.job.meta)
+                meta["profile"] = self.summary(self.top)
+                self.job.connection.hset(self.job.key, "meta", self.job.serializer.dumps(meta))
+            except Exception as e:
+                log("Failed to publish job profile", e)
+
+@contextmanager
+def profile_job(job: Job) -> Iterator[None]:
+    if not config["profiling"]["enabled"]:
+        yield
+        return
+
+    profiler = JobProfiler(job, threading.get_ident(), config["profiling"]["interval"],
+                            config["profiling"]["job_threshold"], config["profiling"]["top"])
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+
+        if profiler.elapsed() > profiler.threshold:
+            summary = profiler.summary(profiler.top)
+            print(f"Slow job {job.id} took {summary['wall_time']} seconds")
+            try:
+                job.meta["profile"] = summary
+                job.save_meta()
+            except Exception as e:
+                log("Failed to save job profile", e)
+
+class RequestProfiling:
+    """
+    The settings are kept in an anonymous mapping made before the app processes are forked
+    (see utils/app_processes.py), so a change through any of them applies to all of them
+    """
+
+    def __init__(self, enabled: bool, threshold: float):
+        self.settings = mmap.mmap(-1, settings_format.size)
+        settings_format.pack_into(self.settings, 0, enabled, threshold)
+        self.profiles: deque[dict[str, Any]] = deque(maxlen=config["profiling"]["max_request_profiles"])
+
+    @property
+    def enabled(self) -> bool:
+        return settings_format.unpack_from(self.settings, 0)[0]
+
+    @enabled.setter
+    def enabled(self, enabled: bool) -> None:
+        settings_format.pack_into(self.settings, 0, enabled, self.threshold)
+
+    @property
+    def threshold(self) -> float:
+        return settings_format.unpack_from(self.settings, 0)[1]
+
+    @threshold.setter
+    def threshold(self, threshold: float) -> None:
+        settings_format.pack_into(self.settings, 0, self.enabled, threshold)
+
+    def add_profile(self, summary: dict[str, Any]) -> None:
+        self.profiles.append(summary)
+        try:
+            process_state.write_process_state("profiles", list(self.profiles))
+        except Exception as e:
+            log("Failed to write request profiles", e)
+
+    def state(self) -> dict[str, Any]:
+        profiles = list(self.profiles)
+        if process_state.state_folder is not None:
+            # The latest of every app process
+            profiles = sorted((profile for process_profiles in process_state.read_process_states("profiles") for profile in process_profiles),
+                              key=lambda profile: profile["finished_at"])[-config["profiling"]["max_request_profiles"]:]
+
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "profiles": profiles,
+        }
+
+# Toggled at runtime through the authenticated profiling endpoint
+request_profiling = RequestProfiling(config["profiling"]["enabled"], config["profiling"]["request_threshold"])
+
+class ProfilingMiddleware:
+    """
+    Pure ASGI middleware so that the disabled path is a single attribute check.
+
+    Requests share the event loop thread, so a profile of one slow request can
+    include samples from other requests that were running at the same time.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if not request_profiling.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profiler = SamplingProfiler(threading.get_ident(), config["profiling"]["interval"])
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+
+            if profiler.elapsed() > request_profiling.threshold:
+                summary = profiler.summary(config["profiling"]["top"])
+                summary["path"] = scope["path"]
+                summary["query_string"] = urlencode([(key, value) for key, value
+                                                    in parse_qsl(scope["query_string"].decode(errors="replace")) if key != "auth"])
+                summary["finished_at"] = time.time()
+                request_profiling.add_profile(summary)
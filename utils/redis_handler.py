@@ -2,33 +2,88 @@ from typing import Any, cast
 from redis import Redis
 from redis.asyncio import Redis as AsyncRedis
 from redis.asyncio.client import PubSub
+import threading
 import time
 from retry import retry
-from rq.queue import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from utils.config import config
+from utils.priority_queue import PriorityJob, PriorityQueue
 
 redis_conn = Redis(host=config["redis"]["host"], port=config["redis"]["port"])
-async_redis_conn: "AsyncRedis[str] | None" = None
 
-queue_high = Queue("high", connection=redis_conn)
-queue_low = Queue("default", connection=redis_conn)
+# Async connections are tied to the event loop they were made on, and worker
+# slots each run their own loop on their own thread
+async_redis_conns = threading.local()
+
+def get_shard_queues(node_id: str | None) -> tuple[PriorityQueue, PriorityQueue]:
+    """
+    Resolve and render queues of a node, with sharding each node has its own (see utils/sharding.py)
+    """
+    suffix = f"-{node_id}" if node_id is not None else ""
+    return PriorityQueue(f"default{suffix}", connection=redis_conn), PriorityQueue(f"render{suffix}", connection=redis_conn)
+
+# First stage of generation, and maintenance jobs such as cleanup, and second stage of
+# generation, fed by the jobs in the resolve queue
+queue_resolve, queue_render = get_shard_queues(config["sharding"]["node_id"] if config["sharding"]["enabled"] else None)
+
+def fetch_job(job_id: str) -> Job | None:
+    """
+    Job with the given ID on any node's queues. Queue.fetch_job only finds jobs enqueued on
+    that queue, which misses the jobs of videos that moved to this node when the ring changed.
+    """
+    try:
+        return PriorityJob.fetch(job_id, connection=queue_resolve.connection)
+    except NoSuchJobError:
+        return None
+
+def get_job_queue(job: Job) -> PriorityQueue:
+    for queue in (queue_resolve, queue_render):
+        if job.origin == queue.name:
+            return queue
+
+    # Another node's
+    return PriorityQueue(job.origin, connection=queue_resolve.connection)
+
+def take_over_job(job: Job) -> Job:
+    """
+    Moves a job still waiting on another node's queue to this node's queue of the same stage,
+    keeping its place in line. Jobs left on the queue of a node that left the ring would
+    otherwise wait until it returns.
+    """
+    queue = get_job_queue(job)
+    if queue in (queue_resolve, queue_render) or not job.is_queued:
+        return job
+
+    score = queue.get_score(job)
+    # Only one of the nodes taking it over, or the worker taking it, gets it out of the old queue
+    if score is None or queue.remove(job) == 0:
+        return job
+
+    job.meta["priority_score"] = score
+    # Queue names are the stage followed by the node ID
+    stage = job.origin.partition("-")[0]
+    return (queue_render if stage == "render" else queue_resolve).enqueue_job(job)
 
 async def init() -> None:
     await get_async_redis_conn()
 
 @retry(tries=5, delay=0.1, backoff=3)
 async def get_async_redis_conn() -> "AsyncRedis[str]":
-    global async_redis_conn
+    async_redis_conn: "AsyncRedis[str] | None" = getattr(async_redis_conns, "conn", None)
     if async_redis_conn is not None:
         return async_redis_conn
 
     async_redis_conn = AsyncRedis(host=config["redis"]["host"], port=config["redis"]["port"])
     await async_redis_conn.ping()
+    async_redis_conns.conn = async_redis_conn
     return async_redis_conn
 
+def set_async_redis_conn(async_redis_conn: "AsyncRedis[str] | None") -> None:
+    async_redis_conns.conn = async_redis_conn
+
 def reset_async_redis_conn() -> None:
-    global async_redis_conn
-    async_redis_conn = None
+    set_async_redis_conn(None)
 
 async def get_redis_pubsub() -> PubSub:
     redis_conn = await get_async_redis_conn()
@@ -36,7 +91,7 @@ async def get_redis_pubsub() -> PubSub:
     return redis_pubsub
 
 @retry(tries=5, delay=0.1, backoff=3)
-async def wait_for_message(key: str, timeout: int = 15) -> str:
+async def wait_for_message(key: str, timeout: int = 15) -> bytes:
     pubsub = None
     try:
         pubsub = await get_redis_pubsub()
@@ -46,8 +101,7 @@ async def wait_for_message(key: str, timeout: int = 15) -> str:
         while True:
             message = cast(dict[str, Any] | None, await pubsub.get_message(timeout=timeout))
             if message is not None:
-                result = message["data"].decode()
-                return result
+                return message["data"]
             elif time.time() - start_time > timeout:
                 raise TimeoutError("Timed out waiting for message")
     finally:
@@ -0,0 +1,189 @@
+"""
+Routes each video to one node, so that its timestamps, hot cache and read cache stay together.
+
+Nodes announce themselves in Redis every heartbeat_interval seconds and are dropped node_ttl
+seconds after their last announcement. Videos are placed on a consistent hash ring with
+virtual_nodes points per node, so a node joining or leaving only moves the videos next to its
+own points. App nodes send requests for videos of other nodes there (see app.py), and each
+node's workers take jobs from that node's own queues (see utils/redis_handler.py).
+"""
+
+import asyncio
+import bisect
+from dataclasses import dataclass
+import hashlib
+import time
+from typing import Any
+
+import httpx
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import RedirectResponse, Response
+from utils.admission import wait_timeout
+from utils.config import config
+from utils.logger import log_error
+from utils.redis_handler import get_async_redis_conn
+
+# Seconds a ring read from Redis is used for before it is read again
+ring_ttl = 5
+# Set on requests sent on by another node, which are always answered locally so that they never loop
+forwarded_header = "X-Shard-Forwarded"
+# Requests answered by the node of the video they are for
+routed_paths = {"/api/v1/getThumbnail"}
+# Belong to each connection rather than the request, or no longer match the body once httpx has decoded it
+hop_by_hop_headers = {"connection", "keep-alive", "transfer-encoding", "content-encoding", "content-length", "host", "accept-encoding"}
+
+@dataclass
+class ShardNode:
+    node_id: str
+    # Base URL of the node's app
+    url: str
+
+class HashRing:
+    def __init__(self, nodes: list[ShardNode], virtual_nodes: int):
+        points = sorted((get_point(f"{node.node_id}#{i}"), node.node_id) for node in nodes for i in range(virtual_nodes))
+        nodes_by_id = {node.node_id: node for node in nodes}
+        self.points = [point for point, _ in points]
+        self.nodes = [nodes_by_id[node_id] for _, node_id in points]
+
+    def get_node(self, key: str) -> ShardNode | None:
+        if len(self.points) == 0:
+            return None
+
+        # The first point after the key's, wrapping around
+        return self.nodes[bisect.bisect(self.points, get_point(key)) % len(self.points)]
+
+def get_point(key: str) -> int:
+    # Not hash(), which differs between processes
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+ring: HashRing | None = None
+ring_read_at = 0.0
+
+async def get_ring() -> HashRing | None:
+    """
+    Ring of the nodes that announced themselves recently, None without sharding
+    """
+    global ring, ring_read_at
+    if not config["sharding"]["enabled"]:
+        return None
+
+    if ring is None or time.monotonic() - ring_read_at > ring_ttl:
+        try:
+            nodes = await get_nodes()
+        except Exception as e:
+            # The last ring is used until Redis answers again, and without one everything is answered here
+            log_error("Failed to read the shard nodes", e)
+            return ring
+
+        ring = HashRing(nodes, config["sharding"]["virtual_nodes"])
+        ring_read_at = time.monotonic()
+
+    return ring
+
+async def get_nodes() -> list[ShardNode]:
+    redis_conn = await get_async_redis_conn()
+    node_ids = [node_id.decode() for node_id in
+                await redis_conn.zrangebyscore(shard_nodes_key(), time.time() - config["sharding"]["node_ttl"], "+inf")]
+    if len(node_ids) == 0:
+        return []
+
+    urls = await redis_conn.hmget(shard_node_urls_key(), node_ids)
+    return [ShardNode(node_id, url.decode()) for node_id, url in zip(node_ids, urls) if url is not None]
+
+async def get_remote_owner(video_id: str) -> ShardNode | None:
+    """
+    The node a video belongs to when it is not this one
+    """
+    current_ring = await get_ring()
+    owner = current_ring.get_node(video_id) if current_ring is not None else None
+    if owner is None or owner.node_id == config["sharding"]["node_id"]:
+        return None
+
+    return owner
+
+async def announce_node() -> None:
+    redis_conn = await get_async_redis_conn()
+    await redis_conn.hset(shard_node_urls_key(), config["sharding"]["node_id"], config["sharding"]["url"])
+    await redis_conn.zadd(shard_nodes_key(), {config["sharding"]["node_id"]: time.time()})
+
+    # Nodes that stopped long ago
+    stopped = await redis_conn.zrangebyscore(shard_nodes_key(), "-inf", time.time() - 10 * config["sharding"]["node_ttl"])
+    if len(stopped) > 0:
+        await redis_conn.zrem(shard_nodes_key(), *stopped)
+        await redis_conn.hdel(shard_node_urls_key(), *stopped)
+
+async def run_heartbeat() -> None:
+    """
+    Keeps this node on the ring until cancelled. A stopped node is dropped once node_ttl has passed.
+    """
+    while True:
+        try:
+            await announce_node()
+        except Exception as e:
+            log_error("Failed to announce this node", e)
+
+        await asyncio.sleep(config["sharding"]["heartbeat_interval"])
+
+class ShardRoutingMiddleware:
+    """
+    Sends requests for a video on to the node it belongs to, by redirect or by proxying
+    depending on read_mode. Pure ASGI so that without sharding it is a single check.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if not config["sharding"]["enabled"] or scope["type"] != "http" or scope["path"] not in routed_paths \
+                or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        video_id = QueryParams(scope["query_string"]).get("videoID")
+        owner = await get_remote_owner(video_id) if video_id is not None and forwarded_header not in headers else None
+        if owner is None:
+            await self.app(scope, receive, send)
+            return
+
+        url = owner.url.rstrip("/") + scope["path"]
+        if scope["query_string"]:
+            url += "?" + scope["query_string"].decode(errors="replace")
+
+        if config["sharding"]["read_mode"] == "redirect":
+            response: Response = RedirectResponse(url, status_code=307)
+        else:
+            try:
+                response = await forward_request(scope["method"], url, headers)
+            except httpx.HTTPError as e:
+                # The owner will have it again once it is back, until then it is made here
+                log_error(f"Failed to forward request to {owner.node_id}", e)
+                await self.app(scope, receive, send)
+                return
+
+        await response(scope, receive, send)
+
+proxy_client: httpx.AsyncClient | None = None
+
+async def forward_request(method: str, url: str, headers: Headers) -> Response:
+    global proxy_client
+    if proxy_client is None:
+        # The owner can wait for the thumbnail to be generated before answering
+        proxy_client = httpx.AsyncClient(timeout=wait_timeout + 5)
+
+    request_headers = {name: value for name, value in headers.items() if name not in hop_by_hop_headers}
+    request_headers[forwarded_header] = "1"
+    owner_response = await proxy_client.request(method, url, headers=request_headers)
+
+    response_headers = {name: value for name, value in owner_response.headers.items() if name.lower() not in hop_by_hop_headers}
+    if method == "HEAD" and "content-length" in owner_response.headers:
+        # Gives the size of the body that was not sent
+        response_headers["content-length"] = owner_response.headers["content-length"]
+
+    return Response(owner_response.content, status_code=owner_response.status_code, headers=response_headers)
+
+def shard_nodes_key() -> str:
+    return "shard-nodes"
+
+def shard_node_urls_key() -> str:
+    return "shard-node-urls"
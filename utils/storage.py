@@ -0,0 +1,549 @@
+"""
+Where thumbnails are stored, so that the app and the workers do not need to share a folder.
+
+Files are named by paths relative to the root of the storage, like "{video_id}/{time}.webp".
+LocalStorage keeps them in thumbnail_storage.path. S3Storage keeps them in a bucket of an
+S3 compatible object store, so app and worker nodes can be added without a shared volume,
+and CachedStorage keeps local copies of the images each app node reads from it.
+
+Images at a time are only ever written once, as a whole, so local copies of them do not need
+to be checked against the object store. Titles and listings can change, so they are only kept
+in memory for a few seconds.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+import hmac
+import os
+import shutil
+import threading
+import time
+from typing import Any, Callable, TypeVar
+from urllib.parse import quote, urlparse
+from xml.etree import ElementTree
+
+import requests
+
+from constants.thumbnail import image_format
+from utils.config import config
+from utils.logger import log_error
+
+T = TypeVar("T")
+
+s3_namespace = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+# Seconds to wait for the object store
+s3_timeout = 10
+# The read cache is cut down to this fraction of its size once it is full
+read_cache_evict_to = 0.9
+# Seconds the read cache uses listings and titles read from the object store for
+remote_cache_ttl = 5
+# Listings and titles kept in memory at most
+remote_cache_entries = 10000
+
+@dataclass
+class StoredFile:
+    size: int
+    # Modification time, which with the size identifies the content since files are only rewritten as a whole
+    mtime_ns: int
+
+    @staticmethod
+    def from_stat(stat: os.stat_result) -> "StoredFile":
+        return StoredFile(stat.st_size, stat.st_mtime_ns)
+
+@dataclass
+class StoredEntry:
+    # Name within its folder
+    name: str
+    file: StoredFile
+
+class Storage(ABC):
+    # Calls go over the network, so async code runs them in a thread, see call_storage
+    remote = False
+
+    @abstractmethod
+    def read(self, name: str) -> tuple[bytes, StoredFile]:
+        ...
+
+    @abstractmethod
+    def stat(self, name: str) -> StoredFile:
+        ...
+
+    @abstractmethod
+    def write(self, name: str, data: bytes) -> StoredFile:
+        """
+        Replaces the file as a whole, readers never see part of it
+        """
+        ...
+
+    @abstractmethod
+    def remove(self, name: str) -> None:
+        ...
+
+    @abstractmethod
+    def list_files(self, folder: str, prefix: str = "") -> list[StoredEntry]:
+        """
+        Files in a folder with names starting with the prefix, none when the folder does not exist
+        """
+        ...
+
+    @abstractmethod
+    def list_folders(self) -> list[str]:
+        ...
+
+    @abstractmethod
+    def delete_folder(self, folder: str) -> None:
+        ...
+
+    def read_start(self, name: str, length: int) -> bytes:
+        """
+        Up to length bytes from the start of the file, for backends that can read less than all of it
+        """
+        return self.read(name)[0][:length]
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.stat(name)
+            return True
+        except FileNotFoundError:
+            return False
+
+class LocalStorage(Storage):
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self, name: str) -> tuple[bytes, StoredFile]:
+        with open(self.get_path(name), "rb") as file:
+            return file.read(), StoredFile.from_stat(os.fstat(file.fileno()))
+
+    def read_start(self, name: str, length: int) -> bytes:
+        with open(self.get_path(name), "rb") as file:
+            return file.read(length)
+
+    def stat(self, name: str) -> StoredFile:
+        return StoredFile.from_stat(os.stat(self.get_path(name)))
+
+    def write(self, name: str, data: bytes) -> StoredFile:
+        path = self.get_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return StoredFile.from_stat(write_file_atomically(path, data))
+
+    def remove(self, name: str) -> None:
+        os.remove(self.get_path(name))
+
+    def list_files(self, folder: str, prefix: str = "") -> list[StoredEntry]:
+        entries: list[StoredEntry] = []
+        try:
+            with os.scandir(self.get_path(folder)) as it:
+                for entry in it:
+                    # Files still being written are left out
+                    if entry.is_file() and entry.name.startswith(prefix) and not entry.name.endswith(".tmp"):
+                        try:
+                            entries.append(StoredEntry(entry.name, StoredFile.from_stat(entry.stat())))
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def list_folders(self) -> list[str]:
+        try:
+            with os.scandir(self.path) as it:
+                return [entry.name for entry in it if entry.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    def delete_folder(self, folder: str) -> None:
+        shutil.rmtree(self.get_path(folder))
+
+    def get_path(self, name: str) -> str:
+        return f"{self.path}/{name}"
+
+class S3Storage(Storage):
+    """
+    Objects in a bucket, addressed by path so that S3 compatible stores like MinIO work without DNS for each bucket.
+    Requests are signed with AWS Signature Version 4.
+    """
+    remote = True
+
+    def __init__(self, endpoint: str, bucket: str, region: str, access_key: str, secret_key: str):
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlparse(self.endpoint).netloc
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        # Sessions are not thread safe, and async code calls the storage from several threads
+        self.sessions = threading.local()
+
+    def read(self, name: str) -> tuple[bytes, StoredFile]:
+        response = self.request("GET", name)
+        return response.content, get_stored_file(response)
+
+    def read_start(self, name: str, length: int) -> bytes:
+        # Stores without range support send the whole object
+        return self.request("GET", name, headers={"Range": f"bytes=0-{length - 1}"}).content[:length]
+
+    def stat(self, name: str) -> StoredFile:
+        return get_stored_file(self.request("HEAD", name))
+
+    def write(self, name: str, data: bytes) -> StoredFile:
+        self.request("PUT", name, data=data)
+        # The modification time is only known to the store
+        return self.stat(name)
+
+    def remove(self, name: str) -> None:
+        self.request("DELETE", name)
+
+    def list_files(self, folder: str, prefix: str = "") -> list[StoredEntry]:
+        folder_prefix = f"{folder}/"
+        return [StoredEntry(key.removeprefix(folder_prefix), file)
+                for key, file in self.list_objects(folder_prefix + prefix, None)[0]]
+
+    def list_folders(self) -> list[str]:
+        return [prefix.removesuffix("/") for prefix in self.list_objects("", "/")[1]]
+
+    def delete_folder(self, folder: str) -> None:
+        for entry in self.list_files(folder):
+            self.remove(f"{folder}/{entry.name}")
+
+    def list_objects(self, prefix: str, delimiter: str | None) -> tuple[list[tuple[str, StoredFile]], list[str]]:
+        """
+        Objects with the key prefix and, with a delimiter, the prefixes of keys below them
+        """
+        objects: list[tuple[str, StoredFile]] = []
+        prefixes: list[str] = []
+        query = {"list-type": "2", "prefix": prefix}
+        if delimiter is not None:
+            query["delimiter"] = delimiter
+
+        while True:
+            root = ElementTree.fromstring(self.request("GET", None, query).content)
+            for contents in root.iter(f"{s3_namespace}Contents"):
+                last_modified = datetime.fromisoformat(contents.findtext(f"{s3_namespace}LastModified", "").replace("Z", "+00:00"))
+                objects.append((contents.findtext(f"{s3_namespace}Key", ""),
+                                StoredFile(int(contents.findtext(f"{s3_namespace}Size", "0")),
+                                           get_mtime_ns(last_modified, contents.findtext(f"{s3_namespace}ETag")))))
+            for common_prefix in root.iter(f"{s3_namespace}CommonPrefixes"):
+                prefixes.append(common_prefix.findtext(f"{s3_namespace}Prefix", ""))
+
+            continuation_token = root.findtext(f"{s3_namespace}NextContinuationToken")
+            if root.findtext(f"{s3_namespace}IsTruncated") != "true" or continuation_token is None:
+                return objects, prefixes
+            query["continuation-token"] = continuation_token
+
+    def request(self, method: str, key: str | None, query: dict[str, str] | None = None, data: bytes = b"",
+                headers: dict[str, str] | None = None) -> requests.Response:
+        path = f"/{quote(self.bucket)}" + (f"/{quote(key)}" if key is not None else "")
+        canonical_query = "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+                                   for name, value in sorted((query or {}).items()))
+        url = self.endpoint + path + (f"?{canonical_query}" if canonical_query else "")
+
+        response = self.get_session().request(method, url, data=data if method == "PUT" else None,
+                                        headers={**(headers or {}), **self.sign(method, path, canonical_query, data)}, timeout=s3_timeout)
+        if response.status_code == 404:
+            raise FileNotFoundError(f"{key} not found in bucket {self.bucket}")
+        response.raise_for_status()
+
+        return response
+
+    def get_session(self) -> requests.Session:
+        session: requests.Session | None = getattr(self.sessions, "session", None)
+        if session is None:
+            session = requests.Session()
+            self.sessions.session = session
+
+        return session
+
+    def sign(self, method: str, path: str, canonical_query: str, data: bytes) -> dict[str, str]:
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        date = amz_date[:8]
+        payload_hash = hashlib.sha256(data).hexdigest()
+        headers = {
+            "host": self.host,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{name}:{headers[name]}\n" for name in sorted(headers))
+        canonical_request = "\n".join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+        signing_key = f"AWS4{self.secret_key}".encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        del headers["host"]
+        headers["Authorization"] = f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, " \
+                                   f"SignedHeaders={signed_headers}, Signature={signature}"
+        return headers
+
+class CachedStorage(Storage):
+    """
+    Reads images through a local copy, kept under a size limit by removing the least recently read ones.
+    Listings and titles are kept in memory for remote_cache_ttl seconds, and missing titles as well.
+    """
+    remote = True
+
+    def __init__(self, backend: Storage, path: str, size: int):
+        self.backend = backend
+        self.cache = LocalStorage(path)
+        self.max_size = size
+        self.size: int | None = None
+        self.lock = threading.Lock()
+        self.memory_lock = threading.Lock()
+        # Expiry time and value, None for a missing title
+        self.listings: dict[tuple[str, str], tuple[float, list[StoredEntry]]] = {}
+        self.titles: dict[str, tuple[float, tuple[bytes, StoredFile] | None]] = {}
+
+    def read(self, name: str) -> tuple[bytes, StoredFile]:
+        if not name.endswith(image_format):
+            return self.read_title(name)
+
+        try:
+            data, file = self.cache.read(name)
+            self.mark_read(name, file)
+            return data, file
+        except FileNotFoundError:
+            pass
+
+        data, file = self.backend.read(name)
+        self.put(name, data, file)
+
+        return data, file
+
+    def read_start(self, name: str, length: int) -> bytes:
+        if name.endswith(image_format):
+            try:
+                return self.cache.read_start(name, length)
+            except FileNotFoundError:
+                pass
+
+        return self.backend.read_start(name, length)
+
+    def stat(self, name: str) -> StoredFile:
+        if not name.endswith(image_format):
+            # Titles are small, so they are read whole to be kept
+            return self.read_title(name)[1]
+
+        try:
+            return self.cache.stat(name)
+        except FileNotFoundError:
+            pass
+
+        return self.backend.stat(name)
+
+    def write(self, name: str, data: bytes) -> StoredFile:
+        file = self.backend.write(name, data)
+        self.forget_listings(name.split("/")[0])
+        if name.endswith(image_format):
+            self.put(name, data, file)
+        else:
+            self.remember(self.titles, name, (data, file))
+
+        return file
+
+    def remove(self, name: str) -> None:
+        self.backend.remove(name)
+        self.forget_listings(name.split("/")[0])
+        with self.memory_lock:
+            self.titles.pop(name, None)
+        try:
+            self.cache.remove(name)
+        except FileNotFoundError:
+            pass
+
+    def list_files(self, folder: str, prefix: str = "") -> list[StoredEntry]:
+        with self.memory_lock:
+            listing = self.listings.get((folder, prefix))
+        if listing is not None and listing[0] > time.monotonic():
+            return listing[1]
+
+        entries = self.backend.list_files(folder, prefix)
+        self.remember(self.listings, (folder, prefix), entries)
+        return entries
+
+    def list_folders(self) -> list[str]:
+        return self.backend.list_folders()
+
+    def delete_folder(self, folder: str) -> None:
+        self.backend.delete_folder(folder)
+        self.forget_listings(folder)
+        with self.memory_lock:
+            for name in [name for name in self.titles if name.startswith(f"{folder}/")]:
+                del self.titles[name]
+        shutil.rmtree(self.cache.get_path(folder), ignore_errors=True)
+
+    def read_title(self, name: str) -> tuple[bytes, StoredFile]:
+        with self.memory_lock:
+            title = self.titles.get(name)
+        if title is None or title[0] <= time.monotonic():
+            try:
+                value: tuple[bytes, StoredFile] | None = self.backend.read(name)
+            except FileNotFoundError:
+                value = None
+            self.remember(self.titles, name, value)
+        else:
+            value = title[1]
+
+        if value is None:
+            raise FileNotFoundError(f"{name} not found")
+        return value
+
+    def remember(self, entries: dict[Any, tuple[float, Any]], key: Any, value: Any) -> None:
+        now = time.monotonic()
+        with self.memory_lock:
+            if len(entries) >= remote_cache_entries:
+                for expired in [entry_key for entry_key, (expires_at, _) in entries.items() if expires_at <= now]:
+                    del entries[expired]
+                if len(entries) >= remote_cache_entries:
+                    entries.clear()
+
+            entries[key] = (now + remote_cache_ttl, value)
+
+    def forget_listings(self, folder: str) -> None:
+        with self.memory_lock:
+            for key in [key for key in self.listings if key[0] == folder]:
+                del self.listings[key]
+
+    def put(self, name: str, data: bytes, file: StoredFile) -> None:
+        try:
+            self.cache.write(name, data)
+            # Keeps the validators of the object store, which are made from the modification time
+            os.utime(self.cache.get_path(name), ns=(time.time_ns(), file.mtime_ns))
+        except OSError as e:
+            log_error(f"Failed to store {name} in the read cache", e)
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.get_cache_size()
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.size = self.evict()
+
+    def mark_read(self, name: str, file: StoredFile) -> None:
+        # The access time orders the copies for eviction, which does not depend on the mount's atime setting
+        try:
+            os.utime(self.cache.get_path(name), ns=(time.time_ns(), file.mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    def get_cache_size(self) -> int:
+        return sum(os.stat(path).st_size for path in self.get_cache_files())
+
+    def get_cache_files(self) -> list[str]:
+        return [os.path.join(folder, name) for folder, _, names in os.walk(self.cache.path) for name in names]
+
+    def evict(self) -> int:
+        """
+        Removes the least recently read copies until the cache is below its limit, returning its size
+        """
+        files: list[tuple[int, int, str]] = []
+        for path in self.get_cache_files():
+            try:
+                stat = os.stat(path)
+                files.append((stat.st_atime_ns, stat.st_size, path))
+            except FileNotFoundError:
+                pass
+
+        files.sort()
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in files:
+            if size <= self.max_size * read_cache_evict_to:
+                break
+
+            try:
+                os.remove(path)
+                size -= file_size
+            except FileNotFoundError:
+                pass
+
+        return size
+
+def get_stored_file(response: requests.Response) -> StoredFile:
+    return StoredFile(int(response.headers["Content-Length"]),
+                      get_mtime_ns(parsedate_to_datetime(response.headers["Last-Modified"]), response.headers.get("ETag")))
+
+def get_mtime_ns(last_modified: datetime, etag: str | None) -> int:
+    """
+    Listings have milliseconds and headers only seconds, so both are cut to seconds. The part below
+    a second is made from the object's ETag instead, so that files written twice in one second
+    still get different validators.
+    """
+    seconds = int(last_modified.astimezone(timezone.utc).timestamp())
+    if etag is None:
+        return seconds * 1_000_000_000
+
+    return seconds * 1_000_000_000 + int.from_bytes(hashlib.sha256(etag.strip('"').encode()).digest()[:4], "little") % 1_000_000_000
+
+def write_file_atomically(filename: str, data: bytes) -> os.stat_result:
+    """
+    Writes to a temporary file next to it first and renames it into place, so readers see either the old file or
+    the whole new one. Returns the stat of the new file.
+    """
+    temp_filename = f"{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(temp_filename, "wb") as file:
+            file.write(data)
+            file.flush()
+            stat = os.fstat(file.fileno())
+        os.replace(temp_filename, filename)
+    finally:
+        try:
+            os.remove(temp_filename)
+        except FileNotFoundError:
+            pass
+
+    return stat
+
+storage: Storage | None = None
+storage_settings: tuple[Any, ...] | None = None
+
+def get_storage() -> Storage:
+    """
+    The storage of this process, made again when the storage config changes
+    """
+    global storage, storage_settings
+    storage_config = config["thumbnail_storage"]
+    settings = (storage_config["backend"], storage_config["path"], str(storage_config["s3"]),
+                storage_config["read_cache_path"], storage_config["read_cache_size"])
+    if storage is None or settings != storage_settings:
+        storage = create_storage()
+        storage_settings = settings
+
+    return storage
+
+def create_storage() -> Storage:
+    storage_config = config["thumbnail_storage"]
+    if storage_config["backend"] == "local":
+        return LocalStorage(storage_config["path"])
+    elif storage_config["backend"] != "s3":
+        raise ValueError(f"Unknown storage backend: {storage_config['backend']}")
+
+    s3_config = storage_config["s3"]
+    if s3_config is None:
+        raise ValueError("thumbnail_storage.s3 is needed for the s3 storage backend")
+
+    backend = S3Storage(s3_config["endpoint"], s3_config["bucket"], s3_config["region"],
+                        s3_config["access_key"], s3_config["secret_key"])
+    if storage_config["read_cache_size"] > 0:
+        return CachedStorage(backend, storage_config["read_cache_path"], storage_config["read_cache_size"])
+
+    return backend
+
+async def call_storage(function: Callable[..., T], *args: Any) -> T:
+    """
+    Calls a storage function from async code, in a thread when the storage is remote so that the event loop is not held up
+    """
+    if get_storage().remote:
+        return await asyncio.to_thread(function, *args)
+
+    return function(*args)
@@ -1,91 +1,244 @@
 import asyncio
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+import json
 import math
 import os
 import random
 import re
+import struct
 import sys
 from typing import cast
 import requests
 
-from .ffmpeg import run_ffmpeg, FFmpegError
+from .ffmpeg import run_ffmpeg_output, FFmpegError, FFmpegNotFoundError, TimeoutExpired
 import pathlib
 
 from retry import retry
+from retry.api import retry_call
+from rq import get_current_job
 from utils.cleanup import add_storage_used, check_if_cleanup_needed, update_last_used
-from utils.proxy import get_proxy_url
+from utils.container_index import ContainerIndexError, RangeReader, read_index, write_segment_file
+from utils.floatie import InnertubeBotCheckError, InnertubeLoginRequiredError, InnertubePlayabilityError
+from utils.format_selection import record_render_time
+from utils.hot_cache import get_hot_cache
+from utils.negative_cache import cache_failure
+from utils.proxy import ProxyInfo, get_proxy_url
+from utils.storage import StoredFile, call_storage, get_storage
 from utils.video import PlaybackUrl, get_playback_url, valid_video_id
 from utils.config import config
 import time as time_module
-from utils.redis_handler import get_async_redis_conn, redis_conn
+from utils.redis_handler import get_async_redis_conn, queue_render, redis_conn
 from utils.logger import log, log_error
 from constants.thumbnail import image_format, metadata_format, minimum_file_size
 
 VIDEO_REQUEST_TIMEOUT = 5
+# The fps of a video does not change, this only bounds how long unused ones are kept
+fps_ttl = 30 * 24 * 60 * 60
+# Time, modification time of the metadata file (-1 without one), and lengths of the served
+# filename, ETag and title, followed by them and the image
+hot_entry_format = struct.Struct("<dqHHI")
 
 class ThumbnailGenerationError(Exception):
     pass
 
+class PremiereError(ThumbnailGenerationError):
+    pass
+
 @dataclass
 class Thumbnail:
     image: bytes
     time: float
     title: str | None = None
+    etag: str | None = None
+    last_modified: float | None = None
+
+@dataclass
+class ThumbnailFile:
+    time: float
+    # None for a variant that has not been made yet
+    etag: str | None
+    last_modified: float | None
+    size: int | None
+
+@dataclass
+class ResolvedPlayback:
+    """
+    Output of the resolve stage, handed to the render stage through the render queue
+    """
+    playback_url: PlaybackUrl
+    proxy: ProxyInfo | None
 
 # Redis queue does not properly support async, and doesn't need it anyway since it is
 # only running one job at a time
 def generate_thumbnail(video_id: str, time: float, title: str | None, is_livestream: bool = False, update_redis: bool = True) -> None:
     try:
         now = time_module.time()
-        if not valid_video_id(video_id):
-            raise ValueError(f"Invalid video ID: {video_id}")
-        if type(time) is not float:
-            raise ValueError(f"Invalid time: {time}")
+        validate_thumbnail_request(video_id, time)
 
         if update_redis:
-            try:
-                asyncio.get_event_loop().run_until_complete(update_last_used(video_id))
-            except Exception as e:
-                log_error("Failed to update last used", e)
+            mark_video_used(video_id)
 
-        generate_and_store_thumbnail(video_id, time, is_livestream)
+        image_data = generate_and_store_thumbnail(video_id, time, is_livestream)
+        finish_thumbnail(video_id, time, title, is_livestream, update_redis, image_data)
 
-        _, output_filename, metadata_filename, _ = get_file_paths(video_id, time, is_livestream)
-        if title is not None:
-            with open(metadata_filename, "w") as metadata_file:
-                metadata_file.write(title)
+        log(f"Generated thumbnail for {video_id} at {time} in {time_module.time() - now} seconds")
 
-        title_file_size = len(title.encode("utf-8")) if title else 0
-        image_file_size = os.path.getsize(output_filename)
-        storage_used = title_file_size + image_file_size
+    except Exception as e:
+        log(f"Failed to generate thumbnail for {video_id} at {time}: {e}")
+        record_failure(video_id, e)
+        publish_job_status(video_id, time, "false")
+        raise e
 
-        if image_file_size < minimum_file_size:
-            os.remove(output_filename)
-            if update_redis:
-                try:
-                    asyncio.get_event_loop().run_until_complete(add_storage_used(title_file_size))
-                except Exception as e:
-                    log_error("Failed to update storage used", e)
+def resolve_thumbnail(video_id: str, time: float, title: str | None, is_livestream: bool = False,
+                        update_redis: bool = True) -> None:
+    """
+    First stage of generation: finds a playback URL and passes it on to the render queue,
+    so that render workers are never held up by slow or rate limited URL resolution
+    """
+    try:
+        validate_thumbnail_request(video_id, time)
+
+        if update_redis:
+            mark_video_used(video_id)
+
+        resolved_playback = resolve_playback(video_id, is_livestream)
+
+        # Keep the place in line the resolve job had
+        job = get_current_job()
+        queue_render.enqueue(render_thumbnail,
+                        args=(video_id, time, title, is_livestream, resolved_playback, update_redis),
+                        job_id=get_render_job_id(video_id, time),
+                        # The default description would include the proxy credentials
+                        description=f"render_thumbnail({video_id}, {time})",
+                        job_timeout=30,
+                        failure_ttl=500,
+                        meta=job.meta if job is not None else {})
+
+    except Exception as e:
+        log(f"Failed to resolve playback url for {video_id} at {time}: {e}")
+        record_failure(video_id, e)
+        publish_job_status(video_id, time, "false")
+        raise e
+
+def render_thumbnail(video_id: str, time: float, title: str | None, is_livestream: bool,
+                        resolved_playback: ResolvedPlayback, update_redis: bool = True) -> None:
+    """
+    Second stage of generation, renders from a playback URL found by resolve_thumbnail
+    """
+    try:
+        now = time_module.time()
+        validate_thumbnail_request(video_id, time)
+
+        image_data = retry_call(render_and_store_thumbnail, fargs=[video_id, time, is_livestream, resolved_playback],
+                    exceptions=ThumbnailGenerationError, tries=2, delay=1)
+        finish_thumbnail(video_id, time, title, is_livestream, update_redis, image_data)
+
+        log(f"Rendered thumbnail for {video_id} at {time} in {time_module.time() - now} seconds")
+
+    except Exception as e:
+        log(f"Failed to render thumbnail for {video_id} at {time}: {e}")
+        record_failure(video_id, e)
+        publish_job_status(video_id, time, "false")
+        raise e
 
-            raise ThumbnailGenerationError(f"Image file for {video_id} at {time} is too small, probably a premiere: {image_file_size} bytes")
+def get_failure_reason(e: BaseException) -> str | None:
+    """
+    Failures that would happen again for any time of the video, see negative_cache
+    """
+    cause: BaseException | None = e
+    while cause is not None:
+        if isinstance(cause, InnertubePlayabilityError):
+            return "unplayable"
+        elif isinstance(cause, InnertubeBotCheckError):
+            # Passes with other visitor data or another proxy
+            return None
+        elif isinstance(cause, InnertubeLoginRequiredError):
+            return "login_required"
+        elif isinstance(cause, PremiereError):
+            return "premiere"
+
+        cause = cause.__cause__ or cause.__context__
+
+    return None
+
+def record_failure(video_id: str, e: BaseException) -> None:
+    reason = get_failure_reason(e)
+    if reason is not None:
+        cache_failure(video_id, reason)
+
+def validate_thumbnail_request(video_id: str, time: float) -> None:
+    if not valid_video_id(video_id):
+        raise ValueError(f"Invalid video ID: {video_id}")
+    if type(time) is not float:
+        raise ValueError(f"Invalid time: {time}")
+
+def mark_video_used(video_id: str) -> None:
+    try:
+        asyncio.get_event_loop().run_until_complete(update_last_used(video_id))
+    except Exception as e:
+        log_error("Failed to update last used", e)
+
+def finish_thumbnail(video_id: str, time: float, title: str | None, is_livestream: bool, update_redis: bool, image_data: bytes) -> None:
+    """
+    Stores the rendered image once it has been checked, so that a request never finds a partly written or invalid file
+    """
+    _, image_name, metadata_name = get_file_names(video_id, time, is_livestream)
+    if title is not None:
+        get_storage().write(metadata_name, title.encode())
+
+    title_file_size = len(title.encode("utf-8")) if title else 0
+    image_file_size = len(image_data)
+    storage_used = title_file_size + image_file_size
 
+    if image_file_size < minimum_file_size or get_webp_width(image_data) is None:
         if update_redis:
             try:
-                asyncio.get_event_loop().run_until_complete(add_storage_used(storage_used))
+                asyncio.get_event_loop().run_until_complete(add_storage_used(title_file_size))
             except Exception as e:
                 log_error("Failed to update storage used", e)
-        publish_job_status(video_id, time, "true")
-        check_if_cleanup_needed()
 
-        log(f"Generated thumbnail for {video_id} at {time} in {time_module.time() - now} seconds")
+        if image_file_size < minimum_file_size:
+            raise PremiereError(f"Image file for {video_id} at {time} is too small, probably a premiere: {image_file_size} bytes")
+        raise ThumbnailGenerationError(f"Image for {video_id} at {time} is not a valid WebP image")
 
+    image_file = get_storage().write(image_name, image_data)
+
+    if update_redis:
+        try:
+            asyncio.get_event_loop().run_until_complete(add_storage_used(storage_used))
+        except Exception as e:
+            log_error("Failed to update storage used", e)
+    publish_job_status(video_id, time, "true", get_finished_message_thumbnail(time, metadata_name, title, image_data, image_file))
+    check_if_cleanup_needed()
+
+def get_finished_message_thumbnail(time: float, metadata_name: str, title: str | None, image_data: bytes,
+                                   image_file: StoredFile) -> Thumbnail | None:
+    """
+    The thumbnail to send with the completion message, so that waiting requests do not read it back from storage
+    """
+    if len(image_data) > config["completion_image_max_size"]:
+        return None
+
+    metadata_file: StoredFile | None = None
+    try:
+        if title is None:
+            metadata, metadata_file = get_storage().read(metadata_name)
+            title = metadata.decode()
+        else:
+            metadata_file = get_storage().stat(metadata_name)
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        log(f"Failed to generate thumbnail for {video_id} at {time}: {e}")
-        publish_job_status(video_id, time, "false")
-        raise e
+        log_error(f"Failed to read {metadata_name} for the completion message", e)
+        return None
+
+    return Thumbnail(image_data, time, title, *get_validators(image_file, metadata_file)[:2])
 
 @retry(ThumbnailGenerationError, tries=2, delay=1)
-def generate_and_store_thumbnail(video_id: str, time: float, is_livestream: bool) -> None:
+def generate_and_store_thumbnail(video_id: str, time: float, is_livestream: bool) -> bytes:
+    return render_and_store_thumbnail(video_id, time, is_livestream, resolve_playback(video_id, is_livestream))
+
+def resolve_playback(video_id: str, is_livestream: bool) -> ResolvedPlayback:
     print("playback url start", time_module.time())
 
     proxy = get_proxy_url()
@@ -99,19 +252,31 @@ def generate_and_store_thumbnail(video_id: str, time: float, is_livestream: bool
 
     print("playback url done", time_module.time())
 
+    try:
+        redis_conn.set(get_fps_key(video_id), playback_url.fps, ex=fps_ttl)
+    except Exception as e:
+        log_error("Failed to store fps", e)
+
+    return ResolvedPlayback(playback_url, proxy)
+
+def render_and_store_thumbnail(video_id: str, time: float, is_livestream: bool, resolved_playback: ResolvedPlayback) -> bytes:
+    playback_url = resolved_playback.playback_url
+    proxy = resolved_playback.proxy
+    proxy_url = proxy.url if proxy is not None else None
+
     try:
         try:
             proxy_to_use = proxy_url if config["skip_local_ffmpeg"] else None
             print(f"Generating image for {video_id}, {time_module.time()}"
                     f"{'' if proxy_to_use is None or proxy is None else f' through proxy {proxy.country_code}'}")
 
-            generate_with_ffmpeg(video_id, time, playback_url, is_livestream, proxy_to_use)
+            image_data = generate_with_ffmpeg(video_id, time, playback_url, is_livestream, proxy_to_use)
             print("generated", time_module.time())
         except FFmpegError:
             if proxy_url is not None and proxy is not None and not config["skip_local_ffmpeg"]:
                 # try again through proxy
                 print(f"Trying to generate again through the proxy {proxy.country_code} {time_module.time()}")
-                generate_with_ffmpeg(video_id, time, playback_url, is_livestream, proxy_url)
+                image_data = generate_with_ffmpeg(video_id, time, playback_url, is_livestream, proxy_url)
             else:
                 raise
     except FFmpegError as e:
@@ -124,8 +289,13 @@ def generate_and_store_thumbnail(video_id: str, time: float, is_livestream: bool
     if proxy is not None and proxy.status_url is not None:
         send_success_status(proxy.status_url)
 
+    return image_data
+
 def generate_with_ffmpeg(video_id: str, time: float, playback_url: PlaybackUrl,
-                            is_livestream: bool, proxy_url: str | None = None) -> None:
+                            is_livestream: bool, proxy_url: str | None = None) -> bytes:
+    """
+    Renders the frame into memory, it is only written to the cache folder by finish_thumbnail
+    """
     wait_time = 0
     # time_module.sleep(5)
     while redis_conn.zcard("concurrent_renders") > config["max_concurrent_renders"]:
@@ -138,12 +308,14 @@ def generate_with_ffmpeg(video_id: str, time: float, playback_url: PlaybackUrl,
 
         time_module.sleep(0.1 + 0.05 * random.random())
     redis_conn.zadd("concurrent_renders", { f"{video_id} {time} {is_livestream}": time_module.time() })
+    render_start = time_module.time()
 
-    output_folder, output_filename, _, video_filename = get_file_paths(video_id, time, is_livestream)
+    output_folder, _, _, video_filename = get_file_paths(video_id, time, is_livestream)
     pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
 
     # Round down time to nearest frame be consistent with browsers
-    rounded_time = int(time * playback_url.fps) / playback_url.fps
+    frame_time = get_frame_index(time, playback_url.fps) / playback_url.fps
+    rounded_time = frame_time
 
     # Rounding error with 60 fps videos cause the wrong frame to render
     if playback_url.fps == 60:
@@ -190,46 +362,88 @@ def generate_with_ffmpeg(video_id: str, time: float, playback_url: PlaybackUrl,
     http_proxy = []
     if proxy_url is not None and not is_livestream:
         http_proxy = ["-http_proxy", proxy_url]
+
+    downloaded_segment = False
+    seek_time: float | None = None
+    image_data: bytes | None = None
     try:
-        # Now YouTube is forcing some waiting time, check to be sure video is ready
-        test_data = requests.get(playback_url.url,
-                                 timeout=5,
-                                 headers={"Range": "bytes=0-10000"},
-                                 proxies=proxies)
-        print(len(test_data.content))
-
-        run_ffmpeg(
-            "-y",
-            *http_proxy,
-            "-ss", str(rounded_time), "-i", video_filename if is_livestream else playback_url.url,
-            "-vframes", "1", "-lossless", "0", "-pix_fmt", "bgra", output_filename,
-            "-timelimit", "20",
-            "-tls_verify", "0",
-            timeout=20,
-        )
-    except FFmpegError:
-        try:
-            os.remove(output_filename)
-        except FileNotFoundError:
-            pass
+        if not is_livestream and config["range_rendering"]:
+            try:
+                seek_time = download_frame_segment(playback_url.url, frame_time, playback_url.fps, video_filename, proxies)
+                downloaded_segment = True
+            except Exception as e:
+                log_error(f"Failed to download the segment for {video_id} at {time}", e)
+        else:
+            # Now YouTube is forcing some waiting time, check to be sure video is ready
+            test_data = requests.get(playback_url.url,
+                                     timeout=5,
+                                     headers={"Range": "bytes=0-10000"},
+                                     proxies=proxies)
+            print(len(test_data.content))
+
+        if seek_time is not None:
+            try:
+                image_data = run_ffmpeg_render(video_filename, seek_time, [])
+            except FFmpegError as e:
+                log_error(f"Failed to render the segment for {video_id} at {time}, seeking the full video instead", e)
 
-        raise
+        if image_data is None:
+            image_data = run_ffmpeg_render(video_filename if is_livestream else playback_url.url, rounded_time, http_proxy)
+
+        if not is_livestream:
+            record_render_time(playback_url, time_module.time() - render_start)
     finally:
-        if is_livestream:
+        if is_livestream or downloaded_segment:
             os.remove(video_filename)
 
         redis_conn.zrem("concurrent_renders", f"{video_id} {time} {is_livestream}")
 
-async def get_latest_thumbnail_from_files(video_id: str, is_livestream: bool) -> Thumbnail:
+    return image_data
+
+def run_ffmpeg_render(input: str, seek_time: float, http_proxy: list[str]) -> bytes:
+    return run_ffmpeg_output(
+        "-y",
+        *http_proxy,
+        "-ss", str(seek_time), "-i", input,
+        "-vframes", "1", "-lossless", "0", "-pix_fmt", "bgra", "-f", "webp", "pipe:1",
+        "-timelimit", "20",
+        "-tls_verify", "0",
+        timeout=20,
+    )
+
+def download_frame_segment(url: str, frame_time: float, fps: float, filename: str, proxies: dict[str, str] | None) -> float:
+    """
+    Downloads only the init segment and the keyframe group with the frame, using the index
+    at the start of the stream. Returns the time to seek to in the downloaded file.
+    """
+    def fetch(start: int, end: int) -> bytes:
+        with requests.get(url, timeout=5, headers={"Range": f"bytes={start}-{end - 1}"}, proxies=proxies, stream=True) as response:
+            # Anything else would be the whole video
+            if response.status_code != 206:
+                raise ContainerIndexError(f"Range request returned status {response.status_code}")
+
+            return response.content
+
+    reader = RangeReader(fetch)
+    return write_segment_file(reader, read_index(reader), frame_time, fps, filename)
+
+async def get_latest_thumbnail_from_files(video_id: str, is_livestream: bool, width: int | None = None) -> Thumbnail:
+    time = await find_latest_thumbnail_time(video_id)
+    return await get_thumbnail_from_files(video_id, time, is_livestream, width=width)
+
+async def find_latest_thumbnail_time(video_id: str) -> float:
     if not valid_video_id(video_id):
         raise ValueError(f"Invalid video ID: {video_id}")
 
-    output_folder = get_folder_path(video_id)
-
-    files = os.listdir(output_folder)
-    files.sort(key=lambda x: os.path.getmtime(os.path.join(output_folder, x)), reverse=True)
+    return await call_storage(find_latest_stored_time, video_id, await get_best_time(video_id))
 
-    best_time = await get_best_time(video_id)
+def find_latest_stored_time(video_id: str, best_time: bytes | None) -> float:
+    """
+    Time of the thumbnail to show for a video when no time is asked for, given its best time
+    """
+    entries = get_storage().list_files(video_id)
+    entries.sort(key=lambda entry: entry.file.mtime_ns, reverse=True)
+    files = [entry.name for entry in entries]
 
     selected_file: str | None = f"{best_time.decode()}{image_format}" if best_time is not None else None
 
@@ -247,59 +461,314 @@ async def get_latest_thumbnail_from_files(video_id: str, is_livestream: bool) ->
         if selected_file is None:
             # Fallback to latest image
             for file in files:
-                if file.endswith(image_format):
+                if file.endswith(image_format) and not is_variant_file(file):
                     selected_file = file
                     break
 
     if selected_file is not None:
         # Remove file extension
-        time = float(re.sub(r"(?:-live)?\.\S{3,4}$", "", selected_file))
-        return await get_thumbnail_from_files(video_id, time, is_livestream)
+        return float(re.sub(r"(?:-live)?\.\S{3,4}$", "", selected_file))
 
     raise FileNotFoundError(f"Failed to find thumbnail for {video_id}")
 
-async def get_thumbnail_from_files(video_id: str, time: float, is_livestream: bool, title: str | None = None) -> Thumbnail:
+async def find_thumbnail_time(video_id: str, time: float, is_livestream: bool) -> float:
+    """
+    Time of the stored thumbnail for a requested time, which can be stored with more precision
+    """
     if not valid_video_id(video_id):
         raise ValueError(f"Invalid video ID: {video_id}")
     if type(time) is not float:
         raise ValueError(f"Invalid time: {time}")
 
-    with os.scandir(get_folder_path(video_id)) as it:
-        truncated_time = math.floor((time * 1000)) / 1000
-        truncated_time_string = str(truncated_time)
-        if "." in truncated_time_string:
-            for entry in it:
-                if entry.is_file() and entry.name.endswith(image_format) \
-                        and entry.name.startswith(truncated_time_string):
-                    try:
-                        time = float(entry.name.replace(image_format, ""))
-                    except ValueError:
-                        continue
-                    break
+    # Usually stored at the time asked for, which is found without listing the folder
+    if await call_storage(get_storage().exists, get_file_names(video_id, time, is_livestream)[1]):
+        return time
+
+    time = await call_storage(find_stored_time, video_id, time)
+    if not await call_storage(get_storage().exists, get_file_names(video_id, time, is_livestream)[1]):
+        # Rendered before the fps of the video was known, from a time in the same frame
+        time = await find_time_in_same_frame(video_id, time)
+
+    return time
+
+def find_stored_time(video_id: str, time: float) -> float:
+    truncated_time = math.floor((time * 1000)) / 1000
+    truncated_time_string = str(truncated_time)
+    if "." in truncated_time_string:
+        for entry in get_storage().list_files(video_id, truncated_time_string):
+            if entry.name.endswith(image_format):
+                try:
+                    time = float(entry.name.replace(image_format, ""))
+                except ValueError:
+                    continue
+                break
+
+    return time
+
+async def find_thumbnail_file(video_id: str, time: float | None, is_livestream: bool, width: int | None = None) -> ThumbnailFile:
+    """
+    Finds the file a request would be answered from, without reading the image
+    """
+    time = await find_thumbnail_time(video_id, time, is_livestream) if time is not None \
+        else await find_latest_thumbnail_time(video_id)
+    _, image_name, metadata_name = get_file_names(video_id, time, is_livestream)
 
-    _, output_filename, metadata_filename, _ = get_file_paths(video_id, time, is_livestream)
+    return await call_storage(find_stored_file, time, image_name, metadata_name, width)
 
-    with open(output_filename, "rb") as file:
-        image_data = file.read()
-        if image_data == b"":
-            raise FileNotFoundError(f"Image file for {video_id} at {time} zero bytes")
+def find_stored_file(time: float, image_name: str, metadata_name: str, width: int | None) -> ThumbnailFile:
+    storage = get_storage()
+    image_file = storage.stat(image_name)
+    if image_file.size == 0:
+        raise FileNotFoundError(f"Image file {image_name} zero bytes")
 
-        if title is not None:
-            with open(metadata_filename, "w") as metadata_file:
-                metadata_file.write(title)
+    metadata_file = stat_if_exists(metadata_name)
+    if width is not None:
+        try:
+            image_file = storage.stat(get_variant_filename(image_name, width))
+        except FileNotFoundError:
+            original_width = get_webp_width(storage.read_start(image_name, webp_header_size))
+            if original_width is not None and original_width > width:
+                # Not made yet, so there is nothing to validate against
+                return ThumbnailFile(time, None, None, None)
+
+    return ThumbnailFile(time, *get_validators(image_file, metadata_file))
 
+def stat_if_exists(name: str) -> StoredFile | None:
+    try:
+        return get_storage().stat(name)
+    except FileNotFoundError:
+        return None
+
+async def get_thumbnail_from_files(video_id: str, time: float, is_livestream: bool, title: str | None = None,
+                                   width: int | None = None) -> Thumbnail:
+    hot_cache_key = get_hot_cache_key(video_id, time, is_livestream, width)
+    thumbnail = await call_storage(get_hot_thumbnail, hot_cache_key, video_id, is_livestream) if title is None else None
+    if thumbnail is not None:
         try:
             await update_last_used(video_id)
         except Exception as e:
             log_error(f"Failed to update last used {e}")
 
-        if title is None and os.path.exists(metadata_filename):
-            with open(metadata_filename, "r") as metadata_file:
-                return Thumbnail(image_data, time, metadata_file.read())
-        else:
-            return Thumbnail(image_data, time)
+        return thumbnail
+
+    time = await find_thumbnail_time(video_id, time, is_livestream)
+    _, image_name, metadata_name = get_file_names(video_id, time, is_livestream)
+    storage = get_storage()
+
+    image_data, image_file = await call_storage(storage.read, image_name)
+    if image_data == b"":
+        raise FileNotFoundError(f"Image file for {video_id} at {time} zero bytes")
+
+    if title is not None:
+        await call_storage(storage.write, metadata_name, title.encode())
+
+    try:
+        await update_last_used(video_id)
+    except Exception as e:
+        log_error(f"Failed to update last used {e}")
+
+    served_name = image_name
+    if width is not None:
+        image_data, image_file, served_name = await get_variant(image_name, image_data, image_file, width)
+
+    stored_title: str | None = None
+    metadata_file: StoredFile | None = None
+    if title is None:
+        try:
+            metadata, metadata_file = await call_storage(storage.read, metadata_name)
+            stored_title = metadata.decode()
+        except FileNotFoundError:
+            pass
+
+    thumbnail = Thumbnail(image_data, time, stored_title, *get_validators(image_file, metadata_file)[:2])
+    if title is None:
+        put_hot_thumbnail(hot_cache_key, thumbnail, served_name, metadata_file.mtime_ns if metadata_file is not None else None)
+
+    return thumbnail
+
+def get_hot_cache_key(video_id: str, time: float, is_livestream: bool, width: int | None) -> bytes:
+    # The folder is part of the key, so that thumbnails of another storage path are never mixed up
+    return f"{get_folder_path(video_id)}/{time}{'-live' if is_livestream else ''}@{width}".encode()
+
+def get_hot_thumbnail(key: bytes, video_id: str, is_livestream: bool) -> Thumbnail | None:
+    """
+    Thumbnail from the hot cache, if the files it was read from have not changed since
+    """
+    hot_cache = get_hot_cache()
+    entry = hot_cache.get(key) if hot_cache is not None else None
+    if entry is None:
+        return None
+
+    time, metadata_mtime_ns, filename_length, etag_length, title_length = hot_entry_format.unpack_from(entry)
+    filename_start = hot_entry_format.size
+    etag_start = filename_start + filename_length
+    title_start = etag_start + etag_length
+    image_start = title_start + title_length
+
+    _, _, metadata_name = get_file_names(video_id, time, is_livestream)
+    metadata_file = stat_if_exists(metadata_name)
+    if (metadata_file.mtime_ns if metadata_file is not None else -1) != metadata_mtime_ns:
+        return None
+
+    try:
+        etag, last_modified, _ = get_validators(get_storage().stat(entry[filename_start:etag_start].decode()), metadata_file)
+    except FileNotFoundError:
+        return None
+    if etag != entry[etag_start:title_start].decode():
+        return None
+
+    title = entry[title_start:image_start].decode() if metadata_mtime_ns != -1 else None
+    return Thumbnail(entry[image_start:], time, title, etag, last_modified)
+
+def put_hot_thumbnail(key: bytes, thumbnail: Thumbnail, served_name: str, metadata_mtime_ns: int | None) -> None:
+    hot_cache = get_hot_cache()
+    if hot_cache is None or thumbnail.etag is None:
+        return
+
+    filename = served_name.encode()
+    etag = thumbnail.etag.encode()
+    title = thumbnail.title.encode() if thumbnail.title is not None else b""
+    hot_cache.put(key, hot_entry_format.pack(thumbnail.time, metadata_mtime_ns if metadata_mtime_ns is not None else -1,
+                                             len(filename), len(etag), len(title)) + filename + etag + title + thumbnail.image)
+
+def get_validators(file: StoredFile, metadata_file: StoredFile | None = None) -> tuple[str, float, int]:
+    """
+    Strong ETag, modification time and size of a stored image. Files are only ever
+    rewritten as a whole, so their sizes and modification times identify the content.
+    The title is sent with the image, so its metadata file is part of the validators.
+    """
+    etag = f"{file.size:x}-{file.mtime_ns:x}"
+    mtime_ns = file.mtime_ns
+    if metadata_file is not None:
+        etag += f"-{metadata_file.size:x}-{metadata_file.mtime_ns:x}"
+        mtime_ns = max(mtime_ns, metadata_file.mtime_ns)
+
+    return f'"{etag}"', mtime_ns / 1_000_000_000, file.size
+
+def get_variant_width(width: int) -> int | None:
+    """
+    Smallest variant at least as wide as asked for, None when only the original is
+    """
+    widths = [variant_width for variant_width in config["thumbnail_variant_widths"] if variant_width >= width]
+    return min(widths) if len(widths) > 0 else None
+
+def get_variant_filename(output_filename: str, width: int) -> str:
+    return output_filename.removesuffix(image_format) + f"-{width}w{image_format}"
+
+def is_variant_file(name: str) -> bool:
+    return re.search(r"-\d+w" + re.escape(image_format) + "$", name) is not None
+
+# Enough of the start of an image for get_webp_width
+webp_header_size = 30
+
+def get_webp_width(image: bytes) -> int | None:
+    if image[0:4] != b"RIFF" or image[8:12] != b"WEBP":
+        return None
+
+    chunk_type = image[12:16]
+    if chunk_type == b"VP8X":
+        return int.from_bytes(image[24:27], "little") + 1
+    elif chunk_type == b"VP8 ":
+        return int.from_bytes(image[26:28], "little") & 0x3FFF
+    elif chunk_type == b"VP8L":
+        return (int.from_bytes(image[21:25], "little") & 0x3FFF) + 1
+
+    return None
+
+async def get_variant(image_name: str, image_data: bytes, image_file: StoredFile, width: int) -> tuple[bytes, StoredFile, str]:
+    """
+    Returns the image scaled down to the width, its stored file and its name. It is made from the original
+    the first time and stored next to it, so it is accounted for and deleted with the rest of the video.
+    """
+    original_width = get_webp_width(image_data)
+    if original_width is None or original_width <= width:
+        return image_data, image_file, image_name
+
+    variant_name = get_variant_filename(image_name, width)
+    try:
+        variant_data, variant_file = await call_storage(get_storage().read, variant_name)
+        if variant_data != b"":
+            return variant_data, variant_file, variant_name
+    except FileNotFoundError:
+        pass
+
+    try:
+        variant_data, variant_file = await asyncio.to_thread(create_variant, image_data, variant_name, width)
+    except (FFmpegError, FFmpegNotFoundError, TimeoutExpired) as e:
+        # The original is sent instead
+        log_error(f"Failed to create {width} wide variant of {image_name}", e)
+        return image_data, image_file, image_name
+
+    try:
+        await add_storage_used(len(variant_data))
+    except Exception as e:
+        log_error("Failed to update storage used", e)
+
+    return variant_data, variant_file, variant_name
+
+def create_variant(image_data: bytes, variant_name: str, width: int) -> tuple[bytes, StoredFile]:
+    variant_data = run_ffmpeg_output("-f", "webp_pipe", "-i", "pipe:0", "-vf", f"scale={width}:-2", "-lossless", "0",
+                                     "-f", "webp", "pipe:1", input=image_data, timeout=10)
+    return variant_data, get_storage().write(variant_name, variant_data)
+
+async def find_time_in_same_frame(video_id: str, time: float) -> float:
+    fps = await get_fps(video_id)
+    if fps is None:
+        return time
+
+    return await call_storage(find_stored_time_in_frame, video_id, time, fps)
+
+def find_stored_time_in_frame(video_id: str, time: float, fps: float) -> float:
+    frame_index = get_frame_index(time, fps)
+    for entry in get_storage().list_files(video_id):
+        if entry.name.endswith(image_format):
+            try:
+                entry_time = float(entry.name.replace(image_format, ""))
+            except ValueError:
+                continue
+
+            if get_frame_index(entry_time, fps) == frame_index:
+                return entry_time
+
+    return time
+
+def get_frame_index(time: float, fps: float) -> int:
+    # Times exactly on a frame, like 5.3 at 30 fps, would otherwise round down to the previous frame
+    return math.floor(time * fps + 1e-6)
+
+def get_frame_time(frame_index: int, fps: float) -> float:
+    # Rounded up to the millisecond, which stays inside the frame and keeps file names short
+    return math.ceil(frame_index * 1000 / fps - 1e-6) / 1000
+
+async def quantize_time(video_id: str, time: float) -> float:
+    """
+    Moves a time to the start of its frame, so that every time showing the same frame
+    shares a job and a file. Times are left as is until the fps of the video is known.
+    """
+    fps = await get_fps(video_id)
+    if fps is None:
+        return time
+
+    return get_frame_time(get_frame_index(time, fps), fps)
+
+def get_file_names(video_id: str, time: float, is_livestream: bool) -> tuple[str, str, str]:
+    """
+    Folder, image and metadata names in the storage, see utils/storage.py
+    """
+    if not valid_video_id(video_id):
+        raise ValueError(f"Invalid video ID: {video_id}")
+    if type(time) is not float:
+        raise ValueError(f"Invalid time: {time}")
+
+    image_name = f"{video_id}/{time}{'-live' if is_livestream else ''}{image_format}"
+    metadata_name = f"{video_id}/{time}{metadata_format}"
+
+    return (video_id, image_name, metadata_name)
 
 def get_file_paths(video_id: str, time: float, is_livestream: bool) -> tuple[str, str, str, str]:
+    """
+    Paths of the files with the local storage backend. Videos are downloaded to the folder with any backend.
+    """
     if not valid_video_id(video_id):
         raise ValueError(f"Invalid video ID: {video_id}")
     if type(time) is not float:
@@ -322,12 +791,60 @@ def get_folder_path(video_id: str) -> str:
 def get_job_id(video_id: str, time: float) -> str:
     return f"{video_id}-{time}"
 
+def get_render_job_id(video_id: str, time: float) -> str:
+    return f"{get_job_id(video_id, time)}-render"
+
 def get_best_time_key(video_id: str) -> str:
     return f"best-{video_id}"
 
+def get_fps_key(video_id: str) -> str:
+    return f"fps-{video_id}"
+
 @retry(tries=5, delay=0.1, backoff=3)
-def publish_job_status(video_id: str, time: float, status: str) -> None:
-    redis_conn.publish(get_job_id(video_id, time), status)
+def publish_job_status(video_id: str, time: float, status: str, thumbnail: Thumbnail | None = None) -> None:
+    redis_conn.publish(get_job_id(video_id, time), encode_job_status(status, thumbnail))
+
+def encode_job_status(status: str, thumbnail: Thumbnail | None) -> bytes:
+    """
+    The status alone, or followed by a line of JSON with the thumbnail's details and then the image
+    """
+    if thumbnail is None:
+        return status.encode()
+
+    details = json.dumps({
+        "time": thumbnail.time,
+        "title": thumbnail.title,
+        "etag": thumbnail.etag,
+        "lastModified": thumbnail.last_modified,
+    })
+    return f"{status}\n{details}\n".encode() + thumbnail.image
+
+def decode_job_status(message: bytes) -> tuple[str, Thumbnail | None]:
+    parts = message.split(b"\n", 2)
+    if len(parts) < 3:
+        return parts[0].decode(), None
+
+    details = json.loads(parts[1])
+    return parts[0].decode(), Thumbnail(parts[2], details["time"], details["title"], details["etag"], details["lastModified"])
+
+def get_job_status(message: bytes) -> str:
+    return message.split(b"\n", 1)[0].decode()
+
+async def get_finished_thumbnail(video_id: str, is_livestream: bool, title: str | None, thumbnail: Thumbnail) -> Thumbnail:
+    """
+    Handles a thumbnail from the completion message like get_thumbnail_from_files does a stored one
+    """
+    if title is not None:
+        _, _, metadata_name = get_file_names(video_id, thumbnail.time, is_livestream)
+        await call_storage(get_storage().write, metadata_name, title.encode())
+        thumbnail = replace(thumbnail, title=None)
+
+    try:
+        await update_last_used(video_id)
+    except Exception as e:
+        log_error(f"Failed to update last used {e}")
+
+    return thumbnail
 
 async def set_best_time(video_id: str, time: float) -> None:
     await (await get_async_redis_conn()).set(get_best_time_key(video_id), time)
@@ -335,6 +852,10 @@ async def set_best_time(video_id: str, time: float) -> None:
 async def get_best_time(video_id: str) -> bytes | None:
     return cast(bytes | None, await (await get_async_redis_conn()).get(get_best_time_key(video_id)))
 
+async def get_fps(video_id: str) -> float | None:
+    fps = cast(bytes | None, await (await get_async_redis_conn()).get(get_fps_key(video_id)))
+    return float(fps) if fps is not None and float(fps) > 0 else None
+
 def send_fail_status(proxy_status_url: str) -> None:
     url = proxy_status_url + "api/fail"
     print(f"Sending fail status to {url}")
@@ -1,24 +1,30 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
 import random
 import re
-from typing import Any, cast
+import threading
+from typing import Any, Iterator, cast
 from retry import retry
-import yt_dlp # pyright: ignore[reportMissingTypeStubs]
 from utils.config import config
 import utils.floatie as floatie
+from utils.format_selection import get_bitrate, get_codec, record_chosen_format, select_format
 import time as time_module
 from utils.redis_handler import redis_conn
 
 class YtdlpRatelimitError(Exception):
     pass
 
-def create_ytdlp_object():
+def create_ytdlp_object(proxy_url: str | None = None):
+    # Imported on first use, as it is a large part of the startup time and memory of processes that never use it
+    import yt_dlp # pyright: ignore[reportMissingTypeStubs]
+
     return yt_dlp.YoutubeDL({
         "retries": 0,
         "fragment_retries": 0,
         "extractor_retries": 0,
         "file_access_retries": 0,
         "socket_timeout": 15,
+        "proxy": proxy_url,
         "remote_components": ["ejs:github"],
         "extractor_args": {
             "youtube": {
@@ -28,7 +34,78 @@ def create_ytdlp_object():
         }
     })
 
-ydl = create_ytdlp_object()
+@dataclass
+class PooledYtdlp:
+    ydl: Any
+    proxy_url: str | None
+    uses: int = 0
+
+class YtdlpPool:
+    """
+    Idle YoutubeDL objects by proxy, so that extractors and player caches are kept between jobs.
+
+    YoutubeDL is not thread safe, so an object is only used by one job at a time.
+    At most max_idle objects are kept, the least recently used are closed first.
+    """
+
+    def __init__(self, max_idle: int, max_uses: int):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        # Least recently used first
+        self.idle: list[PooledYtdlp] = []
+        self.lock = threading.Lock()
+
+    def acquire(self, proxy_url: str | None) -> PooledYtdlp:
+        with self.lock:
+            for index in range(len(self.idle) - 1, -1, -1):
+                if self.idle[index].proxy_url == proxy_url:
+                    return self.idle.pop(index)
+
+        return PooledYtdlp(create_ytdlp_object(proxy_url), proxy_url)
+
+    def release(self, pooled: PooledYtdlp, reuse: bool = True) -> None:
+        evicted: list[PooledYtdlp] = []
+        if reuse and pooled.uses < self.max_uses:
+            with self.lock:
+                self.idle.append(pooled)
+                while len(self.idle) > self.max_idle:
+                    evicted.append(self.idle.pop(0))
+        else:
+            evicted.append(pooled)
+
+        for old in evicted:
+            old.ydl.close()
+
+    @contextmanager
+    def use(self, proxy_url: str | None) -> Iterator[Any]:
+        pooled = self.acquire(proxy_url)
+        pooled.uses += 1
+        reuse = True
+        try:
+            yield pooled.ydl
+        except YtdlpRatelimitError:
+            # Start again with a clean session
+            reuse = False
+            raise
+        finally:
+            self.release(pooled, reuse)
+
+    def warm(self, proxy_urls: list[str | None]) -> None:
+        for proxy_url in proxy_urls[:self.max_idle]:
+            self.release(PooledYtdlp(create_ytdlp_object(proxy_url), proxy_url))
+
+ytdlp_pool = YtdlpPool(config["ytdlp_pool_size"], config["ytdlp_max_uses"])
+
+def warm_ytdlp_pool() -> None:
+    # Proxies fetched with proxy_token change all the time, so only fixed ones are warmed
+    if "proxy_urls" in config and config["proxy_urls"] is not None and len(config["proxy_urls"]) > 0:
+        ytdlp_pool.warm([proxy["url"] for proxy in config["proxy_urls"]])
+    elif config["proxy_token"] is None:
+        ytdlp_pool.warm([config["proxy_url"]])
+
+def is_ratelimit_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return "http error 429" in message or "rate-limit" in message or "not a bot" in message
 
 @dataclass
 class PlaybackUrl:
@@ -36,6 +113,9 @@ class PlaybackUrl:
     width: int
     height: int
     fps: int
+    codec: str = "unknown"
+    # Bits per second, None when the format list does not say
+    bitrate: int | None = None
 
 def valid_video_id(video_id: str) -> bool:
     return type(video_id) is str and re.match(r"^[A-Za-z0-9_\-]{11}$", video_id) is not None
@@ -45,11 +125,11 @@ def get_playback_url(video_id: str, proxy_url: str | None,
                         height: int = config["default_max_height"]) -> PlaybackUrl:
     playback_urls = get_playback_urls(video_id, proxy_url, is_livestream)
 
-    for url in playback_urls:
-        if url.height <= height:
-            return url
+    playback_url, render_time = select_format(playback_urls, height)
+    print(f"Chose {playback_url.codec} {playback_url.height}p for {video_id}, expecting a render of {render_time:.2f}s")
+    record_chosen_format(playback_url)
 
-    raise ValueError(f"Failed to find playback URL with height <= {height}")
+    return playback_url
 
 def get_playback_urls(video_id: str, proxy_url: str | None, is_livestream: bool) -> list[PlaybackUrl]:
     formats: list[dict[str, str | int]] | None = None
@@ -62,7 +142,7 @@ def get_playback_urls(video_id: str, proxy_url: str | None, is_livestream: bool)
             print(f"floatie error:{e}")
 
             # Give up early, let the client generate one since it is geoblocked
-            return []
+            raise
         except Exception as e:
             print(f"floatie error:{e}")
             errors.append(e)
@@ -75,31 +155,18 @@ def get_playback_urls(video_id: str, proxy_url: str | None, is_livestream: bool)
             errors.append(e)
 
     if formats is None:
+        # The last error decided the failure, earlier ones were recovered from by falling back
         raise ValueError(f"Failed to fetch playback URLs: {video_id} Errors: {','.join([str(error) for error in errors])}") \
-            from errors[0]
+            from errors[-1]
 
-    if any(format_has_av1(format) for format in formats):
-        # Filter for only av1
-        formats = [format for format in formats if format_has_av1(format)]
-
-    formatted_urls = [PlaybackUrl(url["url"], url["width"], url["height"], url["fps"])
+    formatted_urls = [PlaybackUrl(url["url"], url["width"], url["height"], url["fps"], get_codec(url), get_bitrate(url))
         for url in cast(list[dict[str, Any]], formats) if "height" in url and url["height"] is not None]
-
-    if formatted_urls[-1].height > 720:
-        # Order is the wrong way
-        formatted_urls.reverse()
     formatted_urls.sort(key=lambda url: url.height, reverse=True)
 
     return formatted_urls
 
-def format_has_av1(format: dict[str, str | int]) -> bool:
-    return ("mimeType" in format and "av01" in cast(str, format["mimeType"])) \
-        or  ("vcodec" in format and "av01" in cast(str, format["vcodec"]))
-
 @retry(YtdlpRatelimitError, tries=2, delay=1)
 def fetch_playback_urls_from_ytdlp(video_id: str, proxy_url: str | None) -> list[dict[str, str | int]]:
-    global ydl
-
     wait_time = 0
     while redis_conn.zcard("concurrent_ytdlp") > config["max_concurrent_ytdlp"]:
         print("Waiting for other ytdlp to finish")
@@ -112,21 +179,22 @@ def fetch_playback_urls_from_ytdlp(video_id: str, proxy_url: str | None) -> list
         time_module.sleep(0.1 + 0.05 * random.random())
     redis_conn.zadd("concurrent_ytdlp", { video_id: time_module.time() })
 
+    import yt_dlp # pyright: ignore[reportMissingTypeStubs]
     url = f"https://www.youtube.com/watch?v={video_id}"
-    ydl = create_ytdlp_object()
-    ydl.params["proxy"] = proxy_url
 
     try:
-        info: Any = ydl.extract_info(url, download=False)
-
-        formats: list[dict[str, str | int]] = ydl.sanitize_info(info)["formats"] # pyright: ignore
+        with ytdlp_pool.use(proxy_url) as ydl:
+            try:
+                info: Any = ydl.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError as e:
+                if is_ratelimit_error(e):
+                    raise YtdlpRatelimitError(str(e)) from e
+                raise
+
+            formats: list[dict[str, str | int]] = ydl.sanitize_info(info)["formats"] # pyright: ignore
         if type(formats) is list:
             return formats
         else:
             raise ValueError("Failed to parse playback URLs: {video_id}")
-    except Exception as e:
-        if "rate-limited by YouTube for up to an hour" in str(e):
-            ydl = create_ytdlp_object()
-        raise
     finally:
         redis_conn.zrem("concurrent_ytdlp", video_id)
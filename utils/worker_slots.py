@@ -0,0 +1,74 @@
+import asyncio
+import signal
+import threading
+import time
+from typing import Any, Optional
+
+from rq.job import Job
+from rq.queue import Queue
+from rq.timeouts import TimerDeathPenalty
+from rq.worker import DequeueStrategy, SimpleWorker
+from utils.priority_queue import PriorityJob, PriorityQueue
+from utils.profiling import profile_job
+
+# How often idle slots wake up to check if they should stop
+slot_dequeue_timeout = 5
+
+class ThumbnailWorker(SimpleWorker):
+    queue_class = PriorityQueue
+    job_class = PriorityJob
+
+    def execute_job(self, job: Job, queue: Queue) -> None:
+        with profile_job(job):
+            super().execute_job(job, queue)
+
+class WorkerSlot(ThumbnailWorker):
+    """
+    One of several workers sharing a process, each running jobs on its own thread.
+
+    Signals can only be handled on the main thread, so job timeouts use a timer
+    instead of SIGALRM and stopping is coordinated by run_worker_slots.
+    """
+    death_penalty_class = TimerDeathPenalty
+
+    def _install_signal_handlers(self) -> None:
+        pass
+
+    def dequeue_job_and_maintain_ttl(self, timeout: Optional[int], max_idle_time: Optional[int] = None) -> Any:
+        # Wake up regularly instead of blocking for the whole dequeue timeout
+        while not self._stop_requested:
+            result = super().dequeue_job_and_maintain_ttl(slot_dequeue_timeout, slot_dequeue_timeout)
+            if result is not None:
+                return result
+
+        return None
+
+def run_slot(worker: WorkerSlot, dequeue_strategy: DequeueStrategy) -> None:
+    # Jobs run async redis calls on the thread's own event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    worker.work(dequeue_strategy=dequeue_strategy)
+
+def run_worker_slots(workers: list[WorkerSlot], dequeue_strategy: DequeueStrategy = DequeueStrategy.DEFAULT) -> None:
+    threads = [threading.Thread(target=run_slot, args=(worker, dequeue_strategy), name=worker.name, daemon=True)
+                for worker in workers]
+    stop_requests = 0
+
+    def request_stop(signum: int, _: Any) -> None:
+        nonlocal stop_requests
+        stop_requests += 1
+        if stop_requests > 1:
+            # Second signal, don't wait for running jobs
+            raise SystemExit(1)
+
+        print(f"Got signal {signum}, stopping after current jobs finish. Send again to force.")
+        for worker in workers:
+            worker._stop_requested = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for thread in threads:
+        thread.start()
+
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)
@@ -1,29 +1,43 @@
+import argparse
 import threading
 from typing import Any
 from fastapi import FastAPI, HTTPException
 import uvicorn
-from rq.worker import SimpleWorker as Worker, WorkerStatus, DequeueStrategy
-from utils.redis_handler import redis_conn
+from rq.worker import SimpleWorker, WorkerStatus, DequeueStrategy
+from utils.redis_handler import queue_render, queue_resolve, redis_conn
 from utils.config import config
+from utils.ffmpeg import get_ffmpeg_path
 from utils.misc import generate_worker_name
+from utils.worker_slots import ThumbnailWorker, WorkerSlot, run_worker_slots
 
-# Import some modules to pre-run init before worker forks
-import utils.video  # noqa: F401
+# Import some modules to pre-run init before worker forks, yt-dlp itself is only loaded by warm_ytdlp_pool
+from utils.video import warm_ytdlp_pool
 
-listen = ["high", "default"]
-worker = Worker(listen, connection=redis_conn, name=generate_worker_name())
+# Render jobs come first so that work already in the pipeline finishes before new work starts
+stage_queues = {
+    "resolve": [queue_resolve.name],
+    "render": [queue_render.name],
+    "all": [queue_render.name, queue_resolve.name],
+}
+
+workers: list[ThumbnailWorker] = []
+
+def create_workers(stage: str, concurrency: int) -> list[ThumbnailWorker]:
+    listen = stage_queues[stage]
+    worker_name = generate_worker_name()
+
+    if concurrency <= 1:
+        return [ThumbnailWorker(listen, connection=redis_conn, name=worker_name)]
+    else:
+        # Each slot is a separate rq worker, so they show up individually in status and metrics
+        return [WorkerSlot(listen, connection=redis_conn, name=f"{worker_name}-{index}") for index in range(concurrency)]
 
 health_check = FastAPI()
 
 
-@health_check.get("{full_path:path}")
-def get_health_check() -> dict[str, Any]:
+def get_worker_info(worker: SimpleWorker) -> dict[str, Any]:
     current_job = worker.get_current_job()
 
-    if worker.state == WorkerStatus.SUSPENDED \
-            or (worker.state == WorkerStatus.BUSY and current_job is None):
-        raise HTTPException(status_code=500, detail="Worker suspended")
-
     return {
         "name": worker.name,
         "key": worker.key,
@@ -43,11 +57,39 @@ def get_health_check() -> dict[str, Any]:
         "successful_job_count": worker.successful_job_count,
         "failed_job_count": worker.failed_job_count,
         "total_working_time": worker.total_working_time,
-        "total_workers": worker.count(redis_conn)
+    }
+
+
+@health_check.get("{full_path:path}")
+def get_health_check() -> dict[str, Any]:
+    slots = [get_worker_info(slot) for slot in workers]
+
+    for slot in slots:
+        if slot["state"] == WorkerStatus.SUSPENDED \
+                or (slot["state"] == WorkerStatus.BUSY and slot["current_job"] is None):
+            raise HTTPException(status_code=500, detail="Worker suspended")
+
+    return {
+        **slots[0],
+        "total_workers": ThumbnailWorker.count(redis_conn),
+        "slots": slots,
     }
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a thumbnail worker")
+    parser.add_argument("--stage", choices=list(stage_queues), default=config["worker_stage"],
+                        help="Which generation stage to work on, so that each can be scaled separately")
+    parser.add_argument("--concurrency", type=int, default=config["worker_concurrency"],
+                        help="Jobs to run at the same time in this process")
+    args = parser.parse_args()
+
+    # Fails at start rather than on the first job
+    get_ffmpeg_path()
+    workers.extend(create_workers(args.stage, args.concurrency))
+    if config["try_ytdlp"] and args.stage != "render":
+        warm_ytdlp_pool()
+
     uvicorn_thread = threading.Thread(target=uvicorn.run, kwargs={
         "app": health_check,
         "host": config["server"]["host"], # type: ignore
@@ -57,4 +99,8 @@ if __name__ == "__main__":
     uvicorn_thread.daemon = True
     uvicorn_thread.start()
 
-    worker.work(dequeue_strategy=DequeueStrategy.DEFAULT)
+    slots = [worker for worker in workers if isinstance(worker, WorkerSlot)]
+    if len(slots) > 0:
+        run_worker_slots(slots, DequeueStrategy.DEFAULT)
+    else:
+        workers[0].work(dequeue_strategy=DequeueStrategy.DEFAULT)